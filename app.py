@@ -1,14 +1,40 @@
 # app.py
 # -*- coding: utf-8 -*-
 import os
+import re
+import sys
 import json
+import time
+import uuid
+import queue
+import random
+import signal
+import functools
+import hmac
+import itertools
+import asyncio
 import logging
+import threading
+import traceback
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
 from typing import Dict, Tuple, Optional, List
+from urllib.parse import parse_qsl, quote, unquote, unquote_to_bytes, urlencode, urljoin, urlsplit
+
+try:
+    import orjson  # 選用：有裝就用較快的 JSON 編解碼
+except ImportError:  # pragma: no cover
+    orjson = None
 
 import requests
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse
+from starlette.background import BackgroundTask, BackgroundTasks
+from starlette.concurrency import run_in_threadpool
+
+from envparse import parse_map  # 'k1:v1,k2:v2' 對照表（replay_traffic.py 也用同一個）
 
 
 # ----------------------------
@@ -20,19 +46,51 @@ def parse_bool(s: Optional[str], default: bool = False) -> bool:
     return str(s).strip().lower() in {"1", "true", "yes", "y", "on"}
 
 
-def parse_map(raw: str) -> Dict[str, str]:
+def parse_rate(spec: Optional[str]) -> Optional[Tuple[float, float]]:
+    """
+    解析 '次數/秒數' 成 (容量, 每秒補充量)。
+    例：
+      '10/60' -> (10.0, 0.1667)   # 每分鐘 10 次，可瞬間用完
+      '5'     -> (5.0, 5.0)       # 每秒 5 次
+    空字串或格式錯誤回傳 None（不限制）
+    """
+    spec = (spec or "").strip()
+    if not spec:
+        return None
+    try:
+        count, _, per = spec.partition("/")
+        capacity = float(count)
+        period = float(per) if per else 1.0
+    except ValueError:
+        return None
+    if capacity <= 0 or period <= 0:
+        return None
+    return capacity, capacity / period
+
+
+def scan_urlencoded(body: bytes, keys: Tuple[str, ...]) -> Dict[str, str]:
     """
-    解析 'k1:v1,k2:v2' 成 dict，左右兩邊會 strip。
+    只從 x-www-form-urlencoded 的原始 body 解出指定欄位，其他欄位完全不 decode。
+    同名欄位以最後一個為準（與 request.form() 的 dict 結果一致）。
     例：
-      '196:tokA, 94:tokB' -> {'196': 'tokA', '94': 'tokB'}
-    也可用來解析 '196:urlA,94:urlB'
+      scan_urlencoded(b'token=a&text=%E6%96%B0+x', ('text',)) -> {'text': '新 x'}
     """
-    m: Dict[str, str] = {}
-    for part in [p for p in (raw or "").split(",") if p.strip()]:
-        if ":" in part:
-            k, v = part.split(":", 1)
-            m[k.strip()] = v.strip()
-    return m
+    wanted = {k.encode("ascii"): k for k in keys}
+    out: Dict[str, str] = {}
+    for pair in body.split(b"&"):
+        k, _, v = pair.partition(b"=")
+        key = wanted.get(k)
+        if key is not None:
+            out[key] = unquote_to_bytes(v.replace(b"+", b" ")).decode("utf-8", "replace")
+    return out
+
+
+def build_keyword_matcher(keywords: List[str]) -> Optional["re.Pattern[str]"]:
+    """把多個關鍵字編成單一 regex（長字優先），掃描一次就知道是否命中任一關鍵字"""
+    alts = sorted({k for k in keywords if k}, key=len, reverse=True)
+    if not alts:
+        return None
+    return re.compile("|".join(re.escape(k) for k in alts))
 
 
 def calculate_business_days(start_date: datetime, days: int) -> str:
@@ -46,25 +104,28 @@ def calculate_business_days(start_date: datetime, days: int) -> str:
     return current.strftime("%Y-%m-%d")
 
 
+# 指令參數的冒號：半形、全形都接受（解析、自訂欄位、從標題移除參數都用同一個）
+FIELD_COLON = '[:：]'
+
+
 def parse_task_params(text: str) -> Optional[Dict[str, str]]:
     """
     解析新任務的結構化參數
-    格式：新任務 專案:XXXX 標題:YYYY 指派:ZZZZ 開始:yyyy-mm-dd 完成:yyyy-mm-dd
+    格式：新任務 專案:XXXX 標題:YYYY 指派:ZZZZ 開始:yyyy-mm-dd 完成:yyyy-mm-dd（冒號可全形）
     """
-    import re
-    
     # 檢查是否為新任務格式
-    if not any(keyword in text for keyword in ['新任務', '增加新任務', '增加新議題', '新議題']):
+    if not any(keyword in text for keyword in TASK_KEYWORDS):
         return None
     
     # 解析參數
     params = {}
     param_patterns = {
-        'project': r'專案:\s*([^\s]+)',
-        'subject': r'標題:\s*([^\s]+)',
-        'assignee': r'指派:\s*([^\s]+)', 
-        'start_date': r'開始:\s*(\d{4}-\d{2}-\d{2})',
-        'due_date': r'完成:\s*(\d{4}-\d{2}-\d{2})'
+        'project': rf'專案{FIELD_COLON}\s*([^\s]+)',
+        'subject': rf'標題{FIELD_COLON}\s*([^\s]+)',
+        'assignee': rf'指派{FIELD_COLON}\s*([^\s]+)',
+        'start_date': rf'開始{FIELD_COLON}\s*(\d{{4}}-\d{{2}}-\d{{2}})',
+        'due_date': rf'完成{FIELD_COLON}\s*(\d{{4}}-\d{{2}}-\d{{2}})',
+        'priority': rf'優先{FIELD_COLON}\s*([^\s]+)',
     }
     
     for key, pattern in param_patterns.items():
@@ -82,157 +143,2648 @@ def parse_task_params(text: str) -> Optional[Dict[str, str]]:
     return params
 
 
-def is_new_business_keyword(text: str) -> bool:
-    """檢查是否為新商機關鍵字（舊功能）"""
-    return any(keyword in text for keyword in KEYWORDS)
+def is_new_business_keyword(text: str) -> bool:
+    """檢查是否為新商機關鍵字（舊功能）"""
+    return any(keyword in text for keyword in current_routing().keywords)
+
+
+def is_new_task_keyword(text: str) -> bool:
+    """檢查是否為新任務關鍵字（新功能）"""
+    return any(keyword in text for keyword in TASK_KEYWORDS)
+
+
+# ----------------------------
+# 環境變數
+# ----------------------------
+PORT = int(os.getenv("PORT", "8085"))
+
+# Outgoing 驗證、允許頻道、Incoming 回貼、關鍵字、限流：可熱更新，見「路由表」區段的 RoutingTable
+CONFIG_FILE = os.getenv("CONFIG_FILE", ".env").strip()                     # 熱更新時重新讀取的設定檔（KEY=VALUE）
+CONFIG_WATCH_INTERVAL = float(os.getenv("CONFIG_WATCH_INTERVAL", "2"))     # 檢查設定檔是否變更的間隔（秒），0 = 不監看
+
+# 流量控制
+PIPELINE_MAX_INFLIGHT = int(os.getenv("PIPELINE_MAX_INFLIGHT", "4"))     # 每台 Redmine 同時執行的建單流程上限
+PIPELINE_MAX_QUEUE = int(os.getenv("PIPELINE_MAX_QUEUE", "20"))          # 每台 Redmine 的排隊上限，超過直接拒絕
+PIPELINE_QUEUE_TIMEOUT = float(os.getenv("PIPELINE_QUEUE_TIMEOUT", "30"))  # 排隊最久等幾秒
+RATE_NOTICE_COOLDOWN = float(os.getenv("RATE_NOTICE_COOLDOWN", "60"))    # 同一對象的限流通知間隔
+
+# 請求期限（秒）：整個 webhook 的總預算，所有下游呼叫共用
+ROUTE_DEADLINES = parse_map(os.getenv("ROUTE_DEADLINES", ""))  # 'chat_webhook:20,n8n_webhook:15'
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "25"))    # 未列在 ROUTE_DEADLINES 的路由
+DEFERRED_DEADLINE = float(os.getenv("DEFERRED_DEADLINE", "60"))  # 回應送出後的延後工作（子議題、回貼）
+SUBTASK_MIN_BUDGET = float(os.getenv("SUBTASK_MIN_BUDGET", "8"))  # 剩餘預算低於此值，子議題改為延後建立
+ACK_MIN_BUDGET = float(os.getenv("ACK_MIN_BUDGET", "2"))          # 剩餘預算低於此值，回貼改為延後送出
+
+# Shadow（演練）模式：完整跑流程但不寫入 Redmine、不回貼 Chat
+SHADOW_CHANNEL_IDS = {s for s in os.getenv("SHADOW_CHANNEL_IDS", "").replace(" ", "").split(",") if s}
+SHADOW_ROUTES = {s for s in os.getenv("SHADOW_ROUTES", "").replace(" ", "").split(",") if s}  # 'n8n_webhook'
+SHADOW_MIRROR_RATE = float(os.getenv("SHADOW_MIRROR_RATE", "0"))  # 正式流量中有多少比例（0~1）鏡像到 SHADOW_MIRROR_URL
+SHADOW_MIRROR_URL = os.getenv("SHADOW_MIRROR_URL", "").strip().rstrip("/")  # 候選版本（另一個部署）的 base URL；鏡像請求一律以 shadow 執行
+SHADOW_MIRROR_TOKEN = os.getenv("SHADOW_MIRROR_TOKEN", "").strip()          # 鏡像請求帶的 X-Debug-Token（= 候選版本的 DEBUG_TOKEN）
+SHADOW_MIRROR_MAX_INFLIGHT = int(os.getenv("SHADOW_MIRROR_MAX_INFLIGHT", "2"))  # 同時進行的鏡像上限（獨立名額，不佔建單閘門）
+SHADOW_MIRROR_TIMEOUT = float(os.getenv("SHADOW_MIRROR_TIMEOUT", "10"))         # 等候選版本回應最久幾秒（另受路由期限限制）
+SHADOW_BUFFER_SIZE = int(os.getenv("SHADOW_BUFFER_SIZE", "200"))   # /debug/shadow 保留最近幾筆
+SHADOW_LOG_PATH = os.getenv("SHADOW_LOG_PATH", "").strip()          # 設定後每筆 shadow 結果另外 append 成 NDJSON
+
+# 追蹤 / 慢請求分析
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))       # /debug/traces 保留最近幾筆
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "5000"))            # 超過此毫秒數視為慢請求
+TRACE_PROFILE = parse_bool(os.getenv("TRACE_PROFILE"), default=False)  # 慢請求是否輸出取樣 profile
+TRACE_PROFILE_DIR = os.getenv("TRACE_PROFILE_DIR", "logs/profiles")
+TRACE_PROFILE_INTERVAL = float(os.getenv("TRACE_PROFILE_INTERVAL", "0.005"))  # 取樣間隔（秒）
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "").strip()  # /debug/* 與 /stats 需帶 X-Debug-Token；未設定 = 這些端點關閉
+
+# 流量錄製（給 replay_traffic.py 重播）
+TRAFFIC_RECORD_PATH = os.getenv("TRAFFIC_RECORD_PATH", "").strip()  # 設定後把 webhook 請求（token 遮蔽）append 成 NDJSON
+TRAFFIC_RECORD_ROUTES = {s for s in os.getenv("TRAFFIC_RECORD_ROUTES", "/chat_webhook,/n8n_webhook").replace(" ", "").split(",") if s}
+TRAFFIC_RECORD_MAX_BODY = int(os.getenv("TRAFFIC_RECORD_MAX_BODY", "65536"))  # body 超過此 bytes 只記長度
+
+# 建單統計（/stats）：每次建單結果 append 到事件紀錄，彙總隨寫入累加；快照記下彙總與對應的檔案 offset，重啟只補讀之後的部分
+STATS_EVENT_LOG = os.getenv("STATS_EVENT_LOG", "logs/pipeline_events.ndjson").strip()  # 空白 = 不記錄
+STATS_SNAPSHOT_PATH = os.getenv("STATS_SNAPSHOT_PATH", "logs/pipeline_stats.json")
+STATS_SNAPSHOT_EVERY = int(os.getenv("STATS_SNAPSHOT_EVERY", "50"))        # 每寫入幾筆事件存一次快照（停機時也會存）
+STATS_HOURLY_RETENTION = int(os.getenv("STATS_HOURLY_RETENTION", "2160"))  # 每小時彙總保留幾小時（預設 90 天）
+STATS_WINDOWS = sorted({int(h) for h in os.getenv("STATS_WINDOWS", "24,168,720").replace(" ", "").split(",") if h.isdigit() and int(h) > 0})  # /stats?hours= 可選的視窗（小時），各自累加維護
+
+# Event loop 監控：量測排程延遲，卡住超過門檻時把卡住當下的 stack 印出來
+LOOP_MONITOR = parse_bool(os.getenv("LOOP_MONITOR"), default=True)
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.25"))  # 量測間隔（秒）
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "200"))  # 延遲超過此值記錄 stack
+
+# Incoming 回貼
+CHAT_VERIFY_TLS = parse_bool(os.getenv("CHAT_VERIFY_TLS"), default=False)  # 自簽憑證先關
+
+# 歷史輪詢：服務停機 / 太慢時 webhook 會漏訊息，改由背景 task 登入 Chat Web API 批次補讀（同 chat_probe.sh）
+CHAT_POLL = parse_bool(os.getenv("CHAT_POLL"), default=False)
+CHAT_API_BASE = os.getenv("CHAT_API_BASE", "").rstrip("/")          # 'https://192.168.0.222:5001'
+CHAT_USER = os.getenv("CHAT_USER", "").strip()
+CHAT_PASS = os.getenv("CHAT_PASS", "")
+CHAT_POLL_CHANNELS = {s for s in os.getenv("CHAT_POLL_CHANNELS", "").replace(" ", "").split(",") if s}  # 空白 = CHAT_CHANNEL_IDS
+CHAT_POLL_INTERVAL = float(os.getenv("CHAT_POLL_INTERVAL", "30"))    # 每輪間隔（秒）
+CHAT_POLL_BATCH = int(os.getenv("CHAT_POLL_BATCH", "50"))            # 每次讀幾則
+CHAT_POLL_MAX_BATCHES = int(os.getenv("CHAT_POLL_MAX_BATCHES", "20"))  # 每輪每頻道最多讀幾批，落後更多就下一輪繼續
+CHAT_POLL_STATE_PATH = os.getenv("CHAT_POLL_STATE_PATH", "logs/chat_poll_state.json")  # 各頻道讀到哪則（重啟後接著讀）
+CHAT_POLL_BACKFILL = parse_bool(os.getenv("CHAT_POLL_BACKFILL"), default=False)  # 第一次輪詢是否處理最近一批（否則只記錄位置）
+CHAT_POLL_IGNORE_USERS = {s for s in os.getenv("CHAT_POLL_IGNORE_USERS", "").replace(" ", "").split(",") if s}  # 另外略過這些 creator_id
+CHAT_BOT_USER_IDS = {s for s in os.getenv("CHAT_BOT_USER_IDS", "").replace(" ", "").split(",") if s}  # 回貼用 Incoming Webhook 的 bot creator_id，輪詢時略過
+POST_DEDUPE_SIZE = int(os.getenv("POST_DEDUPE_SIZE", "5000"))        # 記住最近幾則處理過的 post_id（webhook / 輪詢去重）
+
+# Redmine
+REDMINE_URL = os.getenv("REDMINE_URL", "").rstrip("/")
+REDMINE_API_KEY = os.getenv("REDMINE_API_KEY", "").strip()
+REDMINE_PROJECT = os.getenv("REDMINE_PROJECT", "").strip()
+REDMINE_PROJECT_ID = os.getenv("REDMINE_PROJECT_ID", "").strip()
+REDMINE_TRACKER_ID = os.getenv("REDMINE_TRACKER_ID", "").strip()  # 數字 ID 或名稱（例：商機）
+REDMINE_STATUS_ID = os.getenv("REDMINE_STATUS_ID", "").strip()    # 數字 ID 或名稱（例：新建立）
+REDMINE_PRIORITY = os.getenv("REDMINE_PRIORITY", "").strip()      # 預設優先權，數字 ID 或名稱；不設定用 Redmine 預設
+REDMINE_METADATA_TTL = float(os.getenv("REDMINE_METADATA_TTL", "600"))  # tracker/status/優先權/自訂欄位 重新驗證間隔（秒）
+REDMINE_VERIFY = parse_bool(os.getenv("REDMINE_VERIFY"), default=False)
+# 依頻道改送到其他 Redmine / 專案（沒列到的頻道用上面的預設值）
+REDMINE_URLS = parse_map(os.getenv("REDMINE_URLS", ""))                # '94:https://erp.example.com,95:https://erp.example.com'
+REDMINE_API_KEYS = parse_map(os.getenv("REDMINE_API_KEYS", ""))        # '94:key2,95:key2'（不同 URL 必須另外給 key）
+REDMINE_PROJECT_IDS = parse_map(os.getenv("REDMINE_PROJECT_IDS", ""))  # '196:sales,94:erp-leads'
+REDMINE_TRACKER_IDS = parse_map(os.getenv("REDMINE_TRACKER_IDS", ""))  # '94:商機'（ID 或名稱）
+REDMINE_MAX_CONCURRENCY = int(os.getenv("REDMINE_MAX_CONCURRENCY", "4"))  # 每台 Redmine（URL + key）同時進行的請求上限
+REDMINE_SLOT_WAIT = float(os.getenv("REDMINE_SLOT_WAIT", "5"))          # 延後工作 / 背景 thread 等 Redmine 空位最久幾秒
+REDMINE_LOOKUP_TTL = float(os.getenv("REDMINE_LOOKUP_TTL", "300"))      # 專案清單 / 使用者查詢結果快取秒數
+
+# 附件轉送：Chat 訊息的檔案 URL 或 n8n 上傳的檔案，議題建好後分塊串流到 Redmine /uploads.json 再掛上（不整個讀進記憶體）
+ATTACHMENTS = parse_bool(os.getenv("ATTACHMENTS"), default=True)
+ATTACHMENT_URL_FIELDS = tuple(s for s in os.getenv("ATTACHMENT_URL_FIELDS", "file_url").replace(" ", "").split(",") if s)  # webhook 裡放檔案 URL 的欄位
+ATTACHMENT_URL_HOSTS = {s for s in os.getenv("ATTACHMENT_URL_HOSTS", "").replace(" ", "").split(",") if s}  # 允許下載的主機；空白 = CHAT_API_BASE / Incoming URL 的主機
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(10 * 1024 * 1024)))  # 單檔上限（Redmine 本身也有上限，預設 5MB）
+ATTACHMENT_MAX_FILES = int(os.getenv("ATTACHMENT_MAX_FILES", "5"))              # 每則訊息最多幾個附件
+ATTACHMENT_MAX_CONCURRENCY = int(os.getenv("ATTACHMENT_MAX_CONCURRENCY", "2"))  # 同時轉送幾個檔案（建單流程沿用已佔的 Redmine 空位）
+ATTACHMENT_TIMEOUT = float(os.getenv("ATTACHMENT_TIMEOUT", "60"))               # 單一附件下載 + 上傳的總時間上限（仍受請求期限限制）
+ATTACHMENT_MIN_BUDGET = float(os.getenv("ATTACHMENT_MIN_BUDGET", "10"))         # 議題建好後剩餘預算低於此秒數就不轉送附件
+ATTACHMENT_RESERVE = float(os.getenv("ATTACHMENT_RESERVE", "5"))                # 每次轉送保留給掛上議題（PUT）與回貼的秒數
+ATTACHMENT_MAX_REDIRECTS = int(os.getenv("ATTACHMENT_MAX_REDIRECTS", "3"))      # 下載附件最多跟幾次轉址（每一站都檢查主機）
+ATTACHMENT_CHUNK_SIZE = int(os.getenv("ATTACHMENT_CHUNK_SIZE", str(64 * 1024)))  # 每次讀 / 送的 bytes
+
+# JSON 編解碼：auto（有 orjson 就用）/ orjson / stdlib
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto").strip().lower()
+
+# 新任務關鍵字（固定）；新商機關鍵字 KEYWORD / KEYWORDS 可熱更新，見 RoutingTable
+TASK_KEYWORDS = ['新任務', '增加新任務', '增加新議題', '新議題']
+WEBHOOK_FAST_FIELDS = ("channel_id", "token", "text")
+
+
+# ----------------------------
+# 路由表（可熱更新）
+# ----------------------------
+class RoutingTable:
+    """
+    由設定預先編好的路由表：頻道 → token / Incoming URL / 限流，加上關鍵字 matcher。
+    建好後不再修改；熱更新時建一份新的，以單一參照賦值整個換掉 ROUTING。
+    請求開頭取一次 ROUTING 就一路用同一份，不會看到一半新、一半舊的設定。
+    """
+
+    KEYS = ("OUTGOING_TOKEN", "CHAT_TOKENS", "CHAT_CHANNEL_IDS", "CHAT_INCOMING_URLS", "CHAT_WEBHOOK_URL",
+            "KEYWORD", "KEYWORDS", "CHAT_RATE_LIMITS", "USER_RATE_LIMIT", "ROUTE_RATE_LIMITS")
+
+    def __init__(self, env: Dict[str, str], source: str = "env", version: int = 1):
+        self.raw = {k: (env.get(k) or "").strip() for k in self.KEYS}
+        self.source = source
+        self.version = version
+        self.loaded_at = datetime.now()
+        raw = self.raw
+        # Outgoing 驗證：多頻道 '196:tokA,94:tokB'；沒設定時回退到單一 OUTGOING_TOKEN（僅支援一個頻道）
+        self.outgoing_token = raw["OUTGOING_TOKEN"]
+        self.tokens = parse_map(raw["CHAT_TOKENS"])
+        self.channel_ids = {s for s in raw["CHAT_CHANNEL_IDS"].replace(" ", "").split(",") if s}
+        # Incoming 回貼：'196:urlA,94:urlB,95:urlC'，找不到對應時用 CHAT_WEBHOOK_URL
+        self.incoming_urls = parse_map(raw["CHAT_INCOMING_URLS"])
+        self.default_incoming_url = raw["CHAT_WEBHOOK_URL"]
+        # 新商機關鍵字（逗號分隔）；和新任務關鍵字合成 webhook 快速過濾用的 matcher
+        keywords = [k.strip() for k in raw["KEYWORDS"].split(",") if k.strip()]
+        self.keywords = keywords or [raw["KEYWORD"] or "新商機"]
+        self.trigger_matcher = build_keyword_matcher(self.keywords + TASK_KEYWORDS)
+        # 流量控制：'次數/秒數'，頻道與路由可用 '*' 當預設值；先解析好，請求時只查表
+        self.channel_limits = parse_map(raw["CHAT_RATE_LIMITS"])   # '196:20/60,94:10/60,*:10/60'
+        self.route_limits = parse_map(raw["ROUTE_RATE_LIMITS"])    # 'chat_webhook:60/60,n8n_webhook:30/60'
+        self.channel_rates = {k: parse_rate(v) for k, v in self.channel_limits.items()}
+        self.route_rates = {k: parse_rate(v) for k, v in self.route_limits.items()}
+        self.user_rate = parse_rate(raw["USER_RATE_LIMIT"])        # 每位使用者，例：'5/60'
+
+    def channel_rate(self, channel_id: str) -> Optional[Tuple[float, float]]:
+        return self.channel_rates.get(channel_id, self.channel_rates.get("*"))
+
+    def route_rate(self, route: str) -> Optional[Tuple[float, float]]:
+        return self.route_rates.get(route, self.route_rates.get("*"))
+
+    def incoming_url(self, channel_id: str) -> str:
+        return self.incoming_urls.get(str(channel_id), self.default_incoming_url)
+
+    def problems(self) -> List[str]:
+        """熱更新前的檢查：有問題就不換，繼續用舊表"""
+        issues = []
+        if not self.tokens and not self.outgoing_token:
+            issues.append("CHAT_TOKENS 與 OUTGOING_TOKEN 都是空的，所有 webhook 都會被拒絕")
+        bad = [f"{k}={v}" for k, v in self.channel_limits.items() if self.channel_rates[k] is None]
+        bad += [f"{k}={v}" for k, v in self.route_limits.items() if self.route_rates[k] is None]
+        if self.raw["USER_RATE_LIMIT"] and self.user_rate is None:
+            bad.append(f"user={self.raw['USER_RATE_LIMIT']}")
+        if bad:
+            issues.append(f"限流格式錯誤: {', '.join(bad)}")
+        return issues
+
+    def summary(self) -> Dict[str, object]:
+        """給 log 與 /debug/config 看的摘要（token / URL 只印末8碼）"""
+        return {
+            "version": self.version,
+            "source": self.source,
+            "loaded_at": self.loaded_at.isoformat(timespec="seconds"),
+            "channels": sorted(self.channel_ids) if self.channel_ids else "ALL",
+            "tokens": {k: _safe_tail(v) for k, v in self.tokens.items()} or ("single" if self.outgoing_token else None),
+            "incoming_urls": {k: _safe_tail(v) for k, v in self.incoming_urls.items()},
+            "default_incoming_url": _safe_tail(self.default_incoming_url),
+            "keywords": self.keywords,
+            "rate_limits": {"channel": self.channel_limits, "user": self.raw["USER_RATE_LIMIT"] or None, "route": self.route_limits},
+        }
+
+    def log_summary(self, label: str) -> None:
+        logger.info(f"{label}: channels={sorted(self.channel_ids) if self.channel_ids else 'ALL'}")
+        if self.tokens:
+            masked = {k: _safe_tail(v) for k, v in self.tokens.items()}
+            logger.info(f"Outgoing map(last8)={masked}")
+        if self.incoming_urls:
+            masked = {k: _safe_tail(v) for k, v in self.incoming_urls.items()}
+            logger.info(f"Incoming map(last8)={masked}")
+        if self.default_incoming_url:
+            logger.info(f"Default incoming URL(last8)={_safe_tail(self.default_incoming_url)}")
+        if self.channel_limits or self.raw["USER_RATE_LIMIT"] or self.route_limits:
+            logger.info(f"Rate limits: channel={self.channel_limits} user={self.raw['USER_RATE_LIMIT'] or '-'} route={self.route_limits}")
+
+
+def read_env_file(path: str) -> Dict[str, str]:
+    """
+    讀 .env 格式，與 run.sh 的 source 結果一致：
+      - KEY=VALUE，可有 export 前綴、CRLF
+      - 引號內的值原樣保留（可含 #）；引號外空白之後的 # 起算是註解：'KEY=val # 說明' -> 'val'
+    """
+    values: Dict[str, str] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("export "):
+                line = line[len("export "):].lstrip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, _, value = line.partition("=")
+            value = value.strip()
+            if value[:1] in ("\"", "'") and value.find(value[0], 1) > 0:
+                value = value[1:value.find(value[0], 1)]
+            else:
+                value = re.split(r"\s#", value, maxsplit=1)[0].rstrip()
+            values[key.strip()] = value
+    return values
+
+
+def _read_config_file() -> Dict[str, str]:
+    if CONFIG_FILE and os.path.exists(CONFIG_FILE):
+        return read_env_file(CONFIG_FILE)
+    return {}
+
+
+# 啟動時的環境變數。run.sh（set -a; . .env）與 docker compose 的 env_file 會把設定檔原樣帶進環境變數，
+# 這些值要跟著設定檔熱更新；和設定檔不同（或設定檔沒有）的值才是部署時刻意的覆寫，永遠優先。
+_BASE_ENV = dict(os.environ)
+try:
+    _STARTUP_FILE_ENV = _read_config_file()
+except (OSError, UnicodeDecodeError):
+    _STARTUP_FILE_ENV = {}
+_ENV_OVERRIDES = {k: v for k, v in _BASE_ENV.items() if _STARTUP_FILE_ENV.get(k) != v}
+
+
+def routing_env() -> Dict[str, str]:
+    """
+    設定檔先套上，再以環境變數的覆寫值蓋過（容器 / compose 的 environment 優先於 .env）。
+    啟動時從設定檔帶進環境變數的值不當底：設定檔刪掉的鍵，重新載入後就不再生效。
+    """
+    env = {k: v for k, v in _BASE_ENV.items() if k not in _STARTUP_FILE_ENV}
+    env.update(_read_config_file())
+    env.update(_ENV_OVERRIDES)
+    return env
+
+
+ROUTING = RoutingTable(routing_env(), source=f"startup:{CONFIG_FILE or 'env'}")
+_routing: ContextVar[Optional[RoutingTable]] = ContextVar("routing", default=None)
+
+
+def pin_routing() -> RoutingTable:
+    """請求開頭呼叫：取目前的 ROUTING 固定給這個請求（threadpool 與延後工作都沿用），中途熱更新也不受影響"""
+    routing = ROUTING
+    _routing.set(routing)
+    return routing
+
+
+def current_routing() -> RoutingTable:
+    """目前請求固定的路由表；請求以外（背景工作、除錯端點）用最新的 ROUTING"""
+    return _routing.get() or ROUTING
+
+
+# ----------------------------
+# Logging
+# ----------------------------
+# 目前請求的 Trace（見「追蹤」區段），log 會帶上它的 request id
+_trace: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+
+
+class _RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        t = _trace.get()
+        record.request_id = t.request_id if t else "-"
+        return True
+
+
+logger = logging.getLogger("chat-newbiz")
+logger.setLevel(logging.INFO)
+if not logger.handlers:
+    _h = logging.StreamHandler()
+    _fmt = logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(message)s")
+    _h.setFormatter(_fmt)
+    _h.addFilter(_RequestIdFilter())
+    logger.addHandler(_h)
+
+# 啟動時印出對照摘要（避免洩漏，只印末8碼）
+def _safe_tail(s: str, n: int = 8) -> str:
+    return s[-n:] if s else ""
+
+ROUTING.log_summary("Startup")
+if SHADOW_CHANNEL_IDS or SHADOW_ROUTES or SHADOW_MIRROR_RATE:
+    logger.info(f"Shadow: channels={sorted(SHADOW_CHANNEL_IDS)} routes={sorted(SHADOW_ROUTES)} mirror_rate={SHADOW_MIRROR_RATE} mirror_url={SHADOW_MIRROR_URL or '-'}")
+if SHADOW_MIRROR_RATE > 0 and not SHADOW_MIRROR_URL:
+    logger.error("❌ SHADOW_MIRROR_RATE 需要 SHADOW_MIRROR_URL（候選版本的位址），鏡像未啟用")
+if CHAT_POLL:
+    logger.info(f"Chat poll: base={CHAT_API_BASE or '-'} channels={sorted(CHAT_POLL_CHANNELS) or 'CHAT_CHANNEL_IDS'} interval={CHAT_POLL_INTERVAL}s batch={CHAT_POLL_BATCH}")
+    if not CHAT_BOT_USER_IDS:
+        logger.warning("⚠️ 未設定 CHAT_BOT_USER_IDS：輪詢只能靠 is_bot 標記與最近回貼的內容辨識自己的訊息")
+if TRAFFIC_RECORD_PATH:
+    logger.info(f"Traffic recorder: path={TRAFFIC_RECORD_PATH} routes={sorted(TRAFFIC_RECORD_ROUTES)}")
+logger.info(f"Pipeline gate (per Redmine): inflight={PIPELINE_MAX_INFLIGHT} queue={PIPELINE_MAX_QUEUE}")
+logger.info(f"Deadlines: default={REQUEST_DEADLINE}s route={ROUTE_DEADLINES} deferred={DEFERRED_DEADLINE}s")
+
+# ----------------------------
+# JSON（可切換 orjson / 標準庫）
+# ----------------------------
+if JSON_BACKEND in ("auto", "orjson") and orjson is not None:
+    _ORJSON_OPTS = orjson.OPT_NON_STR_KEYS
+
+    def json_dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=_ORJSON_OPTS)
+
+    json_loads = orjson.loads
+    JSON_BACKEND_NAME = "orjson"
+else:
+    if JSON_BACKEND == "orjson":
+        logger.warning("JSON_BACKEND=orjson 但未安裝 orjson，改用標準庫 json")
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    json_loads = json.loads
+    JSON_BACKEND_NAME = "stdlib"
+
+
+def json_dumps_str(obj) -> str:
+    return json_dumps(obj).decode("utf-8")
+
+
+def parse_listing(content: bytes, key: str, fields: Tuple[str, ...]) -> List[Dict[str, object]]:
+    """
+    解析 Redmine 列表回應（/projects.json、/users.json），每筆只留下會用到的欄位，
+    其餘（description、custom_fields…）解析完立即丟棄，不隨結果留在記憶體。
+    """
+    items = json_loads(content).get(key) or []
+    return [{f: item[f] for f in fields if f in item} for item in items]
+
+
+class FastJSONResponse(JSONResponse):
+    """用 json_dumps 編碼的 JSONResponse（輸出與標準 JSONResponse 相同：UTF-8、不跳脫中文）"""
+
+    def render(self, content) -> bytes:
+        return json_dumps(content)
+
+
+logger.info(f"JSON backend: {JSON_BACKEND_NAME}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    啟動 / 關閉時的所有工作集中在這裡，依序執行（各函式定義在對應區段）。
+    關閉時先停掉 loop watchdog 與背景 task，再寫出輪詢進度、統計與流量紀錄。
+    """
+    await start_loop_monitor()
+    await start_config_reloader()
+    await load_pipeline_stats()
+    await start_metadata_refresher()
+    await start_chat_poller()
+    try:
+        yield
+    finally:
+        LOOP_MONITOR_STATE.stop()  # 先停 watchdog：probe 取消後心跳不再更新，否則會誤報卡住
+        for task in list(_background_tasks):
+            task.cancel()
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+        await save_chat_poller_state()
+        await flush_pipeline_stats()
+        await flush_traffic_recorder()
+
+
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
+
+
+# ----------------------------
+# 驗證 Outgoing token
+# ----------------------------
+def verify_outgoing_token(channel_id: str, token: str, routing: Optional[RoutingTable] = None) -> bool:
+    routing = routing or current_routing()
+    channel_id = (channel_id or "").strip()
+    token = (token or "").strip()
+    if not channel_id or not token:
+        return False
+
+    # 若設定了 per-channel 對照，優先使用
+    if routing.tokens:
+        expect = routing.tokens.get(channel_id)
+        if not expect:
+            return False
+        return token == expect
+
+    # 否則回退到單一 OUTGOING_TOKEN
+    return token == routing.outgoing_token
+
+
+# ----------------------------
+# 請求期限（Deadline budget）
+# ----------------------------
+MIN_CALL_TIMEOUT = 0.5  # 剩不到這麼多秒就不再發下游請求
+
+
+class DeadlineExceeded(Exception):
+    """剩餘預算不足以再發一次下游呼叫"""
+
+
+class Deadline:
+    """
+    單一請求的時間預算。下游呼叫用 call_timeout() 取「剩餘預算」與原本上限的較小值當 timeout，
+    預算不足而沒做完的階段記在 incomplete，最後放進回應。
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.incomplete: List[str] = []
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def mark_incomplete(self, stage: str) -> None:
+        if stage not in self.incomplete:
+            self.incomplete.append(stage)
+
+
+_deadline: ContextVar[Optional[Deadline]] = ContextVar("deadline", default=None)
+
+
+def route_deadline(route: str) -> float:
+    try:
+        return float(ROUTE_DEADLINES.get(route, REQUEST_DEADLINE))
+    except ValueError:
+        return REQUEST_DEADLINE
+
+
+def start_deadline(seconds: float) -> Deadline:
+    """為目前的請求（context）設定新的期限；threadpool 內的呼叫會繼承同一個 Deadline"""
+    d = Deadline(seconds)
+    _deadline.set(d)
+    return d
+
+
+def call_timeout(cap: float, stage: str) -> float:
+    """
+    回傳這次下游呼叫可用的 timeout（不超過 cap）。
+    預算用完時把 stage 記為未完成並丟 DeadlineExceeded；沒有期限時直接回傳 cap。
+    """
+    d = _deadline.get()
+    if d is None:
+        return cap
+    t = min(cap, d.remaining())
+    if t < MIN_CALL_TIMEOUT:
+        d.mark_incomplete(stage)
+        raise DeadlineExceeded(f"deadline exceeded before {stage}")
+    return t
+
+
+def read_body(resp: requests.Response, stage: str) -> requests.Response:
+    """
+    requests 的 timeout 只限制單次 socket 操作（連線、兩次讀取之間的間隔），不是整個呼叫；
+    回應一點一點慢慢送時，總時間仍可能超過預算。請求用 stream=True 送出後交給這裡：
+    分塊讀完 body，每塊之間檢查期限，超過就中斷連線並丟 DeadlineExceeded。
+    （送出 request body 與等待回應 header 的階段仍只受單次 timeout 限制。）
+    """
+    d = _deadline.get()
+    chunks: List[bytes] = []
+    try:
+        for chunk in resp.iter_content(65536):
+            chunks.append(chunk)
+            if d is not None and d.remaining() <= 0:
+                d.mark_incomplete(stage)
+                raise DeadlineExceeded(f"deadline exceeded while reading {stage}")
+    except BaseException:
+        resp.close()
+        raise
+    resp._content = b"".join(chunks)
+    resp._content_consumed = True
+    return resp
+
+
+def has_budget(seconds: float) -> bool:
+    d = _deadline.get()
+    return d is None or d.remaining() >= seconds
+
+
+def incomplete_stages() -> List[str]:
+    d = _deadline.get()
+    return list(d.incomplete) if d else []
+
+
+def run_within_deadline(func, *args) -> FastJSONResponse:
+    """執行建單流程；預算在中途用完時停止（不再發下游請求），回 504 並列出未完成的階段"""
+    try:
+        return func(*args)
+    except DeadlineExceeded as e:
+        logger.warning(f"⏱️ 建單流程超過期限，已停止: {e}")
+        return FastJSONResponse({
+            "ok": False,
+            "error": "處理逾時，未完成的階段見 incomplete",
+            "incomplete": incomplete_stages(),
+        }, status_code=504)
+
+
+def run_deferred(func, *args, **kwargs):
+    """回應送出後才執行的工作（BackgroundTask），使用獨立的 DEFERRED_DEADLINE 預算"""
+    start_deadline(DEFERRED_DEADLINE)
+    try:
+        return func(*args, **kwargs)
+    except DeadlineExceeded as e:
+        logger.warning(f"⏱️ 延後工作 {getattr(func, '__name__', func)} 超過 DEFERRED_DEADLINE，未完成: {e}")
+    except Exception as e:
+        logger.error(f"❌ 延後工作 {getattr(func, '__name__', func)} 發生異常: {e}")
+
+
+# ----------------------------
+# 追蹤（Tracing）
+# ----------------------------
+TRACED_PATHS = {"/chat_webhook", "/n8n_webhook", "/test_webhook"}
+_span_depth: ContextVar[int] = ContextVar("span_depth", default=0)
+_thread_trace: Dict[int, "Trace"] = {}  # threadpool thread id -> 該 thread 目前在處理的 Trace（給取樣 profiler 用）
+_task_trace: Dict["asyncio.Task", "Trace"] = {}  # event loop 上的 task -> 它在處理的 Trace（loop 被卡住時給 watchdog 歸因）
+
+
+@contextmanager
+def loop_trace(trace: "Trace"):
+    """
+    把目前的 asyncio task 登記為在處理 trace。event loop 上同時只有一個 task 在跑，
+    watchdog 用 asyncio.current_task(loop) 就知道是哪個請求把 loop 卡住。
+    """
+    task = asyncio.current_task()
+    _task_trace[task] = trace
+    try:
+        yield
+    finally:
+        _task_trace.pop(task, None)
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+class Trace:
+    """單一請求的 span 紀錄；span 可能來自 event loop 或 threadpool，append 時加鎖"""
+
+    def __init__(self, request_id: str, route: str):
+        self.request_id = request_id
+        self.route = route
+        self.started_at = datetime.now()
+        self.t0 = time.monotonic()
+        self.status = 0
+        self.response_ms: Optional[float] = None
+        self.spans: List[Dict[str, object]] = []
+        self.samples: Optional[Counter] = Counter() if TRACE_PROFILE else None
+        self.profile_path: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic() - self.t0) * 1000
+
+    def add_span(self, span: Dict[str, object]) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self) -> Dict[str, object]:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda sp: sp["start_ms"])
+        return {
+            "request_id": self.request_id,
+            "route": self.route,
+            "started_at": self.started_at.isoformat(timespec="milliseconds"),
+            "status": self.status,
+            "response_ms": self.response_ms,
+            "slow": (self.response_ms or 0) >= TRACE_SLOW_MS,
+            "spans": spans,
+            "profile": self.profile_path,
+        }
+
+
+TRACES: "deque[Dict[str, object]]" = deque(maxlen=TRACE_BUFFER_SIZE)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    記錄一段耗時到目前請求的 Trace；沒有 Trace 時幾乎零成本。
+    yield 出來的 dict 可以在區塊內補上屬性（例：狀態碼）。
+    """
+    trace = _trace.get()
+    if trace is None:
+        yield attrs
+        return
+    depth = _span_depth.get()
+    depth_token = _span_depth.set(depth + 1)
+    # 取樣 profiler 只能依 thread 對應 Trace：threadpool 的 thread 一次只跑一個請求，可以對應；
+    # event loop thread 上多個請求的 coroutine 交錯執行，無法歸給單一 Trace，改由 loop_trace 依 task 登記
+    ident = None if _on_event_loop() else threading.get_ident()
+    prev = _thread_trace.get(ident) if ident is not None else None
+    if ident is not None:
+        _thread_trace[ident] = trace
+    start = time.monotonic()
+    error = None
+    try:
+        yield attrs
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        end = time.monotonic()
+        if ident is not None:
+            if prev is None:
+                _thread_trace.pop(ident, None)
+            else:
+                _thread_trace[ident] = prev
+        _span_depth.reset(depth_token)
+        record: Dict[str, object] = {
+            "name": name,
+            "depth": depth,
+            "start_ms": round((start - trace.t0) * 1000, 2),
+            "duration_ms": round((end - start) * 1000, 2),
+        }
+        if attrs:
+            record["attrs"] = attrs
+        if error:
+            record["error"] = error
+        trace.add_span(record)
+
+
+def traced(func):
+    """把整個函式包成一個同名 span"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class _StackSampler:
+    """
+    取樣 profiler：背景 thread 定期抓各 thread 的 stack，
+    只記錄正在替某個 Trace 工作的 thread，累積成 collapsed stack（flamegraph 格式）。
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-sampler", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            if not _thread_trace:
+                continue
+            for ident, frame in sys._current_frames().items():
+                trace = _thread_trace.get(ident)
+                if ident == me or trace is None or trace.samples is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                with trace._lock:
+                    trace.samples[";".join(reversed(stack))] += 1
+
+
+_SAMPLER = _StackSampler(TRACE_PROFILE_INTERVAL)
+
+
+def _write_profile(trace: Trace) -> Optional[str]:
+    """把慢請求的取樣結果寫成 .folded 檔（flamegraph.pl / speedscope 可直接讀）"""
+    with trace._lock:
+        samples = trace.samples.most_common() if trace.samples else []
+    if not samples:
+        return None
+    try:
+        os.makedirs(TRACE_PROFILE_DIR, exist_ok=True)
+        path = os.path.join(TRACE_PROFILE_DIR, f"{trace.started_at:%Y%m%d-%H%M%S}_{trace.route}_{trace.request_id}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in samples:
+                f.write(f"{stack} {count}\n")
+        return path
+    except OSError as e:
+        logger.error(f"❌ 寫入 profile 失敗: {e}")
+        return None
+
+
+def finish_trace(trace: Trace) -> None:
+    """請求結束：慢請求寫 profile；有 span（真的做了事）或慢的請求才放進 ring buffer"""
+    did_work = bool(trace.spans)
+    trace.add_span({"name": trace.route, "depth": 0, "start_ms": 0.0, "duration_ms": round(trace.elapsed_ms(), 2)})
+    slow = (trace.response_ms or trace.elapsed_ms()) >= TRACE_SLOW_MS
+    if slow:
+        logger.warning(f"🐢 慢請求: {trace.route} {trace.response_ms}ms status={trace.status}")
+        if TRACE_PROFILE:
+            trace.profile_path = _write_profile(trace)
+    if did_work or slow:
+        TRACES.append(trace.to_dict())
+
+
+class TraceMiddleware:
+    """
+    ASGI middleware：webhook 路由進來時建立 Trace（沿用 X-Request-ID 或自動產生），
+    並在回應 header 帶回 X-Request-ID。背景工作（延後的子議題 / 回貼）也記在同一個 Trace。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in TRACED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        request_id = ""
+        for k, v in scope.get("headers", []):
+            if k == b"x-request-id":
+                request_id = v.decode("latin-1")[:64]
+                break
+        trace = Trace(request_id or uuid.uuid4().hex[:12], scope["path"].lstrip("/"))
+        if TRACE_PROFILE:
+            _SAMPLER.ensure_started()
+        token = _trace.set(trace)
+        depth_token = _span_depth.set(1)  # 路由本身是 depth 0，結束時由 finish_trace 補上
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", trace.request_id.encode("latin-1"))]
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                trace.response_ms = round(trace.elapsed_ms(), 2)
+            await send(message)
+
+        try:
+            with loop_trace(trace):
+                await self.app(scope, receive, send_with_trace)
+        except Exception:
+            trace.status = trace.status or 500
+            raise
+        finally:
+            if trace.response_ms is None:
+                trace.response_ms = round(trace.elapsed_ms(), 2)
+            finish_trace(trace)
+            _span_depth.reset(depth_token)
+            _trace.reset(token)
+
+
+app.add_middleware(TraceMiddleware)
+
+
+def require_debug_token(request: Request) -> None:
+    """/debug/* 與 /stats 需帶正確的 X-Debug-Token；沒設定 DEBUG_TOKEN 時這些端點一律關閉"""
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="Debug endpoints disabled (set DEBUG_TOKEN)")
+    if not hmac.compare_digest(request.headers.get("x-debug-token", "").encode(), DEBUG_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid debug token")
+
+
+# ----------------------------
+# 流量錄製
+# ----------------------------
+SENSITIVE_FIELDS = {"token"}
+
+
+def mask_secret(s: str) -> str:
+    """遮蔽方式同啟動摘要：只留末 8 碼；太短的值留末 8 碼等於沒遮，整個遮掉（重播時再依頻道換回真的 token）"""
+    if not s:
+        return s
+    return f"***{_safe_tail(s)}" if len(s) > 16 else "***"
+
+
+def sanitize_body(body: bytes, content_type: str) -> Optional[str]:
+    """遮蔽 body 裡的 token；form / JSON 以外的格式不記內容（回傳 None）"""
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        pairs = parse_qsl(body.decode("utf-8", "replace"), keep_blank_values=True)
+        return urlencode([(k, mask_secret(v) if k in SENSITIVE_FIELDS else v) for k, v in pairs])
+    if content_type.startswith("application/json"):
+        try:
+            data = json_loads(body)
+        except ValueError:
+            return None
+        if isinstance(data, dict):
+            data = {k: mask_secret(v) if k in SENSITIVE_FIELDS and isinstance(v, str) else v for k, v in data.items()}
+        return json_dumps_str(data)
+    return None
+
+
+class NdjsonAppender:
+    """
+    背景 thread 把 dict append 成 NDJSON（每行一筆）；流量錄製與建單事件紀錄共用。
+    event loop 只負責丟進 queue；queue 滿了就丟棄並計數，不拖慢請求。
+    子類別可覆寫 written()，在每批寫入後拿到該批內容與寫完後的檔案 offset。
+    """
+
+    def __init__(self, path: str, name: str, max_queue: int = 10000):
+        self.path = path
+        self.name = name
+        self.recorded = 0
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[Dict[str, object]]]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def record(self, entry: Dict[str, object]) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def written(self, entries: List[Dict[str, object]], offset: int) -> None:
+        pass
+
+    def _run(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as e:
+                logger.error(f"❌ 建立目錄 {directory} 失敗: {e}")
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            entries = [e for e in batch if e is not None]
+            lines = [json_dumps(e) + b"\n" for e in entries]
+            try:
+                with open(self.path, "ab") as f:
+                    f.write(b"".join(lines))
+                    offset = f.tell()
+                self.recorded += len(lines)
+            except OSError as e:
+                self.dropped += len(lines)
+                logger.error(f"❌ 寫入 {self.path} 失敗: {e}")
+            else:
+                if entries:
+                    self.written(entries, offset)
+            if stop:
+                return
+
+    def close(self, timeout: float = 5.0) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+
+TRAFFIC_RECORDER = NdjsonAppender(TRAFFIC_RECORD_PATH, "traffic-recorder") if TRAFFIC_RECORD_PATH else None
+
+
+class TrafficRecordMiddleware:
+    """ASGI middleware：邊轉交 body 邊保留一份，回應送完後把整筆請求交給 TRAFFIC_RECORDER"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in TRAFFIC_RECORD_ROUTES:
+            await self.app(scope, receive, send)
+            return
+        started = time.time()
+        t0 = time.monotonic()
+        chunks: List[bytes] = []
+        size = 0
+        meta: Dict[str, object] = {"status": 0, "request_id": None}
+
+        async def receive_and_keep():
+            nonlocal size
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b"")
+                size += len(body)
+                if size <= TRAFFIC_RECORD_MAX_BODY:
+                    chunks.append(body)
+            return message
+
+        async def send_and_watch(message):
+            if message["type"] == "http.response.start":
+                meta["status"] = message["status"]
+                for k, v in message.get("headers", []):
+                    if k == b"x-request-id":
+                        meta["request_id"] = v.decode("latin-1")
+            await send(message)
+
+        try:
+            await self.app(scope, receive_and_keep, send_and_watch)
+        finally:
+            headers = dict(scope.get("headers", []))
+            content_type = headers.get(b"content-type", b"").decode("latin-1")
+            entry: Dict[str, object] = {
+                "ts": round(started, 6),
+                "path": scope["path"],
+                "content_type": content_type,
+                "body": sanitize_body(b"".join(chunks), content_type) if size <= TRAFFIC_RECORD_MAX_BODY else None,
+                "body_bytes": size,
+                "status": meta["status"] or 500,
+                "response_ms": round((time.monotonic() - t0) * 1000, 2),
+                "request_id": meta["request_id"],
+            }
+            TRAFFIC_RECORDER.record(entry)
+
+
+if TRAFFIC_RECORDER is not None:
+    app.add_middleware(TrafficRecordMiddleware)  # 加在 TraceMiddleware 外層，才拿得到 X-Request-ID
+
+
+async def flush_traffic_recorder():
+    if TRAFFIC_RECORDER is not None:
+        await run_in_threadpool(TRAFFIC_RECORDER.close)
+
+
+# ----------------------------
+# Event loop 監控（lag / 阻塞偵測）
+# ----------------------------
+class LagHistogram:
+    """固定 bucket 的延遲直方圖（毫秒），給 /debug/loop 用"""
+
+    BOUNDS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float) -> None:
+        i = 0
+        while i < len(self.BOUNDS) and ms > self.BOUNDS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """回傳 bucket 上界的近似百分位數"""
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(float(self.BOUNDS[i]), self.max_ms) if i < len(self.BOUNDS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self) -> Dict[str, object]:
+        labels = [f"<={b}" for b in self.BOUNDS] + [f">{self.BOUNDS[-1]}"]
+        return {
+            "count": self.total,
+            "avg_ms": round(self.sum_ms / self.total, 2) if self.total else None,
+            "p50_ms": self.percentile(0.5),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max_ms, 2),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class LoopMonitor:
+    """
+    兩個部分：
+      - event loop 上的 probe：每 interval 睡一次，實際醒來的延遲就是排程延遲（lag），記進直方圖
+      - 背景 watchdog thread：probe 的心跳停太久表示 loop 正被同步程式卡住，
+        此時直接抓 loop thread 的 stack（例如卡在 create_redmine_issue 裡的 requests.post）
+    """
+
+    def __init__(self, interval: float, threshold_ms: float):
+        self.interval = interval
+        self.threshold_ms = threshold_ms
+        self.histogram = LagHistogram()
+        self.stalls: "deque[Dict[str, object]]" = deque(maxlen=50)
+        self._heartbeat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop = threading.Event()  # 關閉時通知 watchdog 結束（probe 停了心跳就不再更新，不能再判斷卡住）
+        self._watchdog_thread: Optional[threading.Thread] = None
+        self._stall_reported = False
+        self._stall_lock = threading.Lock()  # probe（loop thread）與 watchdog thread 都會讀寫 _stall_reported
+
+    async def probe(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._loop = asyncio.get_running_loop()
+        self._stop.clear()
+        self._heartbeat = time.monotonic()
+        self._watchdog_thread = threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True)
+        self._watchdog_thread.start()
+        while True:
+            start = time.monotonic()
+            self._heartbeat = start
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, (time.monotonic() - start - self.interval) * 1000)
+            self.histogram.observe(lag_ms)
+            with self._stall_lock:
+                recovered, self._stall_reported = self._stall_reported, False
+            if recovered:
+                if self.stalls:
+                    self.stalls[-1]["lag_ms"] = round(lag_ms, 1)
+                logger.warning(f"🐌 Event loop 恢復，總延遲 {lag_ms:.0f}ms")
+
+    def stop(self) -> None:
+        """停掉 watchdog thread；lifespan 關閉時在取消 probe 之前呼叫"""
+        self._stop.set()
+        if self._watchdog_thread is not None:
+            self._watchdog_thread.join(timeout=max(1.0, self.interval))
+            self._watchdog_thread = None
+
+    def _watchdog(self) -> None:
+        while not self._stop.wait(self.interval / 2):
+            blocked_ms = (time.monotonic() - self._heartbeat - self.interval) * 1000
+            if blocked_ms < self.threshold_ms:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            with self._stall_lock:
+                if self._stall_reported:
+                    continue
+                self._stall_reported = True
+            stack = "".join(traceback.format_stack(frame)[-12:])
+            task = asyncio.current_task(self._loop)  # 卡住 loop 的正是目前在跑的 task
+            trace = _task_trace.get(task) if task is not None else None
+            self.stalls.append({
+                "at": datetime.now().isoformat(timespec="milliseconds"),
+                "blocked_ms": round(blocked_ms, 1),
+                "lag_ms": None,
+                "request_id": trace.request_id if trace else None,
+                "route": trace.route if trace else None,
+                "stack": stack,
+            })
+            logger.warning(f"🐌 Event loop 被阻塞 {blocked_ms:.0f}ms（request={trace.request_id if trace else '-'}），目前 stack:\n{stack}")
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "interval_s": self.interval,
+            "threshold_ms": self.threshold_ms,
+            "lag": self.histogram.to_dict(),
+            "stalls": list(self.stalls),
+        }
+
+
+LOOP_MONITOR_STATE = LoopMonitor(LOOP_MONITOR_INTERVAL, LOOP_LAG_THRESHOLD_MS)
+_background_tasks: List["asyncio.Task"] = []  # 保留背景 task 的參照，避免被 GC
+
+
+async def start_loop_monitor():
+    if LOOP_MONITOR:
+        _background_tasks.append(asyncio.create_task(LOOP_MONITOR_STATE.probe()))
+        logger.info(f"Loop monitor: interval={LOOP_MONITOR_INTERVAL}s threshold={LOOP_LAG_THRESHOLD_MS}ms")
+
+
+# ----------------------------
+# 設定熱更新
+# ----------------------------
+_routing_lock = threading.Lock()
+
+
+def reload_routing(trigger: str) -> Dict[str, object]:
+    """
+    重新讀取 CONFIG_FILE（環境變數的覆寫值仍然優先），編出新的 RoutingTable 後整個換掉 ROUTING。
+    新表有問題（讀檔失敗、token 全空、限流格式錯）就保留舊表。
+    只換路由表：Redmine 快取、中繼資料、限流 bucket、連線都不受影響。
+    """
+    global ROUTING
+    with _routing_lock:
+        current = ROUTING
+        try:
+            env = routing_env()
+        except (OSError, UnicodeDecodeError) as e:
+            logger.error(f"❌ 設定重新載入失敗（{trigger}）: {e}")
+            return {"ok": False, "error": f"讀取 {CONFIG_FILE} 失敗: {e}", "version": current.version}
+        candidate = RoutingTable(env, source=f"{trigger}:{CONFIG_FILE or 'env'}", version=current.version + 1)
+        problems = candidate.problems()
+        if problems:
+            logger.error(f"❌ 設定重新載入失敗（{trigger}），沿用 v{current.version}: {'；'.join(problems)}")
+            return {"ok": False, "error": "；".join(problems), "version": current.version}
+        changed = [k for k in RoutingTable.KEYS if candidate.raw[k] != current.raw[k]]
+        if not changed:
+            return {"ok": True, "changed": [], "version": current.version}
+        ROUTING = candidate
+    logger.info(f"🔄 設定已重新載入（{trigger}）: v{current.version} -> v{candidate.version} changed={changed}")
+    candidate.log_summary("Reload")
+    return {"ok": True, "changed": changed, "version": candidate.version}
+
+
+def _config_stamp() -> Optional[Tuple[float, int]]:
+    try:
+        st = os.stat(CONFIG_FILE)
+        return st.st_mtime, st.st_size
+    except OSError:
+        return None
+
+
+async def watch_config_file() -> None:
+    """
+    定期檢查 CONFIG_FILE 的修改時間 / 大小，有變更就重新載入。
+    編輯器存檔常是先清空再寫入，要連續兩次檢查都沒再變才讀，避免讀到寫一半的檔案。
+    """
+    loaded = _config_stamp()
+    seen = loaded
+    while True:
+        await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+        stamp = _config_stamp()
+        if stamp is not None and stamp != loaded and stamp == seen:
+            loaded = stamp
+            await run_in_threadpool(reload_routing, "watch")
+        seen = stamp
+
+
+async def start_config_reloader():
+    if CONFIG_FILE and CONFIG_WATCH_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(watch_config_file()))
+        logger.info(f"Config watch: file={CONFIG_FILE} interval={CONFIG_WATCH_INTERVAL}s")
+    # kill -HUP <pid> 也會重新載入（uvicorn 只接管 SIGINT / SIGTERM）
+    def on_sighup():
+        task = asyncio.create_task(run_in_threadpool(reload_routing, "sighup"))
+        _background_tasks.append(task)
+        task.add_done_callback(_background_tasks.remove)
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, on_sighup)
+    except (AttributeError, NotImplementedError, RuntimeError):
+        pass
+
+
+# ----------------------------
+# 流量控制（Admission control）
+# ----------------------------
+class AdmissionRejected(Exception):
+    """請求被限流或排隊已滿；scope 說明是哪一層擋下（例：'channel:196'、'pipeline'）"""
+
+    def __init__(self, scope: str, reason: str, retry_after: float = 0):
+        super().__init__(f"{scope}: {reason}")
+        self.scope = scope
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """容量 capacity、每秒補 rate 個 token 的 token bucket"""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        # now 可能比 bucket 建立時間早一點（admit 先取時間再建 bucket），不能倒扣
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = max(self.updated, now)
+
+    def wait_time(self, now: float) -> float:
+        """還要等幾秒才有 1 個 token（0 表示現在就有）"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """
+    依 (種類, key) 維護 token bucket，一次檢查多層限制（路由 → 頻道 → 使用者），
+    全部通過才扣 token，避免被某一層擋下時前面幾層白白被扣。
+    """
+
+    def __init__(self, max_keys: int = 10000):
+        self._buckets: "OrderedDict[Tuple[str, str], TokenBucket]" = OrderedDict()
+        self._max_keys = max_keys
+        self._lock = threading.Lock()
+
+    def _bucket(self, kind: str, key: str, rate: Tuple[float, float]) -> TokenBucket:
+        bucket = self._buckets.get((kind, key))
+        if bucket is None or (bucket.capacity, bucket.rate) != rate:
+            bucket = TokenBucket(*rate)
+            self._buckets[(kind, key)] = bucket
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end((kind, key))
+        return bucket
+
+    def admit(self, checks: List[Tuple[str, str, Optional[Tuple[float, float]]]]) -> None:
+        """checks: [(種類, key, rate)]；rate 為 None 的層級不限制。被擋時丟 AdmissionRejected"""
+        now = time.monotonic()
+        with self._lock:
+            buckets = [(kind, key, self._bucket(kind, key, rate)) for kind, key, rate in checks if rate]
+            for kind, key, bucket in buckets:
+                wait = bucket.wait_time(now)
+                if wait > 0:
+                    raise AdmissionRejected(f"{kind}:{key}", "rate limited", retry_after=wait)
+            for _, _, bucket in buckets:
+                bucket.take()
+
+
+class PipelineGate:
+    """
+    限制同時執行中的建單流程數量；滿了就排隊，排隊也滿了（或等太久）就拒絕。
+    每台 Redmine 各一個（RedmineTarget.gate），某台變慢只會佔滿自己的名額。
+    只在 event loop 上使用，計數不需要另外加鎖。
+    """
+
+    def __init__(self, max_inflight: int, max_queue: int, queue_timeout: float, scope: str = "pipeline"):
+        self.scope = scope
+        self.max_inflight = max(1, max_inflight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self.waiting = 0
+        self._sem = asyncio.Semaphore(self.max_inflight)
+
+    @asynccontextmanager
+    async def slot(self, wait: bool = True):
+        """wait=False：沒有空位就直接拒絕、不排隊（給 shadow 鏡像這類可以放棄的工作）"""
+        if not self._sem.locked():
+            # 還有空位：acquire 會立即成功，不會讓出 event loop
+            await self._sem.acquire()
+        else:
+            if not wait:
+                raise AdmissionRejected(self.scope, "busy")
+            if self.waiting >= self.max_queue:
+                raise AdmissionRejected(self.scope, "queue full", retry_after=self.queue_timeout)
+            self.waiting += 1
+            try:
+                d = _deadline.get()
+                timeout = self.queue_timeout if d is None else max(0.0, min(self.queue_timeout, d.remaining()))
+                await asyncio.wait_for(self._sem.acquire(), timeout=timeout)
+            except asyncio.TimeoutError:
+                raise AdmissionRejected(self.scope, "queue timeout", retry_after=self.queue_timeout)
+            finally:
+                self.waiting -= 1
+        self.inflight += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            self._sem.release()
+
+
+RATE_LIMITER = RateLimiter()
+_rate_notice_at: Dict[str, float] = {}
+
+
+def admit_request(route: str, channel_id: str, user_id: str) -> None:
+    """
+    依路由、頻道、使用者三層 token bucket 檢查，被擋時丟 AdmissionRejected。
+    限流值來自這個請求固定的路由表；熱更新改了某層的值時，該 bucket 會以新值重建，其他 bucket 保留。
+    """
+    routing = current_routing()
+    RATE_LIMITER.admit([
+        ("route", route, routing.route_rate(route)),
+        ("channel", channel_id, routing.channel_rate(channel_id)),
+        ("user", f"{channel_id}/{user_id}", routing.user_rate if user_id else None),
+    ])
+
+
+async def rejected_response(e: AdmissionRejected, channel_id: str = "", notify: bool = False, route: str = "") -> FastJSONResponse:
+    """
+    統一的限流回應（HTTP 429 + Retry-After）。
+    notify=True 時回貼一則說明到頻道，同一個 scope 在 RATE_NOTICE_COOLDOWN 內只通知一次。
+    有帶 route 時記一筆 rejected 到建單事件紀錄。
+    """
+    logger.warning(f"⛔ 請求被拒絕: {e.scope} {e.reason} (channel={channel_id})")
+    record_rejected(route, channel_id, e)
+    if e.reason == "rate limited":
+        error = "請求過於頻繁，請稍後再試"
+    else:
+        error = "目前處理中的請求過多，請稍後再試"
+    if notify and channel_id:
+        now = time.monotonic()
+        if now - _rate_notice_at.get(e.scope, float("-inf")) >= RATE_NOTICE_COOLDOWN:
+            _rate_notice_at[e.scope] = now
+            await run_in_threadpool(send_chat_message, f"⏳ {error}（{e.scope}），本則訊息未建立議題", channel_id)
+    return FastJSONResponse(
+        {"ok": False, "error": error, "reason": e.reason, "scope": e.scope},
+        status_code=429,
+        headers={"Retry-After": str(max(1, int(e.retry_after + 0.999)))},
+    )
+
+
+# ----------------------------
+# 建單統計（事件紀錄 + 累加彙總）
+# ----------------------------
+class DurationHistogram(LagHistogram):
+    """建單耗時直方圖：bucket 放寬到分鐘等級，可存進快照、可合併 / 扣除"""
+
+    BOUNDS = (100, 250, 500, 1000, 2000, 3000, 5000, 7500, 10000, 15000, 20000, 30000, 60000)
+
+    def merge(self, other: "DurationHistogram") -> None:
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.sum_ms += other.sum_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+
+    def subtract(self, other: "DurationHistogram") -> None:
+        """扣掉滑出視窗的那一段；max_ms 無法扣除，由呼叫端重算"""
+        self.counts = [max(0, a - b) for a, b in zip(self.counts, other.counts)]
+        self.total = sum(self.counts)
+        self.sum_ms = max(0.0, self.sum_ms - other.sum_ms) if self.total else 0.0
+
+    def percentile(self, q: float) -> Optional[float]:
+        """落在哪個 bucket 後，在 bucket 上下界之間依名次線性內插（近似值，不是 bucket 上界）"""
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lower = float(self.BOUNDS[i - 1]) if i > 0 else 0.0
+                upper = float(self.BOUNDS[i]) if i < len(self.BOUNDS) else self.max_ms
+                upper = min(upper, self.max_ms)
+                lower = min(lower, upper)
+                return round(lower + (upper - lower) * (rank - seen) / c, 1)
+            seen += c
+        return round(self.max_ms, 1)
+
+    def state(self) -> Dict[str, object]:
+        return {"counts": self.counts, "sum_ms": round(self.sum_ms, 2), "max_ms": round(self.max_ms, 2)}
+
+    @classmethod
+    def from_state(cls, state: Dict[str, object]) -> "DurationHistogram":
+        h = cls()
+        counts = list(state.get("counts") or [])
+        if len(counts) == len(h.counts):  # bucket 定義改過就捨棄舊分布，只重新累計
+            h.counts = [int(c) for c in counts]
+            h.total = sum(h.counts)
+            h.sum_ms = float(state.get("sum_ms") or 0.0)
+            h.max_ms = float(state.get("max_ms") or 0.0)
+        return h
+
+
+class PipelineOutcome:
+    """
+    單次建單流程的結果：create_redmine_issue 依 stage 記下狀態碼、議題 ID、耗時與距收到請求多久，
+    流程（含回應後的延後工作）結束時整理成一筆事件交給 PIPELINE_STATS。
+    """
+
+    def __init__(self, route: str, channel_id: str, user_id: str, kind: str):
+        tr = _trace.get()
+        self.route = route
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.kind = kind
+        self.request_id = tr.request_id if tr is not None else None
+        self.ts = time.time()
+        self.t0 = tr.t0 if tr is not None else time.monotonic()  # 從收到請求起算（含排隊等待）
+        self.http_status = 0
+        self.issues: List[Tuple[str, int, Optional[int], float, float]] = []  # (stage, 狀態碼, 議題 ID, 耗時, 完成時間點)
+        self._lock = threading.Lock()
+
+    def note_issue(self, stage: str, status: int, issue_id: Optional[int], ms: float) -> None:
+        at_ms = (time.monotonic() - self.t0) * 1000
+        with self._lock:
+            self.issues.append((stage, status, issue_id, ms, at_ms))
+
+    def event(self) -> Dict[str, object]:
+        with self._lock:
+            issues = list(self.issues)
+        parent = next((i for i in issues if i[0] != "subtask"), None)
+        subtasks = [i for i in issues if i[0] == "subtask"]
+        failed_subtasks = sum(1 for i in subtasks if not 200 <= i[1] < 300)
+        if parent is None or not 200 <= parent[1] < 300:
+            outcome = "failed"
+        elif failed_subtasks:
+            outcome = "subtasks_failed"
+        else:
+            outcome = "created"
+        stages: Dict[str, float] = {}
+        for stage, _, _, ms, _ in issues:
+            stages[stage] = round(stages.get(stage, 0.0) + ms, 1)
+        return {
+            "ts": round(self.ts, 3),
+            "request_id": self.request_id,
+            "route": self.route,
+            "channel": self.channel_id,
+            "user": self.user_id,
+            "kind": self.kind,
+            "outcome": outcome,
+            "http": self.http_status,
+            "parent": parent[2] if parent else None,
+            "parent_status": parent[1] if parent else None,
+            "subtasks": [i[2] for i in subtasks if i[2]],
+            "subtasks_failed": failed_subtasks,
+            "ttc_ms": round(parent[4], 1) if outcome != "failed" else None,
+            "total_ms": round((time.monotonic() - self.t0) * 1000, 1),
+            "stages": stages,
+        }
+
+
+_outcome: ContextVar[Optional[PipelineOutcome]] = ContextVar("pipeline_outcome", default=None)
+
+
+def note_issue(stage: str, status: int, issue_id: Optional[int] = None, ms: float = 0.0) -> None:
+    """記錄一次建議題結果到目前流程的 PipelineOutcome（沒有在統計的流程就略過）"""
+    outcome = _outcome.get()
+    if outcome is not None:
+        outcome.note_issue(stage, status, issue_id, ms)
+
+
+class StatsWindow:
+    """
+    最近 hours 小時（含目前這一小時）的累加彙總：事件計入時加上，整點往前推時扣掉滑出視窗的那一小時。
+    /stats 直接讀這裡，不必每次把視窗內的每小時 bucket 重新加總。
+    """
+
+    def __init__(self, hours: int):
+        self.hours = hours
+        self.start = ""  # 視窗內最早的小時（hour_key 格式，可直接比大小）
+        self.outcomes: Counter = Counter()
+        self.channels: Dict[str, Counter] = {}
+        self.ttc = DurationHistogram()
+
+    def start_for(self, now: datetime) -> str:
+        return (now - timedelta(hours=self.hours - 1)).strftime("%Y-%m-%dT%H")
+
+    def add(self, key: str, channel: str, outcome: str, ttc: Optional[float]) -> None:
+        if key < self.start:
+            return
+        self.outcomes[outcome] += 1
+        self.channels.setdefault(channel, Counter())[outcome] += 1
+        if ttc is not None:
+            self.ttc.observe(ttc)
+
+    def rebuild(self, hours: Dict[str, Dict[str, object]], now: datetime) -> None:
+        self.start = self.start_for(now)
+        self.outcomes, self.channels, self.ttc = Counter(), {}, DurationHistogram()
+        for key, hour in hours.items():
+            if key >= self.start:
+                self.outcomes.update(hour["outcomes"])
+                for ch, c in hour["channels"].items():
+                    self.channels.setdefault(ch, Counter()).update(c)
+                self.ttc.merge(hour["ttc"])
+
+    def advance(self, hours: Dict[str, Dict[str, object]], now: datetime) -> None:
+        """整點過後把滑出視窗的小時扣掉；每小時只做一次，停機太久（整個視窗都滑出）就重建"""
+        start = self.start_for(now)
+        if start <= self.start:
+            return
+        if not self.start or datetime.strptime(start, "%Y-%m-%dT%H") - datetime.strptime(self.start, "%Y-%m-%dT%H") >= timedelta(hours=self.hours):
+            self.rebuild(hours, now)
+            return
+        for key in [k for k in hours if self.start <= k < start]:
+            hour = hours[key]
+            self.outcomes.subtract(hour["outcomes"])
+            for ch, c in hour["channels"].items():
+                window = self.channels.get(ch)
+                if window is not None:
+                    window.subtract(c)
+                    if not +window:
+                        del self.channels[ch]
+            self.ttc.subtract(hour["ttc"])
+        self.outcomes = +self.outcomes
+        self.start = start
+        self.ttc.max_ms = max((h["ttc"].max_ms for k, h in hours.items() if k >= start), default=0.0)
+
+
+class PipelineStats(NdjsonAppender):
+    """
+    建單事件紀錄 + 累加彙總。事件由背景 thread append 到 STATS_EVENT_LOG 後才計入彙總，
+    彙總與「已計入到檔案哪個 offset」一起存成快照；重啟時載入快照、只補讀 offset 之後的事件。
+    /stats 只讀累加好的總計與 STATS_WINDOWS 視窗彙總，成本與累積事件數、保留的小時數都無關。
+    """
+
+    def __init__(self, path: str, snapshot_path: str, retention_hours: int):
+        super().__init__(path, "pipeline-stats")
+        self.snapshot_path = snapshot_path
+        self.retention_hours = retention_hours
+        self.offset = 0
+        self.events = 0
+        self.since: Optional[float] = None
+        self.outcomes: Counter = Counter()
+        self.channels: Dict[str, Counter] = {}
+        self.channel_ttc: Dict[str, DurationHistogram] = {}
+        self.ttc = DurationHistogram()
+        self.hours: Dict[str, Dict[str, object]] = {}  # "YYYY-MM-DDTHH" -> {"outcomes": Counter, "channels": {頻道: Counter}, "ttc": 直方圖}
+        self.windows = {h: StatsWindow(h) for h in STATS_WINDOWS if h <= retention_hours}
+        self._unsaved = 0
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def hour_key(ts: float) -> str:
+        return datetime.fromtimestamp(ts).strftime("%Y-%m-%dT%H")
+
+    def _apply(self, event: Dict[str, object]) -> None:
+        outcome = str(event.get("outcome") or "unknown")
+        channel = str(event.get("channel") or "")
+        ts = float(event.get("ts") or time.time())
+        self.events += 1
+        self.since = ts if self.since is None else min(self.since, ts)
+        self.outcomes[outcome] += 1
+        self.channels.setdefault(channel, Counter())[outcome] += 1
+        key = self.hour_key(ts)
+        hour = self.hours.get(key)
+        if hour is None:
+            hour = self.hours[key] = {"outcomes": Counter(), "channels": {}, "ttc": DurationHistogram()}
+            self._prune()
+        hour["outcomes"][outcome] += 1
+        hour["channels"].setdefault(channel, Counter())[outcome] += 1
+        ttc = event.get("ttc_ms")
+        if not isinstance(ttc, (int, float)):
+            ttc = None
+        if ttc is not None:
+            self.ttc.observe(ttc)
+            self.channel_ttc.setdefault(channel, DurationHistogram()).observe(ttc)
+            hour["ttc"].observe(ttc)
+        for window in self.windows.values():
+            window.add(key, channel, outcome, ttc)
+
+    def _advance_windows(self) -> None:
+        now = datetime.now()
+        for window in self.windows.values():
+            window.advance(self.hours, now)
+
+    def _prune(self) -> None:
+        """新的一小時出現時，丟掉超過 STATS_HOURLY_RETENTION 的每小時彙總（總計保留）"""
+        newest = datetime.strptime(max(self.hours), "%Y-%m-%dT%H")
+        cutoff = (newest - timedelta(hours=self.retention_hours)).strftime("%Y-%m-%dT%H")
+        for key in [k for k in self.hours if k <= cutoff]:
+            del self.hours[key]
+
+    def written(self, entries: List[Dict[str, object]], offset: int) -> None:
+        with self._stats_lock:
+            self._advance_windows()
+            for event in entries:
+                self._apply(event)
+            self.offset = offset
+            self._unsaved += len(entries)
+            if self._unsaved < STATS_SNAPSHOT_EVERY:
+                return
+            state = self._state()
+        self._save(state)
+
+    # ---- 快照 ----
+    def _state(self) -> Dict[str, object]:
+        self._unsaved = 0
+        return {
+            "log": self.path,
+            "offset": self.offset,
+            "events": self.events,
+            "since": self.since,
+            "outcomes": dict(self.outcomes),
+            "channels": {ch: dict(c) for ch, c in self.channels.items()},
+            "channel_ttc": {ch: h.state() for ch, h in self.channel_ttc.items()},
+            "ttc": self.ttc.state(),
+            "hours": {k: {"channels": {ch: dict(c) for ch, c in h["channels"].items()}, "ttc": h["ttc"].state()}
+                      for k, h in self.hours.items()},
+        }
+
+    def _save(self, state: Dict[str, object]) -> None:
+        try:
+            directory = os.path.dirname(self.snapshot_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp = f"{self.snapshot_path}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(json_dumps(state))
+            os.replace(tmp, self.snapshot_path)
+        except OSError as e:
+            logger.error(f"❌ 寫入建單統計快照失敗: {e}")
+
+    def _load_snapshot(self) -> None:
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                state = json_loads(f.read())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ 讀取建單統計快照失敗，改為重讀整份事件紀錄: {e}")
+            return
+        if state.get("log") != self.path:
+            logger.warning(f"⚠️ 建單統計快照對應的是 {state.get('log')}，改為重讀 {self.path}")
+            return
+        self.offset = int(state.get("offset") or 0)
+        self.events = int(state.get("events") or 0)
+        self.since = state.get("since")
+        self.outcomes = Counter(state.get("outcomes") or {})
+        self.channels = {ch: Counter(c) for ch, c in (state.get("channels") or {}).items()}
+        self.channel_ttc = {ch: DurationHistogram.from_state(h) for ch, h in (state.get("channel_ttc") or {}).items()}
+        self.ttc = DurationHistogram.from_state(state.get("ttc") or {})
+        self.hours = {}
+        for k, h in (state.get("hours") or {}).items():
+            channels = {ch: Counter(c) for ch, c in (h.get("channels") or {}).items()}
+            self.hours[k] = {"outcomes": sum(channels.values(), Counter()), "channels": channels,
+                             "ttc": DurationHistogram.from_state(h.get("ttc") or {})}
+
+    def load(self) -> None:
+        """啟動時：載入快照，再從快照記錄的 offset 補讀事件紀錄的尾端"""
+        with self._stats_lock:
+            self._load_snapshot()
+            from_snapshot = self.events
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                size = 0
+            if size < self.offset:
+                # 紀錄被輪替 / 清掉：既有彙總保留，新檔從頭計入
+                logger.warning(f"⚠️ {self.path} 比快照記錄的 offset 短，視為新檔從頭補讀")
+                self.offset = 0
+            replayed = bad = 0
+            if size > self.offset:
+                with open(self.path, "r+b") as f:
+                    f.seek(self.offset)
+                    pos = self.offset
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            # 上次停機時寫到一半的最後一行：截掉，避免下一筆接在後面
+                            logger.warning(f"⚠️ 截掉 {self.path} 結尾不完整的一行（{len(line)} bytes）")
+                            f.truncate(pos)
+                            break
+                        pos += len(line)
+                        try:
+                            self._apply(json_loads(line))
+                            replayed += 1
+                        except (ValueError, TypeError, AttributeError):
+                            bad += 1
+                    self.offset = pos
+            now = datetime.now()
+            for window in self.windows.values():
+                window.rebuild(self.hours, now)  # 只在啟動時掃一次每小時 bucket，之後都是累加
+            state = self._state() if replayed or bad else None
+        if state is not None:
+            self._save(state)
+        logger.info(f"📊 建單統計: 快照 {from_snapshot} 筆，補讀 {replayed} 筆"
+                    + (f"，略過 {bad} 行格式錯誤" if bad else "") + f"（offset={self.offset}）")
+
+    def flush(self) -> None:
+        """停機時：寫完 queue 裡的事件並存快照"""
+        self.close()
+        with self._stats_lock:
+            state = self._state()
+        self._save(state)
+
+    def summary(self, hours: Optional[int] = None, hourly: bool = False) -> Dict[str, object]:
+        """
+        總計 + 最近 hours 小時（須為 STATS_WINDOWS 之一）的視窗彙總，都是累加好的值。
+        沒指定 hours 時用還在保留範圍內的最大視窗。
+        hourly=True 時另外列出視窗內每小時的結果計數（每小時一筆，不再逐頻道加總）。
+        """
+        if hours is None and self.windows:
+            hours = max(self.windows)
+        window = self.windows.get(hours)
+        if window is None:
+            return {"ok": False, "error": f"hours 須為 {sorted(self.windows)} 之一（STATS_WINDOWS）"}
+        with self._stats_lock:
+            self._advance_windows()
+            result = {
+                "ok": True,
+                "events": self.events,
+                "since": datetime.fromtimestamp(self.since).isoformat(timespec="seconds") if self.since else None,
+                "log": {"path": self.path, "offset": self.offset, "recorded": self.recorded, "dropped": self.dropped},
+                "outcomes": dict(self.outcomes),
+                "time_to_create": self.ttc.to_dict(),
+                "channels": {
+                    ch: {"outcomes": dict(c), "time_to_create": self.channel_ttc[ch].to_dict() if ch in self.channel_ttc else None}
+                    for ch, c in sorted(self.channels.items())
+                },
+                "window": {
+                    "hours": hours,
+                    "outcomes": dict(window.outcomes),
+                    "channels": {ch: dict(c) for ch, c in sorted(window.channels.items())},
+                    "time_to_create": window.ttc.to_dict(),
+                },
+            }
+            if hourly:
+                result["window"]["hourly"] = [{"hour": k, "outcomes": dict(self.hours[k]["outcomes"])}
+                                              for k in sorted(self.hours) if k >= window.start]
+            return result
+
+
+PIPELINE_STATS = PipelineStats(STATS_EVENT_LOG, STATS_SNAPSHOT_PATH, STATS_HOURLY_RETENTION) if STATS_EVENT_LOG else None
+
+
+def record_outcome(outcome: PipelineOutcome) -> None:
+    """流程結束（含延後工作）時把結果寫進事件紀錄"""
+    PIPELINE_STATS.record(outcome.event())
+
+
+def record_rejected(route: str, channel_id: str, e: AdmissionRejected) -> None:
+    """正式流量被拒絕時記一筆；shadow 路由 / 頻道（含鏡像過來的請求）不記，避免混進正式的拒絕統計"""
+    if PIPELINE_STATS is None or not route or is_shadow(route, channel_id):
+        return
+    tr = _trace.get()
+    PIPELINE_STATS.record({
+        "ts": round(time.time(), 3),
+        "request_id": tr.request_id if tr is not None else None,
+        "route": route,
+        "channel": channel_id,
+        "outcome": "rejected",
+        "reason": e.reason,
+        "scope": e.scope,
+    })
+
+
+async def load_pipeline_stats():
+    if PIPELINE_STATS is not None:
+        await run_in_threadpool(PIPELINE_STATS.load)
+
+
+async def flush_pipeline_stats():
+    if PIPELINE_STATS is not None:
+        await run_in_threadpool(PIPELINE_STATS.flush)
+
+
+# ----------------------------
+# Shadow（演練）模式
+# ----------------------------
+class ShadowRun:
+    """一次 shadow 執行中「本來要送出」的 Redmine 議題與 Chat 訊息"""
+
+    _fake_ids = itertools.count(1)
+
+    def __init__(self):
+        self.issues: List[Dict[str, object]] = []
+        self.chat: List[Dict[str, str]] = []
+
+    def record_issue(self, stage: str, issue: Dict[str, object], target: str = "default") -> int:
+        fake_id = -next(self._fake_ids)  # 負數 ID，不會跟真的議題混淆
+        self.issues.append({"stage": stage, "fake_id": fake_id, "target": target, "issue": issue})
+        return fake_id
+
+
+_shadow: ContextVar[Optional[ShadowRun]] = ContextVar("shadow", default=None)
+_shadow_forced: ContextVar[bool] = ContextVar("shadow_forced", default=False)  # 請求帶 X-Shadow-Run（別台鏡像過來的）
+_mirror_source: ContextVar[Optional[Tuple[str, bytes, str]]] = ContextVar("mirror_source", default=None)  # (path, body, content-type)
+SHADOW_RUNS: "deque[Dict[str, object]]" = deque(maxlen=SHADOW_BUFFER_SIZE)
+_shadow_log_lock = threading.Lock()
+
+
+def is_shadow(route: str, channel_id: str) -> bool:
+    return _shadow_forced.get() or route in SHADOW_ROUTES or channel_id in SHADOW_CHANNEL_IDS
+
+
+def mark_shadow_request(request: Request) -> None:
+    """帶 X-Shadow-Run 的請求（另一個部署鏡像過來的）必須通過 X-Debug-Token，之後整個請求以 shadow 執行"""
+    if request.headers.get("x-shadow-run"):
+        require_debug_token(request)
+        _shadow_forced.set(True)
+
+
+def remember_mirror_source(request: Request, body: bytes) -> None:
+    """可以原樣重送的原始 body 先記下來，抽中鏡像時轉送給 SHADOW_MIRROR_URL（multipart 上傳不鏡像）"""
+    if SHADOW_MIRROR_URL and not _shadow_forced.get():
+        _mirror_source.set((request.url.path, body, request.headers.get("content-type", "")))
+
+
+def store_shadow_record(record: Dict[str, object]) -> None:
+    SHADOW_RUNS.append(record)
+    if SHADOW_LOG_PATH:
+        try:
+            with _shadow_log_lock, open(SHADOW_LOG_PATH, "ab") as f:
+                f.write(json_dumps(record) + b"\n")
+        except OSError as e:
+            logger.error(f"❌ 寫入 shadow 紀錄失敗: {e}")
+
+
+def add_background(resp: FastJSONResponse, func, *args) -> None:
+    """在回應既有的背景工作之後再接一個"""
+    tasks = BackgroundTasks([resp.background] if resp.background else [])
+    tasks.add_task(func, *args)
+    resp.background = tasks
+
+
+def run_shadow(route: str, channel_id: str, source: str, func, *args) -> Tuple[FastJSONResponse, Dict[str, object]]:
+    """
+    以 shadow 模式跑一次完整流程：解析、查專案 / 使用者、到期日、子議題規劃都照常，
+    但 create_redmine_issue 不 POST、send_chat_message 不送出，改記錄到 SHADOW_RUNS。
+    自己開一個 Trace 與 Deadline，階段耗時就是這個 Trace 的 span。
+    回應帶有延後工作（子議題、回貼）時，延後工作也在同一個 ShadowRun 下執行，做完才寫出紀錄。
+    """
+    live = _trace.get()
+    trace = Trace(f"shadow-{uuid.uuid4().hex[:8]}", f"{route}.shadow")
+    run = ShadowRun()
+    tokens = [(_trace, _trace.set(trace)), (_shadow, _shadow.set(run)), (_span_depth, _span_depth.set(1)),
+              (_outcome, _outcome.set(None)),  # 演練結果不計入正式的建單統計
+              (_deadline, _deadline.set(Deadline(route_deadline(route))))]
+    resp = None
+    try:
+        resp = run_within_deadline(func, *args)
+    finally:
+        trace.response_ms = round(trace.elapsed_ms(), 2)
+        trace.status = resp.status_code if resp is not None else 500
+        finish_trace(trace)
+        record = {
+            "request_id": trace.request_id,
+            "source": source,
+            "source_request_id": live.request_id if live else None,
+            "route": route,
+            "channel_id": channel_id,
+            "at": trace.started_at.isoformat(timespec="milliseconds"),
+            "duration_ms": trace.response_ms,
+            "result": json_loads(resp.body) if resp is not None else None,
+            "would_create": run.issues,
+            "would_send": run.chat,
+            "stages": [{"name": sp["name"], "duration_ms": sp["duration_ms"]} for sp in trace.to_dict()["spans"]],
+        }
+        if resp is not None and resp.background is not None:
+            resp.background = BackgroundTask(run_shadow_background, run, record, resp.background)
+        else:
+            store_shadow_record(record)
+        for var, token in reversed(tokens):
+            var.reset(token)
+    return resp, record
+
+
+async def run_shadow_background(run: ShadowRun, record: Dict[str, object], background) -> None:
+    """shadow 回應的延後工作：一樣只記錄不送出（would_create / would_send 直接接在同一筆紀錄上）"""
+    token = _shadow.set(run)
+    try:
+        await background()
+    finally:
+        _shadow.reset(token)
+        store_shadow_record(record)
+
+
+def forward_mirror(route: str, channel_id: str, source: Tuple[str, bytes, str], live_request_id: Optional[str], live_status: int, live_body: bytes) -> None:
+    """把正式請求原樣送到 SHADOW_MIRROR_URL（候選版本，以 shadow 執行），與正式結果並列記到 SHADOW_RUNS"""
+    path, body, content_type = source
+    headers = {"Content-Type": content_type, "X-Shadow-Run": "1"}
+    if SHADOW_MIRROR_TOKEN:
+        headers["X-Debug-Token"] = SHADOW_MIRROR_TOKEN
+    if live_request_id:
+        headers["X-Request-ID"] = f"mirror-{live_request_id}"
+    started = datetime.now()
+    t0 = time.monotonic()
+    try:
+        timeout = min(SHADOW_MIRROR_TIMEOUT, route_deadline(route))
+        r = requests.post(f"{SHADOW_MIRROR_URL}{path}", data=body, headers=headers, timeout=timeout, allow_redirects=False)
+        status = r.status_code
+        try:
+            result = json_loads(r.content)
+        except ValueError:
+            result = r.text[:500]
+    except requests.RequestException as e:
+        status, result = -1, f"request failed: {e}"
+    try:
+        live = json_loads(live_body)
+    except ValueError:
+        live = None
+    store_shadow_record({
+        "request_id": headers.get("X-Request-ID"),
+        "source": "mirror",
+        "source_request_id": live_request_id,
+        "route": route,
+        "channel_id": channel_id,
+        "at": started.isoformat(timespec="milliseconds"),
+        "duration_ms": round((time.monotonic() - t0) * 1000, 2),
+        "status": status,
+        "result": result,
+        "live": {"status": live_status, "result": live},
+    })
+
+
+MIRROR_GATE = PipelineGate(SHADOW_MIRROR_MAX_INFLIGHT, 0, 0, scope="mirror")
+
+
+async def mirror_request(route: str, channel_id: str, source: Tuple[str, bytes, str], live_request_id: Optional[str], live_status: int, live_body: bytes) -> None:
+    """
+    鏡像走自己的限流 bucket（mirror:*，不扣正式流量的 token）與自己的名額（MIRROR_GATE），
+    不佔建單閘門；名額滿了就放棄這次鏡像，不排隊、不影響正式請求。
+    """
+    routing = current_routing()
+    try:
+        RATE_LIMITER.admit([
+            ("mirror:route", route, routing.route_rate(route)),
+            ("mirror:channel", channel_id, routing.channel_rate(channel_id)),
+        ])
+        async with MIRROR_GATE.slot(wait=False):
+            await run_in_threadpool(forward_mirror, route, channel_id, source, live_request_id, live_status, live_body)
+    except AdmissionRejected as e:
+        logger.info(f"🪞 略過鏡像 {route}（{e.scope} {e.reason}）")
+
+
+async def run_pipeline(route: str, channel_id: str, func, *args, user_id: str = "") -> FastJSONResponse:
+    """
+    在 threadpool 執行建單流程。設定為 shadow 的路由 / 頻道（或鏡像過來的請求）只演練不寫入；
+    其他請求照常執行，並依 SHADOW_MIRROR_RATE 抽樣在回應後把原始請求送到 SHADOW_MIRROR_URL，
+    由候選版本以 shadow 執行，新舊兩版的結果並列記在 /debug/shadow。
+    依 channel_id 選定 Redmine 目的地（REDMINE_URLS 等），threadpool 與延後工作都沿用同一個。
+    正式執行的結果（含延後的子議題）在回應後寫入建單事件紀錄（STATS_EVENT_LOG）。
+    """
+    redmine = redmine_for(channel_id)
+    _redmine.set(redmine)
+    # 送進 threadpool 前先在 event loop 上佔好這台 Redmine 的請求空位；等不到丟 RedmineBusy（呼叫端當作限流）
+    d = _deadline.get()
+    reserve = redmine.target.reserve(PIPELINE_QUEUE_TIMEOUT if d is None else max(0.0, min(PIPELINE_QUEUE_TIMEOUT, d.remaining())))
+    if is_shadow(route, channel_id):
+        async with reserve:
+            resp, record = await run_in_threadpool(run_shadow, route, channel_id, "shadow", func, *args)
+        body = json_loads(resp.body)
+        body["shadow"] = True
+        body["would_create"] = record["would_create"]
+        return FastJSONResponse(body, status_code=resp.status_code, background=resp.background)
+    async with reserve:
+        if PIPELINE_STATS is None:
+            resp = await run_in_threadpool(run_within_deadline, func, *args)
+        else:
+            outcome = PipelineOutcome(route, channel_id, user_id, "business" if func is handle_new_business else "task")
+            _outcome.set(outcome)
+            try:
+                resp = await run_in_threadpool(run_within_deadline, func, *args)
+            except Exception:
+                outcome.http_status = 500
+                record_outcome(outcome)
+                raise
+            outcome.http_status = resp.status_code
+            add_background(resp, record_outcome, outcome)  # 排在延後工作之後，子議題做完才算結束
+    source = _mirror_source.get()
+    if source is not None and SHADOW_MIRROR_RATE > 0 and random.random() < SHADOW_MIRROR_RATE:
+        live = _trace.get()
+        add_background(resp, mirror_request, route, channel_id, source, live.request_id if live else None, resp.status_code, resp.body)
+    return resp
+
+
+# ----------------------------
+# Chat：依頻道回貼訊息（Incoming Webhook）
+# ----------------------------
+@traced
+def send_chat_message(text: str, channel_id: str) -> Tuple[int, str]:
+    """
+    依 channel_id 選擇對應的 Incoming URL（CHAT_INCOMING_URLS），
+    沒對到就用 CHAT_WEBHOOK_URL。必須用 x-www-form-urlencoded + payload=JSON。
+    """
+    text = (text or "").strip()
+    if not text:
+        return 0, "empty text"
+
+    shadow = _shadow.get()
+    if shadow is not None:
+        shadow.chat.append({"channel_id": str(channel_id), "text": text})
+        return 0, "shadow: not sent"
+
+    url = current_routing().incoming_url(channel_id)
+    if not url:
+        return 0, f"no incoming url for channel {channel_id}"
+
+    try:
+        r = requests.post(
+            url,
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            data={"payload": json_dumps_str({"text": text})},
+            verify=CHAT_VERIFY_TLS,
+            timeout=call_timeout(8, "chat_ack"),
+            stream=True,
+        )
+        read_body(r, "chat_ack")
+        if 200 <= r.status_code < 300:
+            RECENT_REPLIES.add(channel_id, text)
+        return r.status_code, r.text
+    except DeadlineExceeded as e:
+        # 回貼是流程最後一步：預算用完就不送（已記入 incomplete），不影響已建立的議題
+        logger.warning(f"⏱️ 時間預算不足，未回貼到頻道 {channel_id}: {e}")
+        return 0, str(e)
+    except Exception as e:
+        return -1, f"request failed: {e}"
+
+
+# ----------------------------
+# Redmine：目的地（依頻道）
+# ----------------------------
+def parse_ref(raw: str):
+    """設定值可以是數字 ID 或名稱：'10' -> 10，'商機' -> '商機'，空字串 -> None（啟動時解析一次）"""
+    raw = (raw or "").strip()
+    if not raw:
+        return None
+    return int(raw) if raw.isdigit() else raw
+
+
+REDMINE_TRACKER_REF = parse_ref(REDMINE_TRACKER_ID)
+REDMINE_STATUS_REF = parse_ref(REDMINE_STATUS_ID)
+REDMINE_PRIORITY_REF = parse_ref(REDMINE_PRIORITY)
+
+
+class RedmineBusy(AdmissionRejected):
+    """這台 Redmine 的同時請求數已滿，等不到空位（流程送進 threadpool 前發生時，呼叫端當作限流處理）"""
+
+    def __init__(self, target: "RedmineTarget", retry_after: float = 0):
+        super().__init__(f"redmine:{target.name}", f"busy（同時請求已達上限 {target.max_concurrency}）", retry_after)
+
+
+_reserved_target: ContextVar[Optional["RedmineTarget"]] = ContextVar("reserved_target", default=None)
+
+
+class RedmineTarget:
+    """
+    一台 Redmine（URL + API key）。各自有連線池（requests.Session）、中繼資料、
+    專案 / 使用者查詢快取、建單流程閘門（gate），以及同時請求上限：某台 Redmine 變慢或掛掉時，
+    只有送往它的頻道會排隊或被拒絕，不會佔滿閘門或 threadpool 拖累其他頻道。
+    建單流程在 event loop 上先用 reserve() 佔好一個請求空位才送進 threadpool，worker 不會卡在等空位。
+    """
+
+    def __init__(self, name: str, url: str, api_key: str, max_concurrency: int):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.max_concurrency = max(1, max_concurrency)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["X-Redmine-API-Key"] = api_key
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._waiters: "deque[asyncio.Future]" = deque()  # reserve() 排隊中的流程，依到達順序交付空位
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lookups: Dict[Tuple[str, str], Tuple[float, object]] = {}
+        self._lookups_lock = threading.Lock()  # 多個 threadpool worker 同時查 / 寫快取
+        self.inflight = 0
+        self.busy = 0
+        self.gate = PipelineGate(PIPELINE_MAX_INFLIGHT, PIPELINE_MAX_QUEUE, PIPELINE_QUEUE_TIMEOUT, scope=f"pipeline:{name}")
+        self.metadata = RedmineMetadata(self)
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.url and self.api_key)
+
+    @asynccontextmanager
+    async def reserve(self, timeout: float):
+        """
+        在 event loop 上等一個請求空位，佔著直到區塊結束（流程中的 Redmine 請求依序進行，一個就夠）；
+        沒有空位時排進 _waiters，空位釋放時依到達順序交給下一個（不輪詢、後到的不插隊）。
+        timeout 內等不到就丟 RedmineBusy，這時工作還沒送進 threadpool。
+        """
+        self._loop = asyncio.get_running_loop()
+        while self._waiters and self._waiters[0].done():
+            self._waiters.popleft()
+        if self._waiters or not self._slots.acquire(blocking=False):
+            waiter = self._loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except BaseException as e:
+                if waiter.done() and not waiter.cancelled():
+                    self._release()  # 空位已經交過來但流程被取消：還回去給下一個
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.busy += 1
+                    raise RedmineBusy(self, retry_after=timeout)
+                raise
+        token = _reserved_target.set(self)
+        try:
+            yield
+        finally:
+            _reserved_target.reset(token)
+            self._release()
+
+    def _release(self) -> None:
+        """還一個空位；有流程在 reserve() 排隊時，到 event loop 上交給最早到的（thread 也可以呼叫）"""
+        self._slots.release()
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._hand_off)
+            except RuntimeError:
+                pass  # loop 剛好關閉
+
+    def _hand_off(self) -> None:
+        while self._waiters:
+            waiter = self._waiters[0]
+            if waiter.done():
+                self._waiters.popleft()
+            elif self._slots.acquire(blocking=False):
+                self._waiters.popleft()
+                waiter.set_result(True)
+            else:
+                return
+
+    def request(self, method: str, path: str, stage: str, cap: float, **kwargs) -> requests.Response:
+        """
+        送出一個請求。已用 reserve() 佔好空位的流程直接送；
+        其他（延後工作、背景重新整理）在 thread 裡最多等 REDMINE_SLOT_WAIT 秒，等不到丟 RedmineBusy。
+        """
+        reserved = _reserved_target.get() is self
+        if not reserved and not self._slots.acquire(timeout=min(REDMINE_SLOT_WAIT, call_timeout(cap, stage))):
+            self.busy += 1
+            raise RedmineBusy(self)
+        self.inflight += 1
+        try:
+            resp = self.session.request(method, f"{self.url}{path}", verify=REDMINE_VERIFY, timeout=call_timeout(cap, stage), stream=True, **kwargs)
+            return read_body(resp, stage)
+        finally:
+            self.inflight -= 1
+            if not reserved:
+                self._release()
+
+    def cached(self, kind: str, key: str):
+        with self._lookups_lock:
+            hit = self._lookups.get((kind, key))
+        if hit is not None and time.monotonic() - hit[0] < REDMINE_LOOKUP_TTL:
+            return hit[1]
+        return None
+
+    def remember(self, kind: str, key: str, value) -> None:
+        with self._lookups_lock:
+            if len(self._lookups) >= 1000:
+                self._lookups.clear()
+            self._lookups[(kind, key)] = (time.monotonic(), value)
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "url": self.url,
+            "api_key": _safe_tail(self.api_key, 4),
+            "max_concurrency": self.max_concurrency,
+            "inflight": self.inflight,
+            "busy": self.busy,
+            "pipelines": {"inflight": self.gate.inflight, "waiting": self.gate.waiting},
+            "cached_lookups": len(self._lookups),
+        }
+
+
+class RedmineRoute:
+    """某個頻道建單要用的 Redmine 目的地，以及預設專案 / tracker / 狀態 / 優先權"""
+
+    def __init__(self, target: RedmineTarget, project: Optional[str], tracker_ref, status_ref, priority_ref):
+        self.target = target
+        self.project = project
+        self.tracker_ref = tracker_ref
+        self.status_ref = status_ref
+        self.priority_ref = priority_ref
+
+
+def build_redmine_routes() -> Tuple[RedmineRoute, Dict[str, RedmineRoute], List[RedmineTarget]]:
+    """
+    依 REDMINE_URLS / REDMINE_API_KEYS / REDMINE_PROJECT_IDS / REDMINE_TRACKER_IDS 建立頻道 → 目的地對照。
+    URL + key 相同的頻道共用同一個 RedmineTarget（同一個連線池與快取）。
+    設定的 tracker / 狀態 / 優先權若是數字 ID，只套用在同一台 Redmine；名稱則各台自己解析。
+    """
+    targets: Dict[Tuple[str, str], RedmineTarget] = {}
+
+    def target_for(url: str, api_key: str) -> RedmineTarget:
+        key = (url.rstrip("/"), api_key)
+        if key not in targets:
+            name = "default" if not targets else (urlsplit(url).netloc or url) + (f"#{len(targets)}" if any(t.url == key[0] for t in targets.values()) else "")
+            targets[key] = RedmineTarget(name, url, api_key, REDMINE_MAX_CONCURRENCY)
+        return targets[key]
+
+    default = RedmineRoute(target_for(REDMINE_URL, REDMINE_API_KEY), REDMINE_PROJECT_ID or REDMINE_PROJECT or None,
+                           REDMINE_TRACKER_REF, REDMINE_STATUS_REF, REDMINE_PRIORITY_REF)
+    routes: Dict[str, RedmineRoute] = {}
+    for channel_id in sorted(set(REDMINE_URLS) | set(REDMINE_API_KEYS) | set(REDMINE_PROJECT_IDS) | set(REDMINE_TRACKER_IDS)):
+        url = REDMINE_URLS.get(channel_id, REDMINE_URL).rstrip("/")
+        same_server = url == REDMINE_URL
+        api_key = REDMINE_API_KEYS.get(channel_id) or (REDMINE_API_KEY if same_server else "")
+        if not api_key:
+            logger.error(f"❌ 頻道 {channel_id} 的 Redmine {url} 沒有設定 REDMINE_API_KEYS，不會沿用預設 key")
+
+        def inherit(ref):
+            return ref if same_server or isinstance(ref, str) else None
+
+        tracker = parse_ref(REDMINE_TRACKER_IDS[channel_id]) if channel_id in REDMINE_TRACKER_IDS else inherit(REDMINE_TRACKER_REF)
+        project = REDMINE_PROJECT_IDS.get(channel_id) or (default.project if same_server else None)
+        routes[channel_id] = RedmineRoute(target_for(url, api_key), project, tracker,
+                                          inherit(REDMINE_STATUS_REF), inherit(REDMINE_PRIORITY_REF))
+    return default, routes, list(targets.values())
+
+
+_redmine: ContextVar[Optional[RedmineRoute]] = ContextVar("redmine", default=None)
+
+
+def redmine_for(channel_id: str) -> RedmineRoute:
+    return REDMINE_ROUTES.get(str(channel_id), REDMINE_DEFAULT)
+
+
+def pipeline_gate(channel_id: str) -> PipelineGate:
+    """頻道對應那台 Redmine 的建單流程閘門"""
+    return redmine_for(channel_id).target.gate
+
+
+def current_redmine() -> RedmineRoute:
+    """目前請求的 Redmine 目的地（run_pipeline 依頻道設定；沒設定時用預設）"""
+    return _redmine.get() or REDMINE_DEFAULT
+
+
+# ----------------------------
+# Redmine：中繼資料（tracker / 狀態 / 優先權 / 自訂欄位）
+# ----------------------------
+
+
+class RedmineMetadata:
+    """
+    快取 Redmine 的 tracker、議題狀態、優先權、自訂欄位清單，讓設定與指令可以用名稱指定。
+      - 每個清單記住 ETag / Last-Modified，重新整理時用條件式 GET，304 就沿用舊資料
+      - 重新整理在背景定期進行；請求路徑上的名稱解析只是本地 dict 查詢
+      - 背景還沒讀過（剛啟動）時，第一次名稱解析會在請求裡同步讀一次，不會把名稱默默當成「找不到」
+    /custom_fields.json 需要管理員權限，拿不到（403）時自訂欄位功能就停用。
+    """
+
+    ENDPOINTS = {
+        "trackers": ("/trackers.json", "trackers"),
+        "statuses": ("/issue_statuses.json", "issue_statuses"),
+        "priorities": ("/enumerations/issue_priorities.json", "issue_priorities"),
+        "custom_fields": ("/custom_fields.json", "custom_fields"),
+    }
+
+    def __init__(self, target: RedmineTarget):
+        self.target = target
+        self._by_name: Dict[str, Dict[str, Dict[str, object]]] = {kind: {} for kind in self.ENDPOINTS}
+        self._validators: Dict[str, Dict[str, str]] = {}
+        self.loaded_at: Dict[str, str] = {}
+        self._refresh_lock = threading.Lock()  # 背景重新整理與請求路徑的首次讀取不重複打 Redmine
+        self._refreshed = False
+        self._reported_missing: set = set()  # 每次重新整理後，清單未載入只提醒一次
+
+    def _fetch(self, kind: str) -> None:
+        path, key = self.ENDPOINTS[kind]
+        headers = {}
+        validators = self._validators.get(kind, {})
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        resp = self.target.request("GET", path, "metadata", 10, headers=headers)
+        if resp.status_code == 304:
+            return
+        if resp.status_code != 200:
+            logger.warning(f"⚠️ 讀取 Redmine({self.target.name}) {kind} 失敗: {resp.status_code}")
+            return
+        items = json_loads(resp.content).get(key) or []
+        table: Dict[str, Dict[str, object]] = {}
+        for item in items:
+            if item.get("name"):
+                table[str(item["name"]).strip().lower()] = item
+        self._by_name[kind] = table  # 整張表一次換掉，讀取端不需要加鎖
+        self._validators[kind] = {
+            "etag": resp.headers.get("ETag", ""),
+            "last_modified": resp.headers.get("Last-Modified", ""),
+        }
+        self.loaded_at[kind] = datetime.now().isoformat(timespec="seconds")
+        logger.info(f"📚 Redmine({self.target.name}) {kind}: {len(table)} 筆")
+
+    def _refresh(self) -> None:
+        self._reported_missing = set()
+        for kind in self.ENDPOINTS:
+            try:
+                self._fetch(kind)
+            except DeadlineExceeded:
+                raise  # 請求路徑上的首次讀取超過期限：不算讀過，下個請求再試
+            except Exception as e:
+                logger.error(f"❌ 讀取 Redmine({self.target.name}) {kind} 時發生錯誤: {e}")
+        self._refreshed = True
+
+    def refresh(self) -> None:
+        if not self.target.configured:
+            return
+        with self._refresh_lock:
+            self._refresh()
+
+    def ensure_loaded(self) -> None:
+        """背景還沒讀過就在這裡同步讀一次；同時到達的請求等同一次讀取（等待不超過請求期限）"""
+        if self._refreshed or not self.target.configured:
+            return
+        d = _deadline.get()
+        if not self._refresh_lock.acquire(timeout=-1 if d is None else max(0.0, d.remaining())):
+            logger.warning(f"⏱️ Redmine({self.target.name}) 中繼資料讀取中，等到期限仍未完成，先不解析名稱")
+            return
+        try:
+            if not self._refreshed:
+                logger.info(f"📚 Redmine({self.target.name}) 中繼資料尚未載入，同步讀取")
+                self._refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def _lookup(self, kind: str, name: str) -> Optional[Dict[str, object]]:
+        self.ensure_loaded()
+        if kind not in self.loaded_at:
+            # 例：沒有管理員權限讀不到自訂欄位（403）；名稱當一般文字處理，每次重新整理只提醒一次
+            if kind not in self._reported_missing:
+                self._reported_missing.add(kind)
+                logger.warning(f"⚠️ Redmine({self.target.name}) {kind} 清單未載入，名稱不解析")
+            return None
+        return self._by_name[kind].get(name.strip().lower())
+
+    def resolve_id(self, kind: str, ref) -> Optional[int]:
+        """數字直接回傳；名稱（不分大小寫）查本地快取，找不到回傳 None"""
+        if ref is None or isinstance(ref, int):
+            return ref
+        item = self._lookup(kind, str(ref))
+        if item is None:
+            if kind in self.loaded_at:
+                logger.warning(f"⚠️ 找不到 Redmine({self.target.name}) {kind} 名稱: {ref}")
+            return None
+        return item.get("id")
+
+    def custom_field(self, name: str) -> Optional[Dict[str, object]]:
+        return self._lookup("custom_fields", name)
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            kind: {"count": len(table), "loaded_at": self.loaded_at.get(kind), "names": sorted(str(v.get("name")) for v in table.values())}
+            for kind, table in self._by_name.items()
+        }
+
+
+REDMINE_DEFAULT, REDMINE_ROUTES, REDMINE_TARGETS = build_redmine_routes()
+if REDMINE_ROUTES:
+    logger.info(f"Redmine routes: { {ch: f'{r.target.name}/{r.project}' for ch, r in REDMINE_ROUTES.items()} } targets={[t.name for t in REDMINE_TARGETS]}")
+
 
+async def start_metadata_refresher():
+    async def refresher(target: RedmineTarget):
+        while True:
+            await run_in_threadpool(target.metadata.refresh)
+            await asyncio.sleep(REDMINE_METADATA_TTL)
+    # 每台 Redmine 各自一個 task，某台逾時不會延誤其他台
+    for target in REDMINE_TARGETS:
+        _background_tasks.append(asyncio.create_task(refresher(target)))
+
+
+# 指令中的 '名稱:值'（名稱在行首或空白之後，冒號可全形）；已知參數以外的名稱若是 Redmine 自訂欄位，就當作自訂欄位值
+# 名稱不得含冒號、冒號後不能接 //，'https://...'、'客戶A來源:x' 之類的片段不會被當成欄位
+_FIELD_TOKEN_RE = re.compile(rf'(?:^|(?<=\s))([^\s:：]+){FIELD_COLON}(?!//)[ \t]*(\S+)')
+TASK_PARAM_NAMES = {'專案', '標題', '指派', '開始', '完成', '優先'}
+
+
+def extract_issue_fields(text: str) -> Tuple[Optional[str], Dict[str, str]]:
+    """
+    從訊息中取出優先權與自訂欄位：
+      '新商機 客戶A 優先:高 來源:展會' -> ('高', {'來源': '展會'})   # 若 Redmine 有「來源」自訂欄位
+    """
+    priority = None
+    custom_fields: Dict[str, str] = {}
+    for name, value in _FIELD_TOKEN_RE.findall(text or ""):
+        if name == '優先':
+            priority = value
+        elif name not in TASK_PARAM_NAMES and current_redmine().target.metadata.custom_field(name):
+            custom_fields[name] = value
+    return priority, custom_fields
 
-def is_new_task_keyword(text: str) -> bool:
-    """檢查是否為新任務關鍵字（新功能）"""
-    task_keywords = ['新任務', '增加新任務', '增加新議題', '新議題']
-    return any(keyword in text for keyword in task_keywords)
+
+def strip_issue_fields(text: str, priority: Optional[str], custom_fields: Dict[str, str]) -> str:
+    """從標題移除已取出的 '優先:值' 與自訂欄位參數（冒號可全形）"""
+    fields = ([("優先", priority)] if priority else []) + list(custom_fields.items())
+    if not fields:
+        return text
+    for name, value in fields:
+        text = re.sub(rf'{re.escape(name)}{FIELD_COLON}\s*{re.escape(value)}', '', text)
+    return re.sub(r'\s+', ' ', text).strip()
 
 
 # ----------------------------
-# 環境變數
+# 附件轉送（Chat 檔案 URL / n8n 上傳 → Redmine /uploads.json）
 # ----------------------------
-PORT = int(os.getenv("PORT", "8085"))
+_DISPOSITION_RE = re.compile(r"""filename\*\s*=\s*(?:UTF-8|utf-8)''([^;]+)|filename\s*=\s*"?([^";]+)"?""")
+_attachment_slots = threading.BoundedSemaphore(max(1, ATTACHMENT_MAX_CONCURRENCY))
 
-# Outgoing 驗證
-OUTGOING_TOKEN = os.getenv("OUTGOING_TOKEN", "").strip()  # 單一 token（僅支援一個頻道）
-CHAT_TOKENS = parse_map(os.getenv("CHAT_TOKENS", ""))     # 多頻道：'196:tokA,94:tokB'
-CHAT_CHANNEL_IDS = {s for s in os.getenv("CHAT_CHANNEL_IDS", "").replace(" ", "").split(",") if s}
 
-# Incoming 回貼
-CHAT_INCOMING_URLS = parse_map(os.getenv("CHAT_INCOMING_URLS", ""))  # '196:urlA,94:urlB,95:urlC'
-DEFAULT_INCOMING_URL = os.getenv("CHAT_WEBHOOK_URL", "").strip()     # 找不到對應時的預設
-CHAT_VERIFY_TLS = parse_bool(os.getenv("CHAT_VERIFY_TLS"), default=False)  # 自簽憑證先關
+class AttachmentError(Exception):
+    """附件沒轉送成功（太大 / 來源不允許 / 下載或上傳失敗）；訊息會出現在回應與回貼裡"""
 
-# Redmine
-REDMINE_URL = os.getenv("REDMINE_URL", "").rstrip("/")
-REDMINE_API_KEY = os.getenv("REDMINE_API_KEY", "").strip()
-REDMINE_PROJECT = os.getenv("REDMINE_PROJECT", "").strip()
-REDMINE_PROJECT_ID = os.getenv("REDMINE_PROJECT_ID", "").strip()
-REDMINE_TRACKER_ID = os.getenv("REDMINE_TRACKER_ID", "").strip()
-REDMINE_STATUS_ID = os.getenv("REDMINE_STATUS_ID", "").strip()
-REDMINE_VERIFY = parse_bool(os.getenv("REDMINE_VERIFY"), default=False)
 
-# 關鍵字（支援多個，用逗號分隔）
-KEYWORD = os.getenv("KEYWORD", "新商機").strip()
-KEYWORDS_RAW = os.getenv("KEYWORDS", "").strip()
-KEYWORDS = [k.strip() for k in KEYWORDS_RAW.split(",") if k.strip()] if KEYWORDS_RAW else [KEYWORD]
+class ChunkReader:
+    """
+    把來源串流包成 requests 的 body：每次最多讀 ATTACHMENT_CHUNK_SIZE、累計大小，超過 ATTACHMENT_MAX_BYTES 就中斷。
+    知道大小時提供 len（requests 會送 Content-Length 且不多讀），不知道時 requests 改用 chunked 傳送。
+    給了 until（time.monotonic()）時每塊之前檢查，超過就中斷，慢速傳輸不會吃掉保留給議題的預算。
+    """
 
+    def __init__(self, raw, length: Optional[int] = None, until: Optional[float] = None):
+        self.raw = raw
+        self.sent = 0
+        self.length = length
+        self.until = until
+        if length is not None:
+            self.len = length
 
-# ----------------------------
-# Logging
-# ----------------------------
-logger = logging.getLogger("chat-newbiz")
-logger.setLevel(logging.INFO)
-if not logger.handlers:
-    _h = logging.StreamHandler()
-    _fmt = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
-    _h.setFormatter(_fmt)
-    logger.addHandler(_h)
+    def read(self, size: int = -1) -> bytes:
+        if self.until is not None and time.monotonic() > self.until:
+            raise AttachmentError(f"轉送逾時（已傳 {self.sent} bytes）")
+        size = ATTACHMENT_CHUNK_SIZE if size is None or size < 0 else min(size, ATTACHMENT_CHUNK_SIZE)
+        if self.length is not None:
+            size = min(size, self.length - self.sent)
+            if size <= 0:
+                return b""
+        chunk = self.raw.read(size)
+        self.sent += len(chunk)
+        if self.sent > ATTACHMENT_MAX_BYTES:
+            raise AttachmentError(f"超過 {ATTACHMENT_MAX_BYTES} bytes 上限")
+        return chunk
 
-# 啟動時印出對照摘要（避免洩漏，只印末8碼）
-def _safe_tail(s: str, n: int = 8) -> str:
-    return s[-n:] if s else ""
+    def __iter__(self):
+        while True:
+            chunk = self.read(ATTACHMENT_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
 
-logger.info(f"Startup: channels={sorted(CHAT_CHANNEL_IDS) if CHAT_CHANNEL_IDS else 'ALL'}")
-if CHAT_TOKENS:
-    masked = {k: _safe_tail(v) for k, v in CHAT_TOKENS.items()}
-    logger.info(f"Outgoing map(last8)={masked}")
-if CHAT_INCOMING_URLS:
-    masked = {k: _safe_tail(v) for k, v in CHAT_INCOMING_URLS.items()}
-    logger.info(f"Incoming map(last8)={masked}")
-if DEFAULT_INCOMING_URL:
-    logger.info(f"Default incoming URL(last8)={_safe_tail(DEFAULT_INCOMING_URL)}")
 
-app = FastAPI()
+class UrlAttachment:
+    """webhook / n8n 給的檔案 URL：轉送時才以串流下載，邊下載邊上傳"""
 
+    def __init__(self, url: str, filename: str = ""):
+        self.url = url
+        self.named = bool(filename)  # 呼叫端指定的檔名優先於 Content-Disposition
+        self.filename = filename or unquote(urlsplit(url).path.rsplit("/", 1)[-1]) or "attachment"
+        self.content_type = "application/octet-stream"
+        self.size: Optional[int] = None
 
-# ----------------------------
-# 驗證 Outgoing token
-# ----------------------------
-def verify_outgoing_token(channel_id: str, token: str) -> bool:
-    channel_id = (channel_id or "").strip()
-    token = (token or "").strip()
-    if not channel_id or not token:
+    @contextmanager
+    def open(self, timeout: float):
+        resp = self._get(timeout)
+        try:
+            if resp.status_code != 200:
+                raise AttachmentError(f"下載失敗 HTTP {resp.status_code}")
+            length = resp.headers.get("Content-Length")
+            if length and length.isdigit() and not resp.headers.get("Content-Encoding"):
+                self.size = int(length)
+            if self.size is not None and self.size > ATTACHMENT_MAX_BYTES:
+                raise AttachmentError(f"{self.size} bytes 超過 {ATTACHMENT_MAX_BYTES} bytes 上限")
+            m = _DISPOSITION_RE.search(resp.headers.get("Content-Disposition", ""))
+            if m and not self.named:
+                self.filename = unquote(m.group(1) or "").strip() or (m.group(2) or "").strip() or self.filename
+            self.content_type = resp.headers.get("Content-Type", self.content_type).split(";")[0].strip() or self.content_type
+            resp.raw.decode_content = True
+            yield resp.raw
+        finally:
+            resp.close()
+
+    def _get(self, timeout: float) -> requests.Response:
+        """自己跟轉址：每一站都重新檢查主機，避免允許的主機把請求轉到內網"""
+        url = self.url
+        for _ in range(ATTACHMENT_MAX_REDIRECTS + 1):
+            if not attachment_url_allowed(url):
+                raise AttachmentError(f"來源主機不在 ATTACHMENT_URL_HOSTS: {_safe_url(url)}")
+            resp = requests.get(url, stream=True, verify=CHAT_VERIFY_TLS, timeout=timeout, allow_redirects=False)
+            if not resp.is_redirect:
+                return resp
+            url = urljoin(url, resp.headers["Location"])
+            resp.close()
+        raise AttachmentError(f"轉址超過 {ATTACHMENT_MAX_REDIRECTS} 次")
+
+    def describe(self) -> Dict[str, object]:
+        return {"filename": self.filename, "source": _safe_url(self.url), "size": self.size}
+
+
+class UploadedAttachment:
+    """n8n 以 multipart 上傳的檔案（Starlette 超過 1MB 會先落地成暫存檔），轉送時從頭串流讀出"""
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.filename = upload.filename or "attachment"
+        self.content_type = upload.content_type or "application/octet-stream"
+        self.size: Optional[int] = upload.size
+
+    @contextmanager
+    def open(self, timeout: float):
+        if self.size is not None and self.size > ATTACHMENT_MAX_BYTES:
+            raise AttachmentError(f"{self.size} bytes 超過 {ATTACHMENT_MAX_BYTES} bytes 上限")
+        self.upload.file.seek(0)
+        yield self.upload.file
+
+    def describe(self) -> Dict[str, object]:
+        return {"filename": self.filename, "source": "upload", "size": self.size}
+
+
+def _safe_url(url: str) -> str:
+    """log / 回應裡只留 scheme + host + path，不帶 query（可能有 token）"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}{parts.path}"
+
+
+def attachment_url_allowed(url: str) -> bool:
+    """只接受 http(s) 且主機在允許清單內的 URL，避免被拿來打內網其他服務"""
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
         return False
+    if ATTACHMENT_URL_HOSTS:
+        return parts.hostname in ATTACHMENT_URL_HOSTS
+    routing = current_routing()
+    urls = [CHAT_API_BASE, routing.default_incoming_url, *routing.incoming_urls.values()]
+    return parts.hostname in {urlsplit(u).hostname for u in urls if u}
 
-    # 若設定了 per-channel 對照，優先使用
-    if CHAT_TOKENS:
-        expect = CHAT_TOKENS.get(channel_id)
-        if not expect:
-            return False
-        return token == expect
 
-    # 否則回退到單一 OUTGOING_TOKEN
-    return token == OUTGOING_TOKEN
+def chat_attachments(form: Dict[str, str]) -> List[UrlAttachment]:
+    """Chat webhook / 輪詢訊息裡 ATTACHMENT_URL_FIELDS 欄位帶的檔案 URL（不允許的主機在轉送時回報失敗）"""
+    if not ATTACHMENTS:
+        return []
+    return [UrlAttachment(form[f].strip()) for f in ATTACHMENT_URL_FIELDS if (form.get(f) or "").strip()]
 
 
-# ----------------------------
-# Chat：依頻道回貼訊息（Incoming Webhook）
-# ----------------------------
-def send_chat_message(text: str, channel_id: str) -> Tuple[int, str]:
+def attachment_budget() -> float:
+    """這次轉送還能用的秒數：不超過 ATTACHMENT_TIMEOUT，且留 ATTACHMENT_RESERVE 秒給掛上議題與回貼"""
+    d = _deadline.get()
+    budget = ATTACHMENT_TIMEOUT if d is None else min(ATTACHMENT_TIMEOUT, d.remaining() - ATTACHMENT_RESERVE)
+    if budget < MIN_CALL_TIMEOUT:
+        raise AttachmentError("時間預算不足，未上傳")
+    return budget
+
+
+def upload_attachment(attachment) -> Dict[str, object]:
     """
-    依 channel_id 選擇對應的 Incoming URL（CHAT_INCOMING_URLS），
-    沒對到就用 DEFAULT_INCOMING_URL。必須用 x-www-form-urlencoded + payload=JSON。
+    把一個附件串流到目前 Redmine 目的地的 /uploads.json，回傳 issue 的 uploads 項目（含 token）。
+    下載 + 上傳總共不超過 attachment_budget()；轉送名額（ATTACHMENT_MAX_CONCURRENCY）最多等 REDMINE_SLOT_WAIT 秒，
+    建單流程已佔好 Redmine 空位，上傳沿用不另外佔。shadow 模式不下載也不上傳。
     """
-    text = (text or "").strip()
-    if not text:
-        return 0, "empty text"
+    shadow = _shadow.get()
+    if shadow is not None:
+        return {"token": "shadow", "filename": attachment.filename, "content_type": attachment.content_type}
+    target = current_redmine().target
+    until = time.monotonic() + attachment_budget()
+    if not _attachment_slots.acquire(timeout=min(REDMINE_SLOT_WAIT, until - time.monotonic())):
+        raise AttachmentError(f"同時轉送已達上限 {ATTACHMENT_MAX_CONCURRENCY}")
+    try:
+        with span("redmine.upload", target=target.name) as sp:
+            with attachment.open(attachment_budget()) as raw:
+                reader = ChunkReader(raw, attachment.size, until)
+                resp = target.request(
+                    "POST", f"/uploads.json?filename={quote(attachment.filename)}", "attachment", attachment_budget(),
+                    headers={"Content-Type": "application/octet-stream"}, data=reader,
+                )
+            sp["status"] = resp.status_code
+            sp["bytes"] = reader.sent
+    finally:
+        _attachment_slots.release()
+    if resp.status_code != 201:
+        raise AttachmentError(f"上傳失敗 HTTP {resp.status_code}: {resp.text[:200]}")
+    token = (json_loads(resp.content).get("upload") or {}).get("token")
+    if not token:
+        raise AttachmentError("Redmine 沒有回傳 upload token")
+    logger.info(f"📎 附件已上傳: {attachment.filename} ({reader.sent} bytes, target={target.name})")
+    return {"token": token, "filename": attachment.filename, "content_type": attachment.content_type}
 
-    url = CHAT_INCOMING_URLS.get(str(channel_id), DEFAULT_INCOMING_URL)
-    if not url:
-        return 0, f"no incoming url for channel {channel_id}"
 
+def forward_attachments(attachments: Optional[list]) -> Tuple[List[Dict[str, object]], List[str]]:
+    """依序轉送附件，回傳 (uploads, 失敗說明)；單一附件失敗不影響其他附件"""
+    uploads: List[Dict[str, object]] = []
+    errors: List[str] = []
+    for attachment in (attachments or [])[:ATTACHMENT_MAX_FILES]:
+        if not has_budget(ATTACHMENT_MIN_BUDGET):
+            logger.warning(f"⏱️ 時間預算不足，略過附件: {attachment.filename}")
+            errors.append(f"{attachment.filename}: 時間預算不足，未上傳")
+            continue
+        try:
+            uploads.append(upload_attachment(attachment))
+        except Exception as e:
+            logger.error(f"❌ 附件轉送失敗 {attachment.filename}: {e}")
+            errors.append(f"{attachment.filename}: {e}")
+    return uploads, errors
+
+
+def attach_to_issue(issue_id: Optional[int], attachments: Optional[list]) -> Tuple[List[Dict[str, object]], List[str]]:
+    """
+    議題建好之後才轉送附件，再以 PUT /issues/:id.json 掛上；轉送慢或失敗都不影響議題本身。
+    議題沒建成功時不轉送。回傳 (掛上的 uploads, 失敗說明)。
+    """
+    if not attachments or not issue_id:
+        return [], []
+    uploads, errors = forward_attachments(attachments)
+    if not uploads or _shadow.get() is not None:
+        return uploads, errors
+    target = current_redmine().target
     try:
-        r = requests.post(
-            url,
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            data={"payload": json.dumps({"text": text}, ensure_ascii=False)},
-            verify=CHAT_VERIFY_TLS,
-            timeout=8,
-        )
-        return r.status_code, r.text
+        with span("redmine.attach", target=target.name, issue_id=issue_id) as sp:
+            resp = target.request(
+                "PUT", f"/issues/{issue_id}.json", "attachment", 12,
+                headers={"Content-Type": "application/json; charset=utf-8"}, data=json_dumps({"issue": {"uploads": uploads}}),
+            )
+            sp["status"] = resp.status_code
+        if resp.status_code not in (200, 204):
+            raise AttachmentError(f"掛上議題失敗 HTTP {resp.status_code}: {resp.text[:200]}")
     except Exception as e:
-        return -1, f"request failed: {e}"
+        logger.error(f"❌ 附件掛上議題 #{issue_id} 失敗: {e}")
+        return [], errors + [f"{u['filename']}: {e}" for u in uploads]
+    logger.info(f"📎 已掛上 {len(uploads)} 個附件到議題 #{issue_id}")
+    return uploads, errors
+
+
+def attachment_note(uploads: List[Dict[str, object]], errors: List[str]) -> str:
+    """回貼訊息的附件說明（沒有附件時為空字串）"""
+    lines = [f"📎 已附加 {len(uploads)} 個檔案"] if uploads else []
+    lines += [f"⚠️ 附件未上傳：{e}" for e in errors]
+    return "".join(f"\n{line}" for line in lines)
 
 
 # ----------------------------
 # Redmine：建立議題
 # ----------------------------
-def _project_identifier() -> Optional[str]:
-    if REDMINE_PROJECT_ID:
-        return REDMINE_PROJECT_ID
-    if REDMINE_PROJECT:
-        return REDMINE_PROJECT
-    return None
+PROJECT_LISTING_FIELDS = ("id", "name", "identifier")
+USER_LISTING_FIELDS = ("id", "login", "firstname", "lastname")
 
 
+@traced
 def find_redmine_user(assignee_query: str) -> Optional[int]:
     """
-    根據 ID 或姓名查詢 Redmine 使用者
+    根據 ID 或姓名查詢 Redmine 使用者（目前頻道的 Redmine；找到的結果快取 REDMINE_LOOKUP_TTL 秒）
     優先順序：1. 精確 ID 匹配 2. 姓名匹配 3. 返回 None
     """
-    if not REDMINE_URL or not REDMINE_API_KEY or not assignee_query:
+    target = current_redmine().target
+    if not target.configured or not assignee_query:
         logger.warning("缺少 Redmine 配置或查詢參數")
         return None
-    
-    headers = {"X-Redmine-API-Key": REDMINE_API_KEY}
-    logger.info(f"開始查詢 Redmine 用戶: {assignee_query}")
+    cached = target.cached("user", assignee_query)
+    if cached is not None:
+        return cached
+    user_id = _lookup_redmine_user(target, assignee_query)
+    if user_id is not None:
+        target.remember("user", assignee_query, user_id)
+    return user_id
+
+
+def _lookup_redmine_user(target: RedmineTarget, assignee_query: str) -> Optional[int]:
+    logger.info(f"開始查詢 Redmine({target.name}) 用戶: {assignee_query}")
     
     # 嘗試直接 ID 查詢
     try:
         user_id = int(assignee_query)
-        url = f"{REDMINE_URL}/users/{user_id}.json"
-        logger.info(f"嘗試用戶ID查詢: {url}")
-        resp = requests.get(url, headers=headers, verify=REDMINE_VERIFY, timeout=8)
+        path = f"/users/{user_id}.json"
+        logger.info(f"嘗試用戶ID查詢: {target.url}{path}")
+        resp = target.request("GET", path, "user_lookup", 8)
         logger.info(f"用戶ID查詢結果: 狀態={resp.status_code}")
         
         if resp.status_code == 200:
-            user_data = resp.json().get("user", {})
+            user_data = json_loads(resp.content).get("user", {})
             username = user_data.get("login", "")
             fullname = f"{user_data.get('firstname', '')} {user_data.get('lastname', '')}".strip()
             logger.info(f"找到用戶: ID={user_id}, 登入名={username}, 全名={fullname}")
@@ -241,19 +2793,20 @@ def find_redmine_user(assignee_query: str) -> Optional[int]:
             logger.warning(f"用戶ID查詢失敗: {resp.status_code} - {resp.text[:200]}")
     except ValueError:
         logger.info(f"'{assignee_query}' 不是數字，嘗試姓名查詢")
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"用戶ID查詢異常: {e}")
     
     # 嘗試姓名查詢
     try:
-        url = f"{REDMINE_URL}/users.json"
         params = {"name": assignee_query, "limit": 25}
-        logger.info(f"嘗試姓名查詢: {url} with params={params}")
-        resp = requests.get(url, headers=headers, params=params, verify=REDMINE_VERIFY, timeout=8)
+        logger.info(f"嘗試姓名查詢: {target.url}/users.json with params={params}")
+        resp = target.request("GET", "/users.json", "user_lookup", 8, params=params)
         logger.info(f"姓名查詢結果: 狀態={resp.status_code}")
         
         if resp.status_code == 200:
-            users = resp.json().get("users", [])
+            users = parse_listing(resp.content, "users", USER_LISTING_FIELDS)
             logger.info(f"找到 {len(users)} 個可能的用戶")
             
             for user in users:
@@ -278,6 +2831,8 @@ def find_redmine_user(assignee_query: str) -> Optional[int]:
             logger.warning(f"在 {len(users)} 個用戶中未找到匹配的用戶")
         else:
             logger.warning(f"姓名查詢失敗: {resp.status_code} - {resp.text[:200]}")
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"姓名查詢異常: {e}")
     
@@ -285,65 +2840,69 @@ def find_redmine_user(assignee_query: str) -> Optional[int]:
     return None
 
 
+@traced
 def find_redmine_project_id(project_name: str) -> Optional[str]:
     """
-    根據專案名稱查找 Redmine 專案ID
+    根據專案名稱查找 Redmine 專案ID（目前頻道的 Redmine；專案清單快取 REDMINE_LOOKUP_TTL 秒）
     """
-    if not REDMINE_URL or not REDMINE_API_KEY or not project_name:
-        logger.warning(f"缺少必要參數: REDMINE_URL={bool(REDMINE_URL)}, API_KEY={bool(REDMINE_API_KEY)}, project_name={project_name}")
+    target = current_redmine().target
+    if not target.configured or not project_name:
+        logger.warning(f"缺少必要參數: REDMINE_URL={bool(target.url)}, API_KEY={bool(target.api_key)}, project_name={project_name}")
         return None
     
-    headers = {"X-Redmine-API-Key": REDMINE_API_KEY}
-    url = f"{REDMINE_URL}/projects.json"
-    
     logger.info(f"🔍 開始查詢專案: {project_name}")
-    logger.info(f"🌐 API URL: {url}")
     
     try:
-        resp = requests.get(url, headers=headers, timeout=10, verify=REDMINE_VERIFY)
-        logger.info(f"📡 API 回應狀態: {resp.status_code}")
-        
-        if resp.status_code == 200:
-            data = resp.json()
-            projects = data.get("projects", [])
+        projects = target.cached("projects", "")
+        if projects is None:
+            logger.info(f"🌐 API URL: {target.url}/projects.json")
+            resp = target.request("GET", "/projects.json", "project_lookup", 10)
+            logger.info(f"📡 API 回應狀態: {resp.status_code}")
+            if resp.status_code != 200:
+                logger.error(f"❌ API 請求失敗: {resp.status_code} - {resp.text[:200]}")
+                return None
+            projects = parse_listing(resp.content, "projects", PROJECT_LISTING_FIELDS)
+            target.remember("projects", "", projects)
             logger.info(f"📊 找到 {len(projects)} 個專案")
             
             # 列出所有專案（用於調試）
             for i, project in enumerate(projects[:10]):  # 只列出前10個
                 logger.info(f"  {i+1}. 專案: '{project.get('name')}' (ID: {project.get('id')}, identifier: {project.get('identifier')})")
-            
-            # 先嘗試精確匹配名稱
-            logger.info(f"🎯 嘗試精確匹配: '{project_name}'")
-            for project in projects:
-                if project.get("name") == project_name:
-                    project_id = project.get("identifier") or str(project.get("id"))
-                    logger.info(f"✅ 找到精確匹配專案: {project_name} -> ID: {project_id}")
-                    return project_id
-            
-            # 再嘗試包含匹配（不區分大小寫）
-            logger.info(f"🔍 嘗試模糊匹配: '{project_name.lower()}'")
-            project_name_lower = project_name.lower()
-            for project in projects:
-                project_name_in_db = project.get("name", "").lower()
-                if project_name_lower in project_name_in_db:
-                    project_id = project.get("identifier") or str(project.get("id"))
-                    logger.info(f"✅ 找到相似專案: '{project.get('name')}' -> ID: {project_id}")
-                    return project_id
-                    
-            logger.warning(f"❌ 未找到匹配的專案: {project_name}")
-            return None
-        else:
-            logger.error(f"❌ API 請求失敗: {resp.status_code} - {resp.text[:200]}")
-            return None
-            
+        
+        # 先嘗試精確匹配名稱
+        logger.info(f"🎯 嘗試精確匹配: '{project_name}'")
+        for project in projects:
+            if project.get("name") == project_name:
+                project_id = project.get("identifier") or str(project.get("id"))
+                logger.info(f"✅ 找到精確匹配專案: {project_name} -> ID: {project_id}")
+                return project_id
+        
+        # 再嘗試包含匹配（不區分大小寫）
+        logger.info(f"🔍 嘗試模糊匹配: '{project_name.lower()}'")
+        project_name_lower = project_name.lower()
+        for project in projects:
+            project_name_in_db = project.get("name", "").lower()
+            if project_name_lower in project_name_in_db:
+                project_id = project.get("identifier") or str(project.get("id"))
+                logger.info(f"✅ 找到相似專案: '{project.get('name')}' -> ID: {project_id}")
+                return project_id
+                
+        logger.warning(f"❌ 未找到匹配的專案: {project_name}")
+        return None
+
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"❌ 查詢專案時發生錯誤: {e}")
         return None
 
 
-def create_redmine_issue(subject: str, description: str, assignee_query: str = None, parent_issue_id: int = None, due_date: str = None, project_name: str = None) -> Tuple[int, str, Optional[int]]:
-    if not REDMINE_URL or not REDMINE_API_KEY:
-        return 0, "REDMINE_URL or REDMINE_API_KEY not set", None
+@traced
+def create_redmine_issue(subject: str, description: str, assignee_query: str = None, parent_issue_id: int = None, due_date: str = None, project_name: str = None, stage: str = "issue", priority: str = None, custom_fields: Dict[str, str] = None) -> Tuple[int, str, Optional[int]]:
+    route = current_redmine()
+    target = route.target
+    if not target.configured:
+        return 0, f"REDMINE_URL or REDMINE_API_KEY not set (target={target.name})", None
 
     issue: Dict[str, object] = {
         "subject": (subject or "(no subject)")[:255],
@@ -359,24 +2918,33 @@ def create_redmine_issue(subject: str, description: str, assignee_query: str = N
             logger.info(f"使用指定專案: {project_name} (ID: {project_id})")
         else:
             logger.warning(f"找不到專案 '{project_name}'，使用預設專案")
-            pid = _project_identifier()
-            if pid:
-                issue["project_id"] = pid
+            if route.project:
+                issue["project_id"] = route.project
     else:
-        # 使用預設專案
-        pid = _project_identifier()
-        if pid:
-            issue["project_id"] = pid
-    if REDMINE_TRACKER_ID:
-        try:
-            issue["tracker_id"] = int(REDMINE_TRACKER_ID)
-        except ValueError:
-            pass
-    if REDMINE_STATUS_ID:
-        try:
-            issue["status_id"] = int(REDMINE_STATUS_ID)
-        except ValueError:
-            pass
+        # 使用預設專案（依頻道：REDMINE_PROJECT_IDS，否則 REDMINE_PROJECT_ID / REDMINE_PROJECT）
+        if route.project:
+            issue["project_id"] = route.project
+    # tracker / 狀態 / 優先權：設定或指令可用名稱，從本地快取解析成 ID
+    metadata = target.metadata
+    tracker_id = metadata.resolve_id("trackers", route.tracker_ref)
+    if tracker_id:
+        issue["tracker_id"] = tracker_id
+    status_id = metadata.resolve_id("statuses", route.status_ref)
+    if status_id:
+        issue["status_id"] = status_id
+    priority_id = metadata.resolve_id("priorities", parse_ref(priority) if priority else route.priority_ref)
+    if priority_id:
+        issue["priority_id"] = priority_id
+
+    # 自訂欄位（名稱 -> ID）
+    if custom_fields:
+        values = []
+        for name, value in custom_fields.items():
+            field = metadata.custom_field(name)
+            if field:
+                values.append({"id": field["id"], "value": value})
+        if values:
+            issue["custom_fields"] = values
     
     # 設定被指派者
     if assignee_query:
@@ -392,20 +2960,25 @@ def create_redmine_issue(subject: str, description: str, assignee_query: str = N
     if due_date:
         issue["due_date"] = due_date
 
-    url = f"{REDMINE_URL}/issues.json"
-    headers = {
-        "X-Redmine-API-Key": REDMINE_API_KEY,
-        "Content-Type": "application/json; charset=utf-8",
-    }
+    # shadow 模式：只記錄要送出的內容，回傳假的議題 ID 讓後續流程（子議題）照常規劃
+    shadow = _shadow.get()
+    if shadow is not None:
+        fake_id = shadow.record_issue(stage, issue, target.name)
+        return 201, json_dumps_str({"issue": {"id": fake_id}, "shadow": True}), fake_id
 
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+
+    t0 = time.monotonic()
     try:
-        resp = requests.post(url, headers=headers, json={"issue": issue}, verify=REDMINE_VERIFY, timeout=12)
+        with span("redmine.post_issue", stage=stage, target=target.name) as sp:
+            resp = target.request("POST", "/issues.json", stage, 12, headers=headers, data=json_dumps({"issue": issue}))
+            sp["status"] = resp.status_code
         
         # 詳細解析返回的議題 ID
         issue_id = None
         if resp.status_code in (200, 201):
             try:
-                result = resp.json()
+                result = json_loads(resp.content)
                 issue_id = result.get("issue", {}).get("id")
                 logger.info(f"Redmine API 回應解析: 狀態={resp.status_code}, 議題ID={issue_id}")
                 if not issue_id:
@@ -416,12 +2989,18 @@ def create_redmine_issue(subject: str, description: str, assignee_query: str = N
         else:
             logger.error(f"Redmine API 回應錯誤: 狀態={resp.status_code}, 內容={resp.text[:500]}")
         
+        note_issue(stage, resp.status_code, issue_id, (time.monotonic() - t0) * 1000)
         return resp.status_code, resp.text, issue_id
+    except DeadlineExceeded:
+        note_issue(stage, 0, None, (time.monotonic() - t0) * 1000)
+        raise
     except Exception as e:
         logger.error(f"調用 Redmine API 時發生異常: {e}")
+        note_issue(stage, -1, None, (time.monotonic() - t0) * 1000)
         return -1, f"request failed: {e}", None
 
 
+@traced
 def create_business_lead_subtasks(parent_issue_id: int, creation_date: datetime, assignee_query: str = None) -> List[Tuple[int, str]]:
     """建立新商機的三個子議題（依序進行）"""
     subtasks = [
@@ -446,6 +3025,15 @@ def create_business_lead_subtasks(parent_issue_id: int, creation_date: datetime,
     logger.info(f"開始建立 {len(subtasks)} 個子議題，父議題ID: {parent_issue_id}")
     
     for i, subtask in enumerate(subtasks, 1):
+        if not has_budget(MIN_CALL_TIMEOUT):
+            # 時間預算用完，剩下的子議題不再嘗試
+            logger.warning(f"⏱️ 時間預算不足，略過子議題 {i}: {subtask['subject']}")
+            d = _deadline.get()
+            if d:
+                d.mark_incomplete("subtask")
+            note_issue("subtask", 0)
+            results.append((0, f"{subtask['subject']}: 時間預算不足，未建立"))
+            continue
         try:
             due_date = calculate_business_days(creation_date, subtask["due_days_from_start"])
             logger.info(f"建立子議題 {i}: {subtask['subject']}，到期日: {due_date}")
@@ -455,7 +3043,8 @@ def create_business_lead_subtasks(parent_issue_id: int, creation_date: datetime,
                 description=subtask["description"],
                 assignee_query=assignee_query,
                 parent_issue_id=parent_issue_id,
-                due_date=due_date
+                due_date=due_date,
+                stage="subtask"
             )
             
             if 200 <= status_code < 300:
@@ -465,6 +3054,14 @@ def create_business_lead_subtasks(parent_issue_id: int, creation_date: datetime,
                 logger.error(f"子議題 {i} 建立失敗: {status_code} - {response[:200]}")
                 results.append((status_code, f"{subtask['subject']}: 建立失敗 ({status_code})"))
                 
+        except DeadlineExceeded as e:
+            # 預算用完：這個與剩下的子議題都不再嘗試（主議題已建立，回應照常送出）
+            logger.warning(f"⏱️ 建立子議題 {i} 時預算用完: {e}")
+            for skipped in subtasks[i - 1:]:
+                if skipped is not subtask:
+                    note_issue("subtask", 0)
+                results.append((0, f"{skipped['subject']}: 時間預算不足，未建立"))
+            break
         except Exception as e:
             logger.error(f"建立子議題 {i} 時發生異常: {e}")
             results.append((500, f"{subtask['subject']}: 異常錯誤 - {str(e)}"))
@@ -472,7 +3069,8 @@ def create_business_lead_subtasks(parent_issue_id: int, creation_date: datetime,
     return results
 
 
-def handle_new_task(task_params: Dict[str, str], form: Dict[str, str], channel_id: str) -> JSONResponse:
+@traced
+def handle_new_task(task_params: Dict[str, str], form: Dict[str, str], channel_id: str, attachments: Optional[list] = None) -> FastJSONResponse:
     """處理新任務請求"""
     try:
         # 從參數中提取資訊
@@ -481,6 +3079,8 @@ def handle_new_task(task_params: Dict[str, str], form: Dict[str, str], channel_i
         assignee = task_params.get('assignee', '')
         start_date = task_params.get('start_date', '')
         due_date = task_params.get('due_date', '')
+        priority_field, custom_fields = extract_issue_fields(form.get('text', ''))
+        priority = task_params.get('priority') or priority_field or ''
         
         # 日期邏輯處理
         if start_date and due_date:
@@ -521,6 +3121,10 @@ def handle_new_task(task_params: Dict[str, str], form: Dict[str, str], channel_i
             description_lines.append(f"**開始日期**: {start_date}")
         if due_date:
             description_lines.append(f"**到期日期**: {due_date}")
+        if priority:
+            description_lines.append(f"**優先權**: {priority}")
+        for name, value in custom_fields.items():
+            description_lines.append(f"**{name}**: {value}")
             
         description_lines.append(f"**完整指令**: {' '.join(f'{k}:{v}' for k, v in task_params.items())}")
         
@@ -529,7 +3133,10 @@ def handle_new_task(task_params: Dict[str, str], form: Dict[str, str], channel_i
         logger.info(f"🆕 準備建立新任務: {subject[:30]}, project={project_name}, assignee={assignee}, due_date={due_date}")
         
         # 建立 Redmine 議題（傳入專案名稱）
-        r_code, r_body, issue_id = create_redmine_issue(subject, description, assignee, due_date=due_date, project_name=project_name)
+        r_code, r_body, issue_id = create_redmine_issue(subject, description, assignee, due_date=due_date, project_name=project_name, priority=priority, custom_fields=custom_fields)
+
+        # 議題建好後再轉送附件並掛上
+        uploads, attachment_errors = attach_to_issue(issue_id if 200 <= r_code < 300 else None, attachments)
         
         # 準備回應訊息
         if 200 <= r_code < 300 and issue_id:
@@ -538,24 +3145,37 @@ def handle_new_task(task_params: Dict[str, str], form: Dict[str, str], channel_i
                 ack_msg += f"\n👤 指派: {assignee}"
             if due_date:
                 ack_msg += f"\n📅 到期: {due_date}"
+            ack_msg += attachment_note(uploads, attachment_errors)
             logger.info(f"✅ 新任務建立成功: ID={issue_id}")
         else:
             ack_msg = f"❌ 新任務建立失敗 (HTTP {r_code})"
             logger.error(f"❌ 新任務建立失敗: {r_code} - {r_body[:200]}")
         
-        # 回貼到頻道
-        logger.info(f"📤 準備回報到頻道 {channel_id}: {ack_msg[:50]}...")
-        status_code, result = send_chat_message(ack_msg, channel_id)
-        logger.info(f"📨 Chat 訊息發送結果: status={status_code}, result={result}")
+        # 回貼到頻道；預算不夠就延後到回應送出後
+        deferred: List[str] = []
+        background = None
+        if has_budget(ACK_MIN_BUDGET):
+            logger.info(f"📤 準備回報到頻道 {channel_id}: {ack_msg[:50]}...")
+            status_code, result = send_chat_message(ack_msg, channel_id)
+            logger.info(f"📨 Chat 訊息發送結果: status={status_code}, result={result}")
+        else:
+            deferred.append("chat_ack")
+            background = BackgroundTask(run_deferred, send_chat_message, ack_msg, channel_id)
         
-        return JSONResponse({
+        return FastJSONResponse({
             "ok": True,
             "task_type": "new_task",
             "issue_id": issue_id,
             "status_code": r_code,
-            "message": ack_msg
-        })
+            "message": ack_msg,
+            "attachments": [u["filename"] for u in uploads],
+            "attachment_errors": attachment_errors,
+            "deferred": deferred,
+            "incomplete": incomplete_stages(),
+        }, background=background)
         
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         error_msg = f"❌ 處理新任務時發生錯誤: {str(e)}"
         logger.error(error_msg)
@@ -565,10 +3185,11 @@ def handle_new_task(task_params: Dict[str, str], form: Dict[str, str], channel_i
         status_code, result = send_chat_message(error_msg, channel_id)
         logger.info(f"📨 錯誤訊息發送結果: status={status_code}, result={result}")
             
-        return JSONResponse({
+        return FastJSONResponse({
             "ok": False, 
             "error": str(e),
-            "message": error_msg
+            "message": error_msg,
+            "incomplete": incomplete_stages(),
         })
 
 
@@ -591,12 +3212,46 @@ async def n8n_webhook(request: Request):
         "command": "新任務 專案:XXX 標題:YYY 指派:ZZZ 開始:YYYY-MM-DD 完成:YYYY-MM-DD",
         "channel_id": "196",  // 可選，預設為196
         "username": "n8n",   // 可選，預設為n8n
-        "user_id": "system"  // 可選，預設為system
+        "user_id": "system",  // 可選，預設為system
+        "attachments": [{"url": "https://nas/…/quote.pdf", "filename": "quote.pdf"}]  // 可選，檔案 URL
     }
+    也可用 multipart/form-data：上面的欄位放在 form 欄位，檔案直接上傳（最多 ATTACHMENT_MAX_FILES 個），
+    附件會串流轉送到 Redmine 並掛在建立的議題上。
     """
+    start_deadline(route_deadline("n8n_webhook"))
+    pin_routing()
+    mark_shadow_request(request)
+    form = None
     try:
-        # 解析 JSON 請求
-        data = await request.json()
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            # 先看 Content-Length 擋掉過大的上傳；檔案由 Starlette 分塊解析（超過 1MB 落地成暫存檔）
+            length = request.headers.get("content-length", "")
+            limit = ATTACHMENT_MAX_BYTES * ATTACHMENT_MAX_FILES + 64 * 1024
+            if not length.isdigit():
+                return FastJSONResponse({"ok": False, "error": "上傳檔案需帶 Content-Length"}, status_code=411)
+            if int(length) > limit:
+                return FastJSONResponse({"ok": False, "error": f"上傳內容超過 {limit} bytes 上限"}, status_code=413)
+            try:
+                form = await request.form(max_files=ATTACHMENT_MAX_FILES)
+            except Exception as e:
+                return FastJSONResponse({"ok": False, "error": f"無法解析上傳內容: {e}"}, status_code=400)
+            data = {k: v for k, v in form.multi_items() if isinstance(v, str)}
+            attachments = [UploadedAttachment(v) for _, v in form.multi_items() if not isinstance(v, str)] if ATTACHMENTS else []
+        else:
+            # 解析 JSON 請求
+            body = await request.body()
+            remember_mirror_source(request, body)
+            data = json_loads(body)
+            urls = [(a, "") if isinstance(a, str) else (str(a.get("url") or ""), str(a.get("filename") or ""))
+                    for a in data.get("attachments") or [] if isinstance(a, (str, dict)) and a]
+            if data.get("file_url"):
+                urls.append((str(data["file_url"]), ""))
+            if len(urls) > ATTACHMENT_MAX_FILES:
+                return FastJSONResponse({"ok": False, "error": f"附件最多 {ATTACHMENT_MAX_FILES} 個"}, status_code=400)
+            denied = [_safe_url(url) for url, _ in urls if not attachment_url_allowed(url)]
+            if denied:
+                return FastJSONResponse({"ok": False, "error": "附件來源主機不在 ATTACHMENT_URL_HOSTS", "denied": denied}, status_code=400)
+            attachments = [UrlAttachment(url, filename) for url, filename in urls] if ATTACHMENTS else []
         command = data.get("command", "")
         channel_id = str(data.get("channel_id", "196"))
         username = data.get("username", "n8n")
@@ -605,7 +3260,7 @@ async def n8n_webhook(request: Request):
         logger.info(f"🔗 n8n webhook 請求: command={command[:50]}, channel={channel_id}")
         
         if not command:
-            return JSONResponse({
+            return FastJSONResponse({
                 "ok": False,
                 "error": "缺少 command 參數"
             }, status_code=400)
@@ -623,33 +3278,42 @@ async def n8n_webhook(request: Request):
         # 檢查是否為新任務格式
         task_params = parse_task_params(command)
         if task_params:
-            # 處理新任務
+            # 處理新任務（先過限流，再排進建單流程）
             logger.info(f"🤖 n8n -> 新任務: {task_params}")
-            return await handle_new_task_for_n8n(task_params, mock_form, channel_id)
+            try:
+                admit_request("n8n_webhook", channel_id, str(user_id))
+                async with pipeline_gate(channel_id).slot():
+                    return await run_pipeline("n8n_webhook", channel_id, handle_new_task_for_n8n, task_params, mock_form, channel_id, attachments, user_id=str(user_id))
+            except AdmissionRejected as e:
+                return await rejected_response(e, channel_id, route="n8n_webhook")
         else:
             # 檢查是否為新商機格式
             if is_new_business_keyword(command):
                 logger.info(f"🤖 n8n -> 新商機: {command[:50]}")
                 # 這裡可以擴展支援新商機，目前先返回不支援
-                return JSONResponse({
+                return FastJSONResponse({
                     "ok": False,
                     "error": "n8n 端點目前只支援新任務格式，不支援新商機"
                 }, status_code=400)
             else:
-                return JSONResponse({
+                return FastJSONResponse({
                     "ok": False,
                     "error": "無效的指令格式，請使用：新任務 專案:XXX 標題:YYY 指派:ZZZ 開始:YYYY-MM-DD 完成:YYYY-MM-DD"
                 }, status_code=400)
                 
     except Exception as e:
         logger.error(f"❌ n8n webhook 處理錯誤: {e}")
-        return JSONResponse({
+        return FastJSONResponse({
             "ok": False,
             "error": f"處理請求時發生錯誤: {str(e)}"
         }, status_code=500)
+    finally:
+        if form is not None:
+            await form.close()  # 刪掉上傳的暫存檔
 
 
-async def handle_new_task_for_n8n(task_params: Dict[str, str], form: Dict[str, str], channel_id: str) -> JSONResponse:
+@traced
+def handle_new_task_for_n8n(task_params: Dict[str, str], form: Dict[str, str], channel_id: str, attachments: Optional[list] = None) -> FastJSONResponse:
     """專為 n8n 設計的新任務處理函數（不發送 Chat 訊息）"""
     try:
         # 從參數中提取資訊
@@ -658,6 +3322,8 @@ async def handle_new_task_for_n8n(task_params: Dict[str, str], form: Dict[str, s
         assignee = task_params.get('assignee', '')
         start_date = task_params.get('start_date', '')
         due_date = task_params.get('due_date', '')
+        priority_field, custom_fields = extract_issue_fields(form.get('text', ''))
+        priority = task_params.get('priority') or priority_field or ''
         
         # 日期邏輯處理（與原函數相同）
         if start_date and due_date:
@@ -694,6 +3360,10 @@ async def handle_new_task_for_n8n(task_params: Dict[str, str], form: Dict[str, s
             description_lines.append(f"**開始日期**: {start_date}")
         if due_date:
             description_lines.append(f"**到期日期**: {due_date}")
+        if priority:
+            description_lines.append(f"**優先權**: {priority}")
+        for name, value in custom_fields.items():
+            description_lines.append(f"**{name}**: {value}")
             
         description_lines.append(f"**完整指令**: {' '.join(f'{k}:{v}' for k, v in task_params.items())}")
         
@@ -702,14 +3372,18 @@ async def handle_new_task_for_n8n(task_params: Dict[str, str], form: Dict[str, s
         logger.info(f"🤖 準備建立 n8n 任務: {subject[:30]}, project={project_name}, assignee={assignee}, due_date={due_date}")
         
         # 建立 Redmine 議題
-        r_code, r_body, issue_id = create_redmine_issue(subject, description, assignee, due_date=due_date, project_name=project_name)
+        r_code, r_body, issue_id = create_redmine_issue(subject, description, assignee, due_date=due_date, project_name=project_name, priority=priority, custom_fields=custom_fields)
+
+        # 議題建好後再轉送附件並掛上
+        uploads, attachment_errors = attach_to_issue(issue_id if 200 <= r_code < 300 else None, attachments)
         
         # 準備回應（不發送 Chat 訊息，直接返回結果給 n8n）
         if 200 <= r_code < 300 and issue_id:
             result_msg = f"已建立新任務 (ID: {issue_id})"
             logger.info(f"✅ n8n 任務建立成功: ID={issue_id}")
+            redmine_base = current_redmine().target.url
             
-            return JSONResponse({
+            return FastJSONResponse({
                 "ok": True,
                 "task_type": "new_task",
                 "issue_id": issue_id,
@@ -720,24 +3394,31 @@ async def handle_new_task_for_n8n(task_params: Dict[str, str], form: Dict[str, s
                 "due_date": due_date,
                 "status_code": r_code,
                 "message": result_msg,
-                "redmine_url": f"{REDMINE_URL}/issues/{issue_id}" if REDMINE_URL else None
+                "redmine_url": f"{redmine_base}/issues/{issue_id}" if redmine_base else None,
+                "attachments": [u["filename"] for u in uploads],
+                "attachment_errors": attachment_errors,
+                "incomplete": incomplete_stages(),
             })
         else:
             error_msg = f"任務建立失敗 (HTTP {r_code})"
             logger.error(f"❌ n8n 任務建立失敗: {r_code} - {r_body[:200]}")
             
-            return JSONResponse({
+            return FastJSONResponse({
                 "ok": False,
                 "error": error_msg,
                 "status_code": r_code,
-                "response": r_body[:200]
+                "response": r_body[:200],
+                "attachment_errors": attachment_errors,
+                "incomplete": incomplete_stages(),
             }, status_code=422)
         
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         error_msg = f"處理 n8n 任務時發生錯誤: {str(e)}"
         logger.error(error_msg)
         
-        return JSONResponse({
+        return FastJSONResponse({
             "ok": False, 
             "error": error_msg
         }, status_code=500)
@@ -755,10 +3436,9 @@ async def test_webhook(request: Request):
     test_channel_name = form.get("channel_name", "test_channel")
     
     logger.info(f"🧪 測試模式: text='{test_text}', channel_id={test_channel_id}")
+    _redmine.set(redmine_for(test_channel_id))
     
     # 模擬完整的 webhook 處理流程（跳過 token 驗證）
-    import re
-    
     # 解析指派者
     assignee_query = None
     text_for_subject = test_text
@@ -825,31 +3505,84 @@ async def chat_webhook(request: Request):
       1) 驗證 token（per-channel 或單一）
       2) 限制頻道（若 CHAT_CHANNEL_IDS 有設定）
       3) 關鍵字判斷（KEYWORD）
-      4) 建立 Redmine 議題
-      5) 依 channel_id 回貼到對應頻道（Incoming Webhook）
+      4) 流量控制（頻道 / 使用者 / 路由限流、同時建單上限）
+      5) 建立 Redmine 議題（主議題建好後，file_url 附件串流上傳到 /uploads.json 再掛上）
+      6) 依 channel_id 回貼到對應頻道（Incoming Webhook）
+    整個流程共用 ROUTE_DEADLINES 的時間預算；子議題與回貼在預算不足時延後到回應送出後。
     """
-    form = dict(await request.form())
+    start_deadline(route_deadline("chat_webhook"))
+    mark_shadow_request(request)
+    routing = pin_routing()  # 整個請求（含 threadpool、回應後的延後工作）用同一份路由表，中途熱更新也不受影響
 
-    channel_id = (form.get("channel_id") or "").strip()
-    text_raw = (form.get("text") or "").strip()
-    token_in = (form.get("token") or "").strip()
+    # 快速路徑：先從原始 body 只取 channel_id / token / text 做過濾，
+    # 大部分訊息沒有關鍵字，在這裡就直接略過（不做完整 form 解析、不寫 INFO log）
+    if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+        body = await request.body()
+        remember_mirror_source(request, body)
+        head = scan_urlencoded(body, WEBHOOK_FAST_FIELDS)
+    else:
+        head = dict(await request.form())
 
-    # 記錄收到的欄位（不印 token 值）
-    log_keys = ",".join(sorted(form.keys()))
-    logger.info(f"Webhook keys={log_keys} | channel_id={channel_id} | has_text={bool(text_raw)}")
+    channel_id = (head.get("channel_id") or "").strip()
+    text_raw = (head.get("text") or "").strip()
+    token_in = (head.get("token") or "").strip()
 
     # 限制允許的頻道
-    if CHAT_CHANNEL_IDS and channel_id not in CHAT_CHANNEL_IDS:
+    if routing.channel_ids and channel_id not in routing.channel_ids:
         raise HTTPException(status_code=403, detail="Channel not allowed")
 
     # 驗證 Outgoing token
-    if not verify_outgoing_token(channel_id, token_in):
+    if not verify_outgoing_token(channel_id, token_in, routing):
         raise HTTPException(status_code=403, detail="Invalid token for channel")
 
     # 關鍵字過濾（區分新商機和新任務）
     if not text_raw:
-        return JSONResponse({"ok": True, "skipped": True, "reason": "empty text"})
-        
+        return FastJSONResponse({"ok": True, "skipped": True, "reason": "empty text"})
+    if routing.trigger_matcher is None or not routing.trigger_matcher.search(text_raw):
+        return FastJSONResponse({"ok": True, "skipped": True, "reason": "keyword not found"})
+
+    # 命中關鍵字才做完整 form 解析（body 已快取，不會重讀）
+    form = dict(await request.form())
+
+    # 同一則訊息可能已由輪詢（CHAT_POLL）處理過，或是 Chat 重送
+    post_id = form.get("post_id")
+    if not POST_LEDGER.claim(channel_id, post_id):
+        return FastJSONResponse({"ok": True, "skipped": True, "reason": "duplicate post"})
+
+    # 沒建出議題就結束（被限流、逾時 504、Redmine 錯誤、流程丟出例外）要釋放 post_id，
+    # 輪詢或 Chat 重送時才會再處理，不會就此漏單
+    try:
+        resp = await process_chat_message("chat_webhook", form, channel_id, text_raw)
+        if not issue_created(resp):
+            POST_LEDGER.release(channel_id, post_id)
+        return resp
+    except AdmissionRejected as e:
+        POST_LEDGER.release(channel_id, post_id)
+        return await rejected_response(e, channel_id, notify=not is_shadow("chat_webhook", channel_id), route="chat_webhook")
+    except Exception:
+        POST_LEDGER.release(channel_id, post_id)
+        raise
+
+
+def issue_created(resp) -> bool:
+    """建單流程的回應是否代表議題已建立（或訊息本來就不需建單）；否則 post_id 要釋放讓之後重試"""
+    if resp.status_code >= 300:
+        return False
+    body = json_loads(resp.body)
+    if body.get("skipped"):
+        return True
+    return bool(body.get("ok") and (body.get("parent_issue_id") or body.get("issue_id")))
+
+
+async def process_chat_message(route: str, form: Dict[str, str], channel_id: str, text_raw: str) -> FastJSONResponse:
+    """
+    已通過頻道 / token / 關鍵字過濾的 Chat 訊息：判斷新任務或新商機、解析指派者、過流量控制後建單。
+    webhook（chat_webhook）與歷史輪詢（chat_poll）共用；被限流時丟 AdmissionRejected 由呼叫端處理。
+    """
+    # 記錄收到的欄位（不印 token 值）
+    log_keys = ",".join(sorted(form.keys()))
+    logger.info(f"Webhook keys={log_keys} | channel_id={channel_id} | has_text={bool(text_raw)}")
+
     # 檢查是否為新任務格式
     task_params = parse_task_params(text_raw)
     is_new_task = task_params is not None
@@ -859,13 +3592,12 @@ async def chat_webhook(request: Request):
     
     # 如果兩種格式都不符合，跳過處理
     if not is_new_task and not is_new_business:
-        return JSONResponse({"ok": True, "skipped": True, "reason": "keyword not found"})
+        return FastJSONResponse({"ok": True, "skipped": True, "reason": "keyword not found"})
 
     # 解析指派者（支援多種格式）
     assignee_query = None
     text_for_subject = text_raw
-    import re
-    
+
     # 1. 優先檢查 @ 符號格式
     if "@" in text_raw:
         # 匹配 @後面的內容
@@ -905,14 +3637,27 @@ async def chat_webhook(request: Request):
                 # 不移除這部分文字，因為可能是描述的一部分
                 break
 
-    # 根據類型決定處理流程
-    if is_new_task:
-        # 新任務處理流程
-        logger.info(f"🆕 偵測到新任務請求，參數: {task_params}")
-        return handle_new_task(task_params, form, channel_id)
-    else:
-        # 新商機處理流程（保持原有邏輯不變）
+    # 流量控制：路由 / 頻道 / 使用者限流，以及同時建單數量上限（被擋時丟 AdmissionRejected）
+    user_id = (form.get("user_id") or "").strip()
+    admit_request(route, channel_id, user_id)
+    attachments = chat_attachments(form)
+    async with pipeline_gate(channel_id).slot():
+        # 根據類型決定處理流程（Redmine / Chat 呼叫是同步的，丟到 threadpool 執行）
+        if is_new_task:
+            # 新任務處理流程
+            logger.info(f"🆕 偵測到新任務請求，參數: {task_params}")
+            return await run_pipeline(route, channel_id, handle_new_task, task_params, form, channel_id, attachments, user_id=user_id)
+        # 新商機處理流程
         logger.info(f"💼 偵測到新商機請求")
+        return await run_pipeline(route, channel_id, handle_new_business, form, channel_id, text_raw, text_for_subject, assignee_query, attachments, user_id=user_id)
+
+
+@traced
+def handle_new_business(form: Dict[str, str], channel_id: str, text_raw: str, text_for_subject: str, assignee_query: Optional[str], attachments: Optional[list] = None) -> FastJSONResponse:
+    """處理新商機請求：建立主議題（含附件）+ 三個子議題，並回貼結果到頻道"""
+    # 優先權 / 自訂欄位（例：優先:高 來源:展會），從標題中移除這些參數
+    priority, custom_fields = extract_issue_fields(text_raw)
+    text_for_subject = strip_issue_fields(text_for_subject, priority, custom_fields)
 
     # 建 Redmine 主議題內容（新商機用）
     subject = text_for_subject[:120] if text_for_subject else text_raw[:120]
@@ -920,6 +3665,8 @@ async def chat_webhook(request: Request):
         f"**來源頻道**: {form.get('channel_name','')} (id={channel_id})",
         f"**使用者**: {form.get('username','')} (id={form.get('user_id','')})",
         f"**指派者**: {assignee_query}" if assignee_query else "",
+        f"**優先權**: {priority}" if priority else "",
+        *[f"**{name}**: {value}" for name, value in custom_fields.items()],
         f"**原始文字**:\n{text_raw}",
     ]
     description = "\n\n".join([line for line in description_lines if line])
@@ -928,12 +3675,56 @@ async def chat_webhook(request: Request):
     creation_time = datetime.now()
     main_issue_due_date = calculate_business_days(creation_time, 7)
     logger.info(f"準備建立主議題: subject={subject[:50]}, assignee={assignee_query}, due_date={main_issue_due_date}")
-    
-    r_code, r_body, parent_issue_id = create_redmine_issue(subject, description, assignee_query, due_date=main_issue_due_date)
+
+    r_code, r_body, parent_issue_id = create_redmine_issue(subject, description, assignee_query, due_date=main_issue_due_date, stage="parent_issue", priority=priority, custom_fields=custom_fields)
     logger.info(f"主議題建立結果: status={r_code}, id={parent_issue_id}")
     logger.info(f"主議題回應內容: {r_body[:500]}")
 
-    # 如果主議題建立成功，建立子議題
+    # 附件（報價單、規格書等）在主議題建好後才串流上傳並掛上，慢或失敗都不影響主議題
+    uploads, attachment_errors = attach_to_issue(parent_issue_id if 200 <= r_code < 300 else None, attachments)
+    note = attachment_note(uploads, attachment_errors)
+
+    # 如果主議題建立成功，建立子議題；剩餘預算不夠時改到回應送出後再建（連同回貼）
+    if 200 <= r_code < 300 and parent_issue_id and not has_budget(SUBTASK_MIN_BUDGET):
+        logger.warning(f"⏱️ 剩餘時間預算不足，子議題與回貼改為延後處理，父議題ID: {parent_issue_id}")
+        return FastJSONResponse({
+            "ok": True,
+            "redmine_status": r_code,
+            "parent_issue_id": parent_issue_id,
+            "subtasks_created": 0,
+            "attachments": [u["filename"] for u in uploads],
+            "attachment_errors": attachment_errors,
+            "deferred": ["subtasks", "chat_ack"],
+            "incomplete": incomplete_stages(),
+        }, background=BackgroundTask(run_deferred, finish_business_lead, r_code, parent_issue_id, creation_time, assignee_query, channel_id, note))
+
+    subtask_results = create_lead_subtasks_logged(r_code, r_body, parent_issue_id, creation_time, assignee_query)
+    ack_msg = business_ack_message(r_code, subtask_results) + note
+
+    # 回貼訊息（依頻道對應 URL）；預算不夠就延後送出
+    deferred: List[str] = []
+    background = None
+    if has_budget(ACK_MIN_BUDGET):
+        c_status, c_body = send_chat_message(ack_msg, channel_id)
+        logger.info(f"Chat ack status={c_status} body={c_body}")
+    else:
+        deferred.append("chat_ack")
+        background = BackgroundTask(run_deferred, send_chat_message, ack_msg, channel_id)
+
+    return FastJSONResponse({
+        "ok": True, 
+        "redmine_status": r_code,
+        "parent_issue_id": parent_issue_id,
+        "subtasks_created": len([r for r in subtask_results if 200 <= r[0] < 300]),
+        "attachments": [u["filename"] for u in uploads],
+        "attachment_errors": attachment_errors,
+        "deferred": deferred,
+        "incomplete": incomplete_stages(),
+    }, background=background)
+
+
+def create_lead_subtasks_logged(r_code: int, r_body: str, parent_issue_id: Optional[int], creation_time: datetime, assignee_query: Optional[str]) -> List[Tuple[int, str]]:
+    """主議題建立成功時建立三個子議題，並記錄每個子議題的結果"""
     subtask_results = []
     if 200 <= r_code < 300:
         if parent_issue_id:
@@ -957,31 +3748,429 @@ async def chat_webhook(request: Request):
             logger.warning(f"主議題回應內容: {r_body}")
     else:
         logger.error(f"❌ 主議題建立失敗，狀態碼: {r_code}，跳過子議題建立")
+    return subtask_results
 
-    # 準備回貼訊息
+
+def business_ack_message(r_code: int, subtask_results: List[Tuple[int, str]]) -> str:
+    """新商機回貼訊息"""
     if 200 <= r_code < 300:
         success_subtasks = sum(1 for code, _ in subtask_results if 200 <= code < 300)
         total_subtasks = len(subtask_results)
         if success_subtasks == total_subtasks:
-            ack_msg = f"✅ 已建立 Redmine 主議題及 {success_subtasks} 個子議題"
-        else:
-            ack_msg = f"✅ 已建立 Redmine 主議題，子議題 {success_subtasks}/{total_subtasks} 成功"
-    else:
-        ack_msg = f"❌ 建議題失敗（HTTP {r_code}）"
+            return f"✅ 已建立 Redmine 主議題及 {success_subtasks} 個子議題"
+        return f"✅ 已建立 Redmine 主議題，子議題 {success_subtasks}/{total_subtasks} 成功"
+    return f"❌ 建議題失敗（HTTP {r_code}）"
 
-    # 回貼訊息（依頻道對應 URL）
-    c_status, c_body = send_chat_message(ack_msg, channel_id)
-    logger.info(f"Chat ack status={c_status} body={c_body}")
 
-    return JSONResponse({
-        "ok": True, 
-        "redmine_status": r_code,
-        "parent_issue_id": parent_issue_id,
-        "subtasks_created": len([r for r in subtask_results if 200 <= r[0] < 300])
-    })
+def finish_business_lead(r_code: int, parent_issue_id: int, creation_time: datetime, assignee_query: Optional[str], channel_id: str, note: str = "") -> None:
+    """延後路徑：回應送出後才建立子議題並回貼結果"""
+    subtask_results = create_lead_subtasks_logged(r_code, "", parent_issue_id, creation_time, assignee_query)
+    c_status, c_body = send_chat_message(business_ack_message(r_code, subtask_results) + note, channel_id)
+    logger.info(f"Chat ack (deferred) status={c_status} body={c_body}")
+
+
+# ----------------------------
+# Chat 歷史輪詢（補讀 webhook 漏掉的訊息）
+# ----------------------------
+class RecentReplies:
+    """
+    最近回貼過的 (頻道, 內容)。輪詢時 bot 的 creator_id 沒設定（或 Chat 沒標 is_bot）也能認出自己的回貼，
+    避免回貼裡的關鍵字讓自己觸發自己；只比對完全相同的內容，使用者的訊息不會被誤擋。
+    send_chat_message 在 threadpool 寫、輪詢在 event loop 讀，要加鎖。
+    """
+
+    def __init__(self, max_size: int = 500):
+        self.max_size = max_size
+        self._texts: "OrderedDict[Tuple[str, str], None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, channel_id: str, text: str) -> None:
+        with self._lock:
+            self._texts[(str(channel_id), text.strip())] = None
+            if len(self._texts) > self.max_size:
+                self._texts.popitem(last=False)
+
+    def __contains__(self, item: Tuple[str, str]) -> bool:
+        channel_id, text = item
+        with self._lock:
+            return (str(channel_id), text.strip()) in self._texts
+
+
+RECENT_REPLIES = RecentReplies()
+
+
+def is_own_post(channel_id: str, post: Dict[str, object], text: str) -> bool:
+    """本服務（或其他 bot）的貼文：依 creator_id / bot 標記判斷，最後再比對最近回貼的內容"""
+    creator = str(post.get("creator_id") or post.get("user_id") or "")
+    if creator in CHAT_BOT_USER_IDS or creator in CHAT_POLL_IGNORE_USERS:
+        return True
+    if post.get("is_bot") or post.get("bot_id"):
+        return True
+    return (channel_id, text) in RECENT_REPLIES
+
+
+class PostLedger:
+    """
+    最近處理過的 (頻道, post_id)；webhook 與輪詢共用，同一則訊息只建一次單（Chat 重送的 webhook 也一併擋掉）。
+    只在 event loop 上讀寫，不需要加鎖。
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._seen: "OrderedDict[Tuple[str, str], None]" = OrderedDict()
+
+    def claim(self, channel_id: str, post_id: Optional[str]) -> bool:
+        """第一次看到回傳 True；沒有 post_id 的訊息無法去重，一律放行"""
+        if not post_id:
+            return True
+        key = (str(channel_id), str(post_id))
+        if key in self._seen:
+            return False
+        self._seen[key] = None
+        if len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return True
+
+    def release(self, channel_id: str, post_id: Optional[str]) -> None:
+        if post_id:
+            self._seen.pop((str(channel_id), str(post_id)), None)
+
+    def snapshot(self) -> List[List[str]]:
+        return [list(k) for k in self._seen]
+
+    def load(self, items: List[List[str]]) -> None:
+        for channel_id, post_id in items[-self.max_size:]:
+            self._seen[(channel_id, post_id)] = None
+
+
+POST_LEDGER = PostLedger(POST_DEDUPE_SIZE)
+
+
+class SynoChatClient:
+    """
+    Synology Chat Web API（流程同 chat_probe.sh）：登入一次取得 sid + SynoToken，之後都用同一個 Session；
+    session 失效時自動重新登入一次。version 2 失敗時回退 version 1。
+    """
+
+    SESSION_ERRORS = {105, 106, 107, 119}
+
+    def __init__(self, base: str, account: str, password: str):
+        self.base = base
+        self.account = account
+        self.password = password
+        self.session = requests.Session()
+        self.session.headers["X-Requested-With"] = "XMLHttpRequest"
+        self.syno_token = ""
+        self.workspace_id: Optional[str] = None
+
+    def login(self) -> None:
+        resp = self.session.post(f"{self.base}/webapi/auth.cgi", data={
+            "api": "SYNO.API.Auth", "method": "login", "version": "6", "session": "chat", "format": "sid",
+            "enable_syno_token": "yes", "account": self.account, "passwd": self.password,
+        }, verify=CHAT_VERIFY_TLS, timeout=call_timeout(10, "chat_login"))
+        data = json_loads(resp.content)
+        if not data.get("success"):
+            raise RuntimeError(f"Chat 登入失敗: {data.get('error')}")
+        self.session.cookies.set("id", data["data"]["sid"])
+        self.syno_token = data["data"]["synotoken"]
+        logger.info(f"🔑 Chat Web API 已登入（SID={_safe_tail(data['data']['sid'], 6)}）")
+        if self.workspace_id is None:
+            # 沒啟用 workspace 時會失敗或回空，跟 chat_probe.sh 一樣預設 1
+            try:
+                workspaces = self.call("SYNO.Chat.Workspace", "list", {}).get("workspaces") or []
+            except RuntimeError:
+                workspaces = []
+            self.workspace_id = str(workspaces[0]["id"]) if workspaces else "1"
+
+    def call(self, api: str, method: str, params: Dict[str, str]) -> Dict[str, object]:
+        for attempt in range(2):
+            if not self.syno_token:
+                self.login()
+            error = None
+            for version in ("2", "1"):
+                resp = self.session.post(
+                    f"{self.base}/chat/webapi/entry.cgi",
+                    params={"api": api, "method": method, "version": version, "SynoToken": self.syno_token},
+                    data=params, verify=CHAT_VERIFY_TLS, timeout=call_timeout(15, "chat_poll"),
+                )
+                data = json_loads(resp.content)
+                if data.get("success"):
+                    return data.get("data") or {}
+                error = data.get("error") or {}
+                if error.get("code") in self.SESSION_ERRORS:
+                    self.syno_token = ""  # session 失效：重新登入後再試一次
+                    break
+            if self.syno_token:
+                break
+        raise RuntimeError(f"{api}.{method} 失敗: {error}")
+
+    def list_posts(self, channel_id: str, after: Optional[int], limit: int) -> List[Dict[str, object]]:
+        """讀頻道訊息；after 有值時讀它之後的 limit 則，否則讀最新的 limit 則。依 post_id 由舊到新排序"""
+        params = {"channel_id": channel_id, "limit": str(limit)}
+        if self.workspace_id:
+            params["workspace_id"] = self.workspace_id
+        if after is not None:
+            params.update({"post_id": str(after), "prev_count": "0", "next_count": str(limit)})
+        data = self.call("SYNO.Chat.Message", "list", params)
+        posts = [p for p in (data.get("posts") or data.get("messages") or []) if p.get("post_id") is not None]
+        if after is not None:
+            posts = [p for p in posts if int(p["post_id"]) > after]
+        return sorted(posts, key=lambda p: int(p["post_id"]))
+
+
+class ChatPoller:
+    """
+    背景輪詢：依頻道記住讀到的最後一則 post_id（存到 CHAT_POLL_STATE_PATH），每輪批次讀新訊息，
+    過關鍵字的訊息送進與 webhook 相同的流程（process_chat_message，路由名稱 chat_poll）。
+    被限流時停在該則，下一輪再從那裡接著讀，不會漏也不會重複。
+    """
+
+    def __init__(self, client: SynoChatClient, state_path: str):
+        self.client = client
+        self.state_path = state_path
+        self.cursors: Dict[str, int] = {}
+        self.stats = Counter()
+        self.last_poll_at: Optional[str] = None
+        self.last_error: Optional[str] = None
+
+    def load_state(self) -> None:
+        try:
+            with open(self.state_path, "rb") as f:
+                state = json_loads(f.read())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ 讀取輪詢狀態失敗，從最新訊息開始: {e}")
+            return
+        self.cursors = {str(k): int(v) for k, v in (state.get("cursors") or {}).items()}
+        POST_LEDGER.load(state.get("seen") or [])
+
+    def _write_state(self, state: Dict[str, object]) -> None:
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = f"{self.state_path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(json_dumps(state))
+        os.replace(tmp, self.state_path)  # 先寫暫存檔再換名，停機時不會留下寫一半的狀態
+
+    async def save_state(self) -> None:
+        state = {"cursors": dict(self.cursors), "seen": POST_LEDGER.snapshot()}
+        try:
+            await run_in_threadpool(self._write_state, state)
+        except OSError as e:
+            logger.error(f"❌ 寫入輪詢狀態失敗: {e}")
+
+    def channels(self) -> List[str]:
+        return sorted(CHAT_POLL_CHANNELS or ROUTING.channel_ids)
+
+    async def run(self) -> None:
+        await run_in_threadpool(self.load_state)
+        while True:
+            try:
+                for channel_id in self.channels():
+                    await self.poll_channel(channel_id)
+                self.last_error = None
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                logger.error(f"❌ Chat 輪詢失敗: {self.last_error}")
+            self.last_poll_at = datetime.now().isoformat(timespec="seconds")
+            await asyncio.sleep(CHAT_POLL_INTERVAL)
+
+    async def poll_channel(self, channel_id: str) -> None:
+        _deadline.set(None)  # 讀取本身不受上一則訊息的期限影響
+        cursor = self.cursors.get(channel_id)
+        if cursor is None and not CHAT_POLL_BACKFILL:
+            # 第一次輪詢：只記錄目前位置，不回頭處理舊訊息
+            posts = await run_in_threadpool(self.client.list_posts, channel_id, None, 1)
+            self.cursors[channel_id] = int(posts[-1]["post_id"]) if posts else 0
+            await self.save_state()
+            return
+        for _ in range(CHAT_POLL_MAX_BATCHES):
+            posts = await run_in_threadpool(self.client.list_posts, channel_id, cursor, CHAT_POLL_BATCH)
+            if not posts:
+                break
+            for post in posts:
+                if not await self.ingest(channel_id, post):
+                    await self.save_state()
+                    return  # 被限流：停在這則，下一輪重讀
+                cursor = int(post["post_id"])
+                self.cursors[channel_id] = cursor
+            await self.save_state()
+            if len(posts) < CHAT_POLL_BATCH:
+                break
+
+    async def ingest(self, channel_id: str, post: Dict[str, object]) -> bool:
+        """處理一則訊息；回傳 False 表示被限流，需要稍後重試"""
+        post_id = str(post["post_id"])
+        text = str(post.get("message") or post.get("text") or "").strip()
+        creator = str(post.get("creator_id") or post.get("user_id") or "")
+        self.stats["seen"] += 1
+        routing = ROUTING
+        matcher = routing.trigger_matcher
+        if not text or matcher is None or not matcher.search(text) or is_own_post(channel_id, post, text):
+            return True
+        if not POST_LEDGER.claim(channel_id, post_id):
+            self.stats["duplicate"] += 1
+            return True
+        form = {
+            "channel_id": channel_id,
+            "channel_name": str(post.get("channel_name") or ""),
+            "user_id": creator,
+            "username": str(post.get("creator_name") or post.get("username") or ""),
+            "post_id": post_id,
+            "timestamp": str(post.get("create_at") or ""),
+            "text": text,
+        }
+        # 訊息帶的檔案 URL 沿用 webhook 的 ATTACHMENT_URL_FIELDS 欄位名，交給 chat_attachments 轉送
+        form.update({f: post[f].strip() for f in ATTACHMENT_URL_FIELDS if isinstance(post.get(f), str) and post[f].strip()})
+        trace = Trace(f"poll-{channel_id}-{post_id}", "chat_poll")
+        tokens = [(_trace, _trace.set(trace)), (_span_depth, _span_depth.set(1)), (_routing, _routing.set(routing)),
+                  (_deadline, _deadline.set(Deadline(route_deadline("chat_poll"))))]
+        task = asyncio.current_task()
+        _task_trace[task] = trace  # 同 loop_trace：輪詢卡住 loop 時也歸得到這則訊息
+        resp = None
+        try:
+            resp = await process_chat_message("chat_poll", form, channel_id, text)
+            if not issue_created(resp):
+                POST_LEDGER.release(channel_id, post_id)  # 逾時或 Redmine 錯誤：Chat 重送的 webhook 還能再處理一次
+                self.stats["failed"] += 1
+                return True
+            if resp.background is not None:
+                await resp.background()  # 延後的子議題 / 回貼：webhook 是回應後跑，這裡直接接著跑
+            self.stats["processed"] += 1
+            return True
+        except AdmissionRejected as e:
+            POST_LEDGER.release(channel_id, post_id)
+            record_rejected("chat_poll", channel_id, e)
+            self.stats["rate_limited"] += 1
+            logger.warning(f"⛔ 輪詢訊息被限流，稍後重試: channel={channel_id} post={post_id} ({e.scope})")
+            return False
+        except Exception as e:
+            POST_LEDGER.release(channel_id, post_id)  # Chat 重送的 webhook 還能再處理一次
+            self.stats["failed"] += 1
+            logger.error(f"❌ 輪詢訊息處理失敗（略過）: channel={channel_id} post={post_id}: {e}")
+            return True
+        finally:
+            trace.response_ms = round(trace.elapsed_ms(), 2)
+            trace.status = resp.status_code if resp is not None else 500
+            finish_trace(trace)
+            _task_trace.pop(task, None)
+            for var, token in reversed(tokens):
+                var.reset(token)
+
+    def status(self) -> Dict[str, object]:
+        return {
+            "channels": self.channels(),
+            "cursors": self.cursors,
+            "stats": dict(self.stats),
+            "last_poll_at": self.last_poll_at,
+            "last_error": self.last_error,
+        }
+
+
+CHAT_POLLER: Optional[ChatPoller] = None
+
+
+async def start_chat_poller():
+    global CHAT_POLLER
+    if not CHAT_POLL:
+        return
+    if not (CHAT_API_BASE and CHAT_USER and CHAT_PASS):
+        logger.error("❌ CHAT_POLL 需要 CHAT_API_BASE / CHAT_USER / CHAT_PASS，輪詢未啟動")
+        return
+    CHAT_POLLER = ChatPoller(SynoChatClient(CHAT_API_BASE, CHAT_USER, CHAT_PASS), CHAT_POLL_STATE_PATH)
+    _background_tasks.append(asyncio.create_task(CHAT_POLLER.run()))
+
+
+async def save_chat_poller_state():
+    if CHAT_POLLER is not None:
+        await CHAT_POLLER.save_state()
+
+
+@app.get("/stats")
+def pipeline_stats(request: Request, hours: Optional[int] = None, hourly: bool = False):
+    """建單統計：總計 / 各頻道 / 各結果、建單耗時中位數（內插近似值），以及最近 hours 小時（預設最大視窗）的視窗彙總"""
+    require_debug_token(request)
+    if PIPELINE_STATS is None:
+        return FastJSONResponse({"ok": False, "error": "STATS_EVENT_LOG 未設定"}, status_code=404)
+    summary = PIPELINE_STATS.summary(hours, hourly)
+    return FastJSONResponse(summary, status_code=200 if summary["ok"] else 400)
+
+
+@app.get("/debug/traces")
+def debug_traces(request: Request, limit: int = 50, slow: bool = False, route: str = ""):
+    """最近的請求追蹤（新到舊）；slow=true 只看慢請求，route 可指定路由"""
+    require_debug_token(request)
+    out = []
+    for t in reversed(TRACES):
+        if slow and not t["slow"]:
+            continue
+        if route and t["route"] != route:
+            continue
+        out.append(t)
+        if len(out) >= limit:
+            break
+    return {"count": len(out), "slow_ms": TRACE_SLOW_MS, "traces": out}
+
+
+@app.get("/debug/traces/{request_id}")
+def debug_trace(request: Request, request_id: str):
+    require_debug_token(request)
+    for t in reversed(TRACES):
+        if t["request_id"] == request_id:
+            return t
+    raise HTTPException(status_code=404, detail="Trace not found")
+
+
+@app.get("/debug/loop")
+def debug_loop(request: Request):
+    """Event loop 排程延遲直方圖與最近的阻塞事件（含當下 stack）"""
+    require_debug_token(request)
+    return LOOP_MONITOR_STATE.to_dict()
+
+
+@app.get("/debug/redmine_metadata")
+def debug_redmine_metadata(request: Request):
+    """目前快取的 tracker / 狀態 / 優先權 / 自訂欄位名稱"""
+    require_debug_token(request)
+    return {
+        "targets": {t.name: {**t.to_dict(), "metadata": t.metadata.to_dict()} for t in REDMINE_TARGETS},
+        "channels": {ch: {"target": r.target.name, "project": r.project} for ch, r in REDMINE_ROUTES.items()},
+    }
+
+
+@app.get("/debug/shadow")
+def debug_shadow(request: Request, limit: int = 50, source: str = ""):
+    """最近的 shadow 執行結果（新到舊）：本來要建立的議題、要回貼的訊息、各階段耗時"""
+    require_debug_token(request)
+    runs = [r for r in reversed(SHADOW_RUNS) if not source or r["source"] == source][:limit]
+    return {"count": len(runs), "runs": runs}
+
+
+@app.get("/debug/chat_poll")
+def debug_chat_poll(request: Request):
+    require_debug_token(request)
+    if CHAT_POLLER is None:
+        return {"enabled": False}
+    return {"enabled": True, **CHAT_POLLER.status()}
+
+
+@app.get("/debug/config")
+def debug_config(request: Request):
+    require_debug_token(request)
+    return ROUTING.summary()
+
+
+@app.post("/debug/config/reload")
+def debug_config_reload(request: Request):
+    """手動觸發設定熱更新（與改 CONFIG_FILE、kill -HUP 效果相同）"""
+    require_debug_token(request)
+    result = reload_routing("endpoint")
+    return FastJSONResponse(result, status_code=200 if result["ok"] else 422)
 
 
 @app.get("/")
 def root():
-    return JSONResponse({"detail": "Not Found"}, status_code=404)
+    return FastJSONResponse({"detail": "Not Found"}, status_code=404)
 
@@ -0,0 +1,77 @@
+# benchmarks/bench_attachments.py
+# -*- coding: utf-8 -*-
+"""
+附件轉送的記憶體：對執行中的服務送大檔（Chat file_url 與 n8n multipart），每次之後讀服務程序的 RSS / 峰值 RSS。
+檔案是邊下載邊上傳，峰值 RSS 應該只比起點多一點、與檔案大小無關。
+
+用法（專案目錄，Linux；需要兩個終端機或背景執行）：
+  python replay_traffic.py stubs --port 18080
+  REDMINE_URL=http://127.0.0.1:18080 REDMINE_API_KEY=dummy REDMINE_PROJECT_ID=sales \\
+  CHAT_WEBHOOK_URL=http://127.0.0.1:18080/chat/incoming CHAT_TOKENS=196:tokA CHAT_CHANNEL_IDS=196 CONFIG_FILE= \\
+  ATTACHMENT_URL_HOSTS=127.0.0.1 ATTACHMENT_MAX_BYTES=314572800 REQUEST_DEADLINE=120 \\
+    python -m uvicorn app:app --port 18085 &
+  python benchmarks/bench_attachments.py --pid $!
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import requests
+
+MB = 2 ** 20
+
+
+def rss(pid: int) -> str:
+    with open(f"/proc/{pid}/status") as f:
+        fields = dict(line.split(":", 1) for line in f if line.startswith(("VmRSS", "VmHWM")))
+    return " ".join(f"{k}={int(v.split()[0]) // 1024}MB" for k, v in fields.items())
+
+
+def chat(args, size: int) -> str:
+    url = f"{args.stubs}/files/{size}/quote_{size // MB}MB.pdf"
+    t = time.perf_counter()
+    r = requests.post(f"{args.target}/chat_webhook", data={
+        "channel_id": "196", "token": args.token, "text": "新商機 報價", "user_id": "1", "username": "amy",
+        "post_id": str(time.time_ns()), "file_url": url,
+    }, timeout=300)
+    body = r.json()
+    return f"HTTP {r.status_code} {time.perf_counter() - t:.2f}s attachments={body.get('attachments')} errors={body.get('attachment_errors')}"
+
+
+def n8n(args, size: int, workdir: str) -> str:
+    path = os.path.join(workdir, f"spec_{size // MB}MB.bin")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            for _ in range(size // MB):
+                f.write(os.urandom(MB))
+    t = time.perf_counter()
+    with open(path, "rb") as f:
+        r = requests.post(f"{args.target}/n8n_webhook", data={"command": "新任務 標題:規格書 指派:amy", "channel_id": "196"},
+                          files={"file": (os.path.basename(path), f, "application/pdf")}, timeout=300)
+    body = r.json()
+    return f"HTTP {r.status_code} {time.perf_counter() - t:.2f}s attachments={body.get('attachments')} errors={body.get('attachment_errors') or body.get('error')}"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="附件轉送時服務程序的 RSS")
+    parser.add_argument("--pid", type=int, required=True, help="uvicorn 程序的 PID")
+    parser.add_argument("--target", default="http://127.0.0.1:18085")
+    parser.add_argument("--stubs", default="http://127.0.0.1:18080")
+    parser.add_argument("--token", default="tokA")
+    parser.add_argument("--chat-mb", default="1,16,64,256")
+    parser.add_argument("--n8n-mb", default="16,64,256")
+    args = parser.parse_args()
+    print("start", rss(args.pid))
+    for mb in (int(x) for x in args.chat_mb.split(",") if x):
+        print(f"chat file_url {mb}MB", chat(args, mb * MB), rss(args.pid))
+    with tempfile.TemporaryDirectory() as workdir:
+        for mb in (int(x) for x in args.n8n_mb.split(",") if x):
+            print(f"n8n multipart {mb}MB", n8n(args, mb * MB, workdir), rss(args.pid))
+    print("stubs", requests.get(f"{args.stubs}/stats", timeout=10).json())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+# benchmarks/bench_json.py
+# -*- coding: utf-8 -*-
+"""
+JSON 編解碼層（json_dumps / json_loads / parse_listing / FastJSONResponse）在 stdlib 與 orjson 後端的
+每次 CPU 時間與 tracemalloc 記憶體（peak / 結果保留量）。每個後端在獨立的子程序跑（JSON_BACKEND 只在啟動時讀）。
+
+用法（專案目錄）：
+  python benchmarks/bench_json.py                 # stdlib 與 orjson 都跑
+  python benchmarks/bench_json.py --backend orjson
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import subprocess
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROJECTS = json.dumps({"projects": [{
+    "id": i, "name": f"專案 {i}", "identifier": f"proj-{i}", "description": "說明" * 40,
+    "status": 1, "is_public": True, "created_on": "2024-01-01T00:00:00Z", "updated_on": "2024-01-01T00:00:00Z",
+    "custom_fields": [{"id": 1, "name": "來源", "value": "展會"}], "parent": {"id": 1, "name": "x"},
+} for i in range(300)], "total_count": 300, "offset": 0, "limit": 300}, ensure_ascii=False).encode()
+ISSUE = {"issue": {"subject": "新商機 客戶A 需要報價", "description": "**來源頻道**: sales (id=196)\n\n" * 5,
+                   "project_id": "businessleads", "tracker_id": 10, "status_id": 1, "assigned_to_id": 5, "due_date": "2026-10-28"}}
+RESPONSE = {"ok": True, "redmine_status": 201, "parent_issue_id": 101, "subtasks_created": 3, "deferred": [], "incomplete": []}
+
+
+def run(backend: str) -> None:
+    os.environ.update({"JSON_BACKEND": backend, "CONFIG_FILE": "", "STATS_EVENT_LOG": "", "LOOP_MONITOR": "false",
+                       "CHAT_POLL": "false", "TRAFFIC_RECORD_PATH": ""})
+    logging.disable(logging.CRITICAL)
+    sys.path.insert(0, ROOT)
+    import app
+
+    def listing():
+        return app.parse_listing(PROJECTS, "projects", app.PROJECT_LISTING_FIELDS)
+
+    def outbound():
+        return app.json_dumps(ISSUE)
+
+    def render():
+        return app.FastJSONResponse(RESPONSE).body
+
+    def per_lead():
+        # 每筆新商機：1 次專案列表解析 + 4 次 issue POST 編碼 + 1 次回應編碼
+        listing()
+        for _ in range(4):
+            outbound()
+        render()
+
+    for name, fn, n in [("projects.json parse (300)", listing, 2000), ("issue payload encode", outbound, 20000),
+                        ("response render", render, 20000), ("per lead", per_lead, 2000)]:
+        fn()
+        t = time.process_time()
+        for _ in range(n):
+            fn()
+        us = (time.process_time() - t) / n * 1e6
+        tracemalloc.start()
+        result = fn()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+        print(f"{app.JSON_BACKEND_NAME:7s} {name:28s} {us:9.1f} us/op  peak={peak / 1024:8.1f} KiB  retained={retained / 1024:7.1f} KiB")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="JSON 後端 CPU / 記憶體比較")
+    parser.add_argument("--backend", choices=["stdlib", "orjson"], help="只跑這個後端（預設兩個都跑）")
+    args = parser.parse_args()
+    if args.backend:
+        run(args.backend)
+        return 0
+    for backend in ("stdlib", "orjson"):
+        code = subprocess.call([sys.executable, os.path.abspath(__file__), "--backend", backend])
+        if code:
+            return code
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
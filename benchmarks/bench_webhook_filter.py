@@ -0,0 +1,86 @@
+# benchmarks/bench_webhook_filter.py
+# -*- coding: utf-8 -*-
+"""
+沒有關鍵字的 Chat 訊息（大多數流量）經過 /chat_webhook 的吞吐量：直接呼叫 ASGI app，不經網路、不打 Redmine。
+快速路徑（只從原始 body 取 channel_id / token / text 過濾）前後各跑一次比較。
+
+用法（專案目錄）：
+  python benchmarks/bench_webhook_filter.py
+  python benchmarks/bench_webhook_filter.py --n 10000 --rounds 5
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.update({
+    "CONFIG_FILE": "",
+    "STATS_EVENT_LOG": "",
+    "LOOP_MONITOR": "false",
+    "CHAT_POLL": "false",
+    "TRAFFIC_RECORD_PATH": "",
+    "CHAT_TOKENS": "196:tokA,94:tokB",
+    "CHAT_CHANNEL_IDS": "196,94",
+    "KEYWORDS": "newbiz,新商機,new business",
+})
+logging.disable(logging.CRITICAL)
+
+import app  # noqa: E402
+
+
+def make_body(text: str, channel: str = "196", token: str = "tokA") -> bytes:
+    return urlencode({"channel_id": channel, "channel_name": "sales", "token": token, "text": text,
+                      "user_id": "12", "username": "amy", "post_id": "123456", "thread_id": "0",
+                      "timestamp": "1700000000000"}).encode()
+
+
+async def call(path: str, body: bytes) -> int:
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+             "headers": [(b"content-type", b"application/x-www-form-urlencoded"), (b"content-length", str(len(body)).encode())],
+             "client": ("127.0.0.1", 1), "server": ("127.0.0.1", 8085)}
+    sent = False
+    status = 0
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app.app(scope, receive, send)
+    return status
+
+
+async def rate(n: int, body: bytes) -> float:
+    t = time.perf_counter()
+    for _ in range(n):
+        await call("/chat_webhook", body)
+    return n / (time.perf_counter() - t)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="沒有關鍵字的 webhook 訊息吞吐量（msg/s）")
+    parser.add_argument("--n", type=int, default=5000, help="每輪送幾則")
+    parser.add_argument("--rounds", type=int, default=3, help="取最快的一輪")
+    args = parser.parse_args()
+    body = make_body("明天下午三點開會，記得帶筆電 " * 3)
+    assert asyncio.run(call("/chat_webhook", body)) == 200
+    asyncio.run(rate(500, body))  # 暖身
+    best = max(asyncio.run(rate(args.n, body)) for _ in range(args.rounds))
+    print(f"skipped messages: {best:.0f} msg/s (n={args.n}, best of {args.rounds})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
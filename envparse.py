@@ -0,0 +1,22 @@
+# envparse.py
+# -*- coding: utf-8 -*-
+"""
+設定值的解析工具：app.py 與 replay_traffic.py 共用，格式才不會兩邊不一致。
+只用標準函式庫、import 時沒有副作用（不讀 .env、不寫 log）。
+"""
+from typing import Dict
+
+
+def parse_map(raw: str) -> Dict[str, str]:
+    """
+    解析 'k1:v1,k2:v2' 成 dict，左右兩邊會 strip。
+    例：
+      '196:tokA, 94:tokB' -> {'196': 'tokA', '94': 'tokB'}
+    也可用來解析 '196:urlA,94:urlB'
+    """
+    m: Dict[str, str] = {}
+    for part in [p for p in (raw or "").split(",") if p.strip()]:
+        if ":" in part:
+            k, v = part.split(":", 1)
+            m[k.strip()] = v.strip()
+    return m
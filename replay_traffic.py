@@ -0,0 +1,354 @@
+# replay_traffic.py
+# -*- coding: utf-8 -*-
+"""
+重播 TRAFFIC_RECORD_PATH 錄下的 webhook 流量，產生跟正式環境同樣形狀的負載並統計延遲。
+
+用法：
+  # 1) 啟動本機上游替身（假 Redmine + 假 Chat incoming webhook）
+  python replay_traffic.py stubs --port 18080 --latency-ms 80
+
+  # 2) 讓服務指向替身後啟動（不會碰到真的 Redmine / Chat）
+  REDMINE_URL=http://127.0.0.1:18080 REDMINE_API_KEY=dummy \\
+  CHAT_WEBHOOK_URL=http://127.0.0.1:18080/chat/incoming ./run.sh start
+
+  # 3) 重播：1 倍速、10 倍速、或不等間隔全速送
+  python replay_traffic.py replay traffic.ndjson --target http://127.0.0.1:8085 --speed 1
+  python replay_traffic.py replay traffic.ndjson --speed 10 --concurrency 32
+  python replay_traffic.py replay traffic.ndjson --max --concurrency 16 --tokens 196:tokA,94:tokB
+
+替身也模擬附件：GET /files/<bytes>/<檔名> 串流回傳指定大小的檔案（當作 Chat 的 file_url），
+POST /uploads.json 分塊讀完 body 後回 upload token（累計 bytes 見 /stats 的 upload_bytes），
+PUT /issues/<id>.json 把 token 掛上議題（次數見 /stats 的 issues_with_uploads）。
+
+錄製檔裡的 token 已遮蔽（***末8碼），重播時依 channel_id 換成 --tokens（預設讀 CHAT_TOKENS / OUTGOING_TOKEN）；
+--tokens 用 envparse.parse_map 解析（與 app.py 同一個，需在專案目錄執行），格式與正式環境完全相同。
+延遲同時回報兩種：service（實際送出到收到回應）與 scheduled（從排定時間起算，含送不出去的排隊時間）。
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+import itertools
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+
+from envparse import parse_map  # 與 app.py 同一個解析，CHAT_TOKENS 的格式才不會有差異
+
+
+# ----------------------------
+# 工具
+# ----------------------------
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[idx]
+
+
+def load_capture(path: str, routes: Optional[set], limit: int) -> List[Dict[str, object]]:
+    entries = []
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if entry.get("body") is None:
+                continue  # 太大或非 form / JSON，錄製時沒留內容
+            if routes and entry["path"] not in routes:
+                continue
+            entries.append(entry)
+    entries.sort(key=lambda e: e["ts"])
+    return entries[:limit] if limit else entries
+
+
+def restore_token(entry: Dict[str, object], tokens: Dict[str, str], default_token: str) -> str:
+    """把遮蔽過的 token 依 channel_id 換回重播環境的 token"""
+    body = entry["body"]
+    if not entry.get("content_type", "").startswith("application/x-www-form-urlencoded"):
+        return body
+    pairs = parse_qsl(body, keep_blank_values=True)
+    channel_id = next((v for k, v in pairs if k == "channel_id"), "")
+    token = tokens.get(channel_id, default_token)
+    if not token:
+        return body
+    return urlencode([(k, token if k == "token" else v) for k, v in pairs])
+
+
+# ----------------------------
+# 重播
+# ----------------------------
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.service: Dict[str, List[float]] = defaultdict(list)
+        self.scheduled: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, int] = defaultdict(int)
+        self.errors = 0
+
+    def add(self, group: str, status: str, service_ms: float, scheduled_ms: float) -> None:
+        with self.lock:
+            for key in ("ALL", group):
+                self.service[key].append(service_ms)
+                self.scheduled[key].append(scheduled_ms)
+            self.statuses[status] += 1
+
+
+def outcome_of(resp: requests.Response) -> str:
+    """依回應分類：skipped（沒觸發）/ created / rejected（429）/ 其他狀態碼"""
+    if resp.status_code == 429:
+        return "rejected"
+    if resp.status_code != 200:
+        return f"http_{resp.status_code}"
+    try:
+        body = resp.json()
+    except ValueError:
+        return "ok"
+    if body.get("skipped"):
+        return "skipped"
+    return "created" if body.get("ok") else "failed"
+
+
+def replay(args) -> int:
+    routes = {r for r in args.routes.split(",") if r} if args.routes else None
+    entries = load_capture(args.capture, routes, args.limit)
+    if not entries:
+        print("錄製檔沒有可重播的請求")
+        return 1
+    tokens = parse_map(args.tokens if args.tokens is not None else os.getenv("CHAT_TOKENS", ""))
+    default_token = os.getenv("OUTGOING_TOKEN", "")
+    speed = 0.0 if args.max else args.speed
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    stats = Stats()
+    seq = itertools.count(1)
+
+    def fire(entry: Dict[str, object], due: float) -> None:
+        headers = {"Content-Type": entry["content_type"], "X-Request-ID": f"replay-{next(seq)}"}
+        sent = time.monotonic()
+        try:
+            resp = session.post(args.target.rstrip("/") + entry["path"], data=restore_token(entry, tokens, default_token).encode("utf-8"),
+                                headers=headers, timeout=args.timeout)
+            status = outcome_of(resp)
+        except requests.RequestException:
+            status = "error"
+            with stats.lock:
+                stats.errors += 1
+        done = time.monotonic()
+        stats.add(f"{entry['path']} {status}", status, (done - sent) * 1000, (done - due) * 1000)
+
+    print(f"▶️ 重播 {len(entries)} 筆 → {args.target}（{'全速' if not speed else f'{speed:g}x'}，concurrency={args.concurrency}）")
+    t_first = entries[0]["ts"]
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for entry in entries:
+            due = start + ((entry["ts"] - t_first) / speed if speed else 0.0)
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            pool.submit(fire, entry, due if speed else time.monotonic())
+    elapsed = time.monotonic() - start
+    report(stats, len(entries), elapsed, entries[-1]["ts"] - t_first)
+    return 0
+
+
+def report(stats: Stats, total: int, elapsed: float, captured_span: float) -> None:
+    print(f"\n共 {total} 筆，耗時 {elapsed:.2f}s（錄製時間跨度 {captured_span:.2f}s），{total / elapsed if elapsed else 0:.1f} req/s，連線錯誤 {stats.errors}")
+    print("結果：" + ", ".join(f"{k}={v}" for k, v in sorted(stats.statuses.items())))
+    header = f"{'group':<36}{'n':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  {'sched p99':>9}"
+    print("\n延遲（ms）service = 送出→回應；sched = 排定時間→回應")
+    print(header)
+    print("-" * len(header))
+    for group in sorted(stats.service, key=lambda g: (g != "ALL", g)):
+        values = sorted(stats.service[group])
+        sched = sorted(stats.scheduled[group])
+        print(f"{group:<36}{len(values):>7}{percentile(values, 50):>9.1f}{percentile(values, 90):>9.1f}"
+              f"{percentile(values, 99):>9.1f}{values[-1]:>9.1f}  {percentile(sched, 99):>9.1f}")
+
+
+# ----------------------------
+# 上游替身（假 Redmine + 假 Chat）
+# ----------------------------
+class StubState:
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000
+        self.issue_ids = itertools.count(100000)
+        self.upload_ids = itertools.count(1)
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.lock = threading.Lock()
+
+
+STUB_LISTINGS = {
+    "projects.json": {"projects": [{"id": 1, "name": "業務", "identifier": "sales"}], "total_count": 1},
+    "users.json": {"users": [{"id": 5, "login": "amy", "firstname": "Amy", "lastname": "Lin"}], "total_count": 1},
+    "trackers.json": {"trackers": [{"id": 1, "name": "商機"}]},
+    "issue_statuses.json": {"issue_statuses": [{"id": 1, "name": "新建立"}]},
+    "issue_priorities.json": {"issue_priorities": [{"id": 2, "name": "一般"}]},
+    "custom_fields.json": {"custom_fields": []},
+}
+
+
+def make_stub_handler(state: StubState):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _reply(self, status: int, body: Dict[str, object]) -> None:
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _count(self, key: str) -> None:
+            with state.lock:
+                state.counts[key] += 1
+            time.sleep(state.latency)
+
+        def _send_file(self, size: int, name: str) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(size))
+            self.send_header("Content-Disposition", f'attachment; filename="{name}"')
+            self.end_headers()
+            block = b"\0" * 65536
+            while size > 0:
+                self.wfile.write(block[:size])
+                size -= len(block)
+
+        def _drain(self) -> int:
+            """分塊讀完 request body（Content-Length 或 chunked），回傳 bytes 數"""
+            total = 0
+            if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                    if size == 0:
+                        while self.rfile.readline() not in (b"\r\n", b"\n", b""):  # trailer
+                            pass
+                        return total
+                    while size > 0:
+                        chunk = self.rfile.read(min(size, 65536))
+                        if not chunk:
+                            return total
+                        size -= len(chunk)
+                        total += len(chunk)
+                    self.rfile.readline()  # chunk 結尾的 CRLF
+            remaining = int(self.headers.get("Content-Length") or 0)
+            while remaining > 0:
+                n = len(self.rfile.read(min(remaining, 65536)))
+                if not n:
+                    break
+                remaining -= n
+                total += n
+            return total
+
+        def do_GET(self):
+            path = urlsplit(self.path).path
+            name = path.rsplit("/", 1)[-1]
+            if path.startswith("/files/"):
+                self._count("GET /files")
+                parts = path.split("/")
+                self._send_file(int(parts[2]), parts[3] if len(parts) > 3 and parts[3] else "file.bin")
+                return
+            self._count(f"GET {name}")
+            if name in STUB_LISTINGS:
+                self._reply(200, STUB_LISTINGS[name])
+            elif self.path.startswith("/users/"):
+                self._reply(200, {"user": STUB_LISTINGS["users.json"]["users"][0]})
+            elif name == "stats":
+                with state.lock:
+                    self._reply(200, dict(state.counts))
+            else:
+                self._reply(404, {"errors": ["not found"]})
+
+        def do_POST(self):
+            path = urlsplit(self.path).path
+            if path.endswith("/uploads.json"):
+                received = self._drain()
+                self._count("POST /uploads.json")
+                with state.lock:
+                    state.counts["upload_bytes"] += received
+                    upload_id = next(state.upload_ids)
+                self._reply(201, {"upload": {"id": upload_id, "token": f"{upload_id}.stub"}})
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length)
+            self._count(f"POST {path}")
+            if path.endswith("/issues.json"):
+                self._reply(201, {"issue": {"id": next(state.issue_ids)}})
+            else:
+                self._reply(200, {"success": True})  # Chat incoming webhook
+
+        def do_PUT(self):
+            path = urlsplit(self.path).path
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            self._count("PUT /issues")
+            if not path.startswith("/issues/"):
+                self._reply(404, {"errors": ["not found"]})
+                return
+            if b'"uploads"' in body:
+                with state.lock:
+                    state.counts["issues_with_uploads"] += 1
+            self.send_response(204)  # Redmine 更新議題成功不帶 body
+            self.end_headers()
+
+    return StubHandler
+
+
+def stubs(args) -> int:
+    state = StubState(args.latency_ms)
+    server = ThreadingHTTPServer((args.host, args.port), make_stub_handler(state))
+    server.daemon_threads = True
+    base = f"http://{args.host}:{args.port}"
+    print(f"🧪 上游替身啟動：{base}（延遲 {args.latency_ms:g}ms）")
+    print(f"   REDMINE_URL={base}  CHAT_WEBHOOK_URL={base}/chat/incoming  呼叫統計：GET {base}/stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="重播錄製的 webhook 流量 / 啟動上游替身")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("replay", help="重播 NDJSON 錄製檔")
+    p.add_argument("capture", help="TRAFFIC_RECORD_PATH 錄下的檔案")
+    p.add_argument("--target", default="http://127.0.0.1:8085")
+    p.add_argument("--speed", type=float, default=1.0, help="時間倍率，1=照原間隔，10=快 10 倍")
+    p.add_argument("--max", action="store_true", help="不等間隔，以 --concurrency 全速送")
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--routes", default="", help="只重播這些路由，例：/chat_webhook")
+    p.add_argument("--limit", type=int, default=0)
+    p.add_argument("--tokens", default=None, help="'196:tokA,94:tokB'，預設讀 CHAT_TOKENS")
+    p.add_argument("--timeout", type=float, default=60.0)
+    p.set_defaults(func=replay)
+
+    p = sub.add_parser("stubs", help="啟動假 Redmine / 假 Chat")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=18080)
+    p.add_argument("--latency-ms", type=float, default=0.0, help="每個上游呼叫的模擬延遲")
+    p.set_defaults(func=stubs)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
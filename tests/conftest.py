@@ -0,0 +1,12 @@
+import os
+import sys
+
+# 測試不讀工作目錄的 .env、不寫 logs/、不啟動背景監控
+os.environ.update({
+    "CONFIG_FILE": "",
+    "STATS_EVENT_LOG": "",
+    "LOOP_MONITOR": "false",
+    "CHAT_POLL": "false",
+    "TRAFFIC_RECORD_PATH": "",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
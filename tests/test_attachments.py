@@ -0,0 +1,100 @@
+import asyncio
+import io
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+
+def fake_response(status, headers=None, body=b""):
+    resp = app.requests.Response()
+    resp.status_code = status
+    resp.headers.update(headers or {})
+    resp.raw = io.BytesIO(body)
+    return resp
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    monkeypatch.setattr(app, "ATTACHMENT_URL_HOSTS", {"chat.example"})
+    calls = []
+
+    def serve(responses):
+        def get(url, **kwargs):
+            calls.append((url, kwargs.get("allow_redirects")))
+            return responses[url]
+
+        monkeypatch.setattr(app.requests, "get", get)
+        return calls
+
+    return serve
+
+
+def test_redirect_to_other_host_is_rejected(fetched):
+    calls = fetched({"https://chat.example/f/1": fake_response(302, {"Location": "http://10.0.0.5/admin"})})
+    with pytest.raises(app.AttachmentError):
+        with app.UrlAttachment("https://chat.example/f/1").open(5):
+            pytest.fail("不應該下載")
+    assert calls == [("https://chat.example/f/1", False)]
+
+
+def test_redirect_within_allowed_hosts_is_followed(fetched):
+    calls = fetched({
+        "https://chat.example/f/1": fake_response(302, {"Location": "/files/quote.pdf"}),
+        "https://chat.example/files/quote.pdf": fake_response(200, {"Content-Length": "3"}, b"pdf"),
+    })
+    attachment = app.UrlAttachment("https://chat.example/f/1", "quote.pdf")
+    with attachment.open(5) as raw:
+        assert raw.read() == b"pdf"
+    assert [url for url, _ in calls] == ["https://chat.example/f/1", "https://chat.example/files/quote.pdf"]
+    assert attachment.size == 3
+
+
+def test_transfer_budget_keeps_reserve(monkeypatch):
+    monkeypatch.setattr(app, "ATTACHMENT_RESERVE", 5)
+    token = app._deadline.set(app.Deadline(8))
+    try:
+        assert app.attachment_budget() <= 3
+        app._deadline.get().expires_at -= 2.5  # 只剩 5.5 秒：全部留給議題
+        with pytest.raises(app.AttachmentError):
+            app.attachment_budget()
+    finally:
+        app._deadline.reset(token)
+
+
+def test_chunk_reader_stops_after_budget():
+    reader = app.ChunkReader(io.BytesIO(b"x" * 10), until=app.time.monotonic() - 1)
+    with pytest.raises(app.AttachmentError):
+        reader.read()
+
+
+def test_failed_upload_does_not_touch_issue(monkeypatch):
+    target = app.RedmineTarget("one", "http://redmine.invalid", "key", 1)
+    sent = []
+    target.session.request = lambda *args, **kwargs: sent.append(args)
+    monkeypatch.setattr(app, "current_redmine", lambda: SimpleNamespace(target=target))
+
+    def fail(attachment):
+        raise app.AttachmentError("下載失敗 HTTP 404")
+
+    monkeypatch.setattr(app, "upload_attachment", fail)
+    uploads, errors = app.attach_to_issue(42, [app.UrlAttachment("https://chat.example/f/1", "quote.pdf")])
+    assert uploads == [] and errors == ["quote.pdf: 下載失敗 HTTP 404"]
+    assert sent == []  # 沒有成功的上傳就不送 PUT
+    assert app.attach_to_issue(None, [object()]) == ([], [])  # 議題沒建成功時不轉送
+
+
+def test_poller_forwards_file_fields(monkeypatch):
+    seen = {}
+
+    async def capture(route, form, channel_id, text):
+        seen.update(form)
+        return app.FastJSONResponse({"ok": True})
+
+    monkeypatch.setattr(app, "process_chat_message", capture)
+    monkeypatch.setattr(app, "POST_LEDGER", app.PostLedger(10))
+    poller = app.ChatPoller(client=None, state_path="")
+    post = {"post_id": 6, "message": "新商機 客戶A", "creator_id": "7", "file_url": " https://chat.example/f/1 "}
+    assert asyncio.run(poller.ingest("196", post)) is True
+    assert [a.url for a in app.chat_attachments(seen)] == ["https://chat.example/f/1"]
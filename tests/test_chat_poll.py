@@ -0,0 +1,73 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+
+FORM = {"channel_id": "196", "token": "tok", "text": "新商機 客戶A", "post_id": "9001", "user_id": "7"}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, "verify_outgoing_token", lambda *args: True)
+    monkeypatch.setattr(app, "POST_LEDGER", app.PostLedger(100))
+    monkeypatch.setattr(app, "send_chat_message", lambda text, channel_id: (0, "not sent"))
+    return TestClient(app.app, raise_server_exceptions=False)
+
+
+def test_rate_limited_webhook_releases_post(client, monkeypatch):
+    async def rejected(*args):
+        raise app.AdmissionRejected("channel:196", "rate limited", retry_after=1)
+
+    monkeypatch.setattr(app, "process_chat_message", rejected)
+    assert client.post("/chat_webhook", data=FORM).status_code == 429
+    assert app.POST_LEDGER.claim("196", "9001")  # 輪詢之後還能處理這則訊息
+
+
+def test_failed_webhook_releases_post(client, monkeypatch):
+    async def boom(*args):
+        raise RuntimeError("parse failed")
+
+    monkeypatch.setattr(app, "process_chat_message", boom)
+    assert client.post("/chat_webhook", data=FORM).status_code == 500
+    assert app.POST_LEDGER.claim("196", "9001")
+
+
+def test_processed_webhook_keeps_claim(client, monkeypatch):
+    async def created(*args):
+        return app.FastJSONResponse({"ok": True, "parent_issue_id": 12})
+
+    monkeypatch.setattr(app, "process_chat_message", created)
+    assert client.post("/chat_webhook", data=FORM).status_code == 200
+    assert client.post("/chat_webhook", data=FORM).json()["reason"] == "duplicate post"
+
+
+def test_timed_out_webhook_releases_post(client, monkeypatch):
+    def slow_pipeline(*args):
+        raise app.DeadlineExceeded("deadline exceeded before parent_issue")
+
+    async def timed_out(*args):
+        return app.run_within_deadline(slow_pipeline)
+
+    monkeypatch.setattr(app, "process_chat_message", timed_out)
+    assert client.post("/chat_webhook", data=FORM).status_code == 504
+    assert app.POST_LEDGER.claim("196", "9001")  # 主議題沒建成，輪詢之後還能補建
+
+
+def test_redmine_error_releases_post(client, monkeypatch):
+    async def failed(*args):
+        return app.FastJSONResponse({"ok": True, "redmine_status": 500, "parent_issue_id": None})
+
+    monkeypatch.setattr(app, "process_chat_message", failed)
+    assert client.post("/chat_webhook", data=FORM).status_code == 200
+    assert app.POST_LEDGER.claim("196", "9001")
+
+
+def test_own_posts_detected_by_creator_not_prefix(monkeypatch):
+    monkeypatch.setattr(app, "CHAT_BOT_USER_IDS", {"42"})
+    monkeypatch.setattr(app, "RECENT_REPLIES", app.RecentReplies())
+    assert not app.is_own_post("196", {"creator_id": "7"}, "✅ 新商機 客戶B 已談妥")  # 使用者自己用 emoji 開頭
+    assert app.is_own_post("196", {"creator_id": "42"}, "新商機已建立")
+    assert app.is_own_post("196", {"creator_id": "0", "is_bot": True}, "新商機")
+    app.RECENT_REPLIES.add("196", "✅ 新商機已建立 #12")
+    assert app.is_own_post("196", {"creator_id": "0"}, "✅ 新商機已建立 #12")
+    assert not app.is_own_post("94", {"creator_id": "0"}, "✅ 新商機已建立 #12")
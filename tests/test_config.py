@@ -0,0 +1,80 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+from starlette.concurrency import run_in_threadpool
+
+import app
+
+
+def write(tmp_path, text):
+    path = tmp_path / ".env"
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def test_read_env_file_strips_comments_and_export(tmp_path):
+    path = write(tmp_path, "\n".join([
+        "# 註解",
+        "export CHAT_TOKENS=196:tokA # 說明",
+        "KEYWORD='新商機 # 不是註解'  # 這才是註解",
+        'CHAT_WEBHOOK_URL="http://chat/x#frag"',
+        "RATE=10/60#沒有空白不算註解",
+        "EMPTY=",
+        "",
+    ]) + "\r\n")
+    assert app.read_env_file(path) == {
+        "CHAT_TOKENS": "196:tokA",
+        "KEYWORD": "新商機 # 不是註解",
+        "CHAT_WEBHOOK_URL": "http://chat/x#frag",
+        "RATE": "10/60#沒有空白不算註解",
+        "EMPTY": "",
+    }
+
+
+def test_environment_overrides_win_over_config_file(tmp_path, monkeypatch):
+    path = write(tmp_path, "KEYWORD=新商機\nCHAT_TOKENS=196:fileTok\n")
+    # 啟動時：KEYWORD 由 run.sh 從 .env 帶進環境變數，CHAT_TOKENS 是 compose environment 的覆寫
+    base = {"KEYWORD": "新商機", "CHAT_TOKENS": "196:envTok"}
+    monkeypatch.setattr(app, "CONFIG_FILE", path)
+    monkeypatch.setattr(app, "_BASE_ENV", base)
+    monkeypatch.setattr(app, "_ENV_OVERRIDES", {k: v for k, v in base.items() if app.read_env_file(path).get(k) != v})
+    write(tmp_path, "KEYWORD=新任務\nCHAT_TOKENS=196:newFileTok\n")
+    env = app.routing_env()
+    assert env["KEYWORD"] == "新任務"  # 從設定檔來的值跟著熱更新
+    assert env["CHAT_TOKENS"] == "196:envTok"  # 部署時的覆寫永遠優先
+
+
+def test_key_removed_from_config_file_stops_applying(tmp_path, monkeypatch):
+    path = write(tmp_path, "KEYWORDS=新商機,新案件\nCHAT_TOKENS=196:fileTok\n")
+    base = {"KEYWORDS": "新商機,新案件", "CHAT_TOKENS": "196:fileTok", "PATH": "/usr/bin"}  # run.sh 把 .env 帶進環境變數
+    monkeypatch.setattr(app, "CONFIG_FILE", path)
+    monkeypatch.setattr(app, "_BASE_ENV", base)
+    monkeypatch.setattr(app, "_STARTUP_FILE_ENV", app.read_env_file(path))
+    monkeypatch.setattr(app, "_ENV_OVERRIDES", {})
+    write(tmp_path, "CHAT_TOKENS=196:fileTok\n")
+    env = app.routing_env()
+    assert "KEYWORDS" not in env
+    assert env["CHAT_TOKENS"] == "196:fileTok" and env["PATH"] == "/usr/bin"
+
+
+def test_request_keeps_pinned_routing_across_reload(monkeypatch):
+    old = app.ROUTING
+
+    async def request():
+        app.pin_routing()
+        monkeypatch.setattr(app, "ROUTING", object())  # 請求進行中熱更新
+        return await run_in_threadpool(app.current_routing)
+
+    assert asyncio.run(request()) is old
+    assert app.current_routing() is app.ROUTING
+
+
+def test_reload_endpoint_requires_token(monkeypatch):
+    monkeypatch.setattr(app, "DEBUG_TOKEN", "")
+    client = TestClient(app.app)
+    assert client.post("/debug/config/reload").status_code == 404
+    monkeypatch.setattr(app, "DEBUG_TOKEN", "s3cret")
+    assert client.post("/debug/config/reload").status_code == 403
+    monkeypatch.setattr(app, "ROUTING", app.ROUTING)  # 測試結束時換回原本的路由表
+    monkeypatch.setattr(app, "_ENV_OVERRIDES", {**app._ENV_OVERRIDES, "OUTGOING_TOKEN": "tok"})
+    assert client.post("/debug/config/reload", headers={"X-Debug-Token": "s3cret"}).json()["ok"]
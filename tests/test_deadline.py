@@ -0,0 +1,81 @@
+import json
+import time
+
+import pytest
+
+import app
+from app import Deadline, DeadlineExceeded
+
+
+@pytest.fixture
+def deadline():
+    def start(seconds):
+        d = Deadline(seconds)
+        token = app._deadline.set(d)
+        started.append(token)
+        return d
+    started = []
+    yield start
+    for token in reversed(started):
+        app._deadline.reset(token)
+
+
+class TricklingResponse:
+    """每 20ms 才送一小塊的回應（每次讀取都不超過 socket timeout）"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def iter_content(self, size):
+        for _ in range(self.chunks):
+            time.sleep(0.02)
+            yield b"x"
+
+    def close(self):
+        self.closed = True
+
+
+def test_call_timeout_caps_to_remaining_budget(deadline):
+    deadline(2.0)
+    assert app.call_timeout(10, "issue") <= 2.0
+    assert app.call_timeout(1, "issue") == 1
+
+
+def test_call_timeout_raises_and_marks_stage(deadline):
+    d = deadline(0.1)
+    with pytest.raises(DeadlineExceeded):
+        app.call_timeout(10, "subtask")
+    assert d.incomplete == ["subtask"]
+
+
+def test_read_body_enforces_total_deadline(deadline):
+    d = deadline(0.1)
+    resp = TricklingResponse(50)
+    with pytest.raises(DeadlineExceeded):
+        app.read_body(resp, "parent_issue")
+    assert resp.closed
+    assert d.incomplete == ["parent_issue"]
+
+
+def test_read_body_without_deadline_reads_everything():
+    import requests
+    resp = requests.Response()
+    resp.raw = None
+    resp.iter_content = TricklingResponse(3).iter_content
+    app.read_body(resp, "issue")
+    assert resp.content == b"xxx"
+
+
+def test_pipeline_stops_with_504_when_budget_runs_out(deadline):
+    deadline(5.0)
+    calls = []
+
+    def pipeline():
+        calls.append("lookup")
+        raise DeadlineExceeded("deadline exceeded before parent_issue")
+
+    resp = app.run_within_deadline(pipeline)
+    assert resp.status_code == 504
+    assert json.loads(resp.body)["ok"] is False
+    assert calls == ["lookup"]
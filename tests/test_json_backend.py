@@ -0,0 +1,23 @@
+import json
+
+import pytest
+from fastapi.responses import JSONResponse
+
+import app
+
+PAYLOADS = [
+    {"ok": True, "issue_id": 123, "subject": "新商機：台北客戶", "tags": ["業務", "急"]},
+    {"issue": {"project_id": 7, "custom_fields": [{"id": 3, "value": "A/B \"quoted\""}], "estimated_hours": 1.5}},
+    {"ok": False, "error": "處理逾時", "incomplete": [], "nested": {"none": None}},
+]
+
+
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_json_dumps_matches_stdlib_response(payload):
+    assert app.json_dumps(payload) == JSONResponse(payload).body
+    assert app.json_loads(app.json_dumps(payload)) == payload
+
+
+def test_parse_listing_keeps_only_requested_fields():
+    content = json.dumps({"projects": [{"id": 1, "name": "業務", "identifier": "sales", "description": "x" * 100}]}).encode()
+    assert app.parse_listing(content, "projects", ("id", "name")) == [{"id": 1, "name": "業務"}]
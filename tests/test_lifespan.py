@@ -0,0 +1,33 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import app
+
+
+def test_lifespan_starts_and_stops_background_work(monkeypatch):
+    calls = []
+
+    async def start_sleeper():
+        calls.append("start")
+        app._background_tasks.append(asyncio.create_task(asyncio.sleep(3600)))
+
+    async def record(name):
+        calls.append(name)
+
+    monkeypatch.setattr(app, "REDMINE_TARGETS", [])
+    monkeypatch.setattr(app, "start_loop_monitor", start_sleeper)
+    monkeypatch.setattr(app, "save_chat_poller_state", lambda: record("poller"))
+    monkeypatch.setattr(app, "flush_pipeline_stats", lambda: record("stats"))
+    monkeypatch.setattr(app, "flush_traffic_recorder", lambda: record("traffic"))
+    monkeypatch.setattr(app, "_background_tasks", [])
+
+    with TestClient(app.app) as client:
+        assert client.get("/health").status_code == 200
+        assert calls == ["start"]
+        task = app._background_tasks[0]
+        assert not task.done()
+
+    assert task.cancelled()
+    assert calls == ["start", "poller", "stats", "traffic"]
+
@@ -0,0 +1,84 @@
+import json
+import threading
+
+import app
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self.content = json.dumps(payload or {}).encode()
+        self.headers = {}
+
+
+class FakeTarget:
+    name = "fake"
+    configured = True
+
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.calls = []
+        self.metadata = app.RedmineMetadata(self)
+
+    def request(self, method, path, stage, timeout, **kwargs):
+        self.calls.append(path)
+        key = app.RedmineMetadata.ENDPOINTS[next(k for k, v in app.RedmineMetadata.ENDPOINTS.items() if v[0] == path)][1]
+        return FakeResponse(self.status_code, {key: [{"id": 5, "name": "來源"}, {"id": 2, "name": "High"}]})
+
+
+def test_first_lookup_waits_for_synchronous_refresh():
+    target = FakeTarget()
+    assert target.metadata.resolve_id("priorities", "high") == 2
+    assert len(target.calls) == len(app.RedmineMetadata.ENDPOINTS)
+    assert target.metadata.custom_field("來源")["id"] == 5
+    assert len(target.calls) == len(app.RedmineMetadata.ENDPOINTS)  # 只讀一次
+
+
+def test_concurrent_first_lookups_share_one_refresh():
+    target = FakeTarget()
+    threads = [threading.Thread(target=target.metadata.resolve_id, args=("trackers", "來源")) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(target.calls) == len(app.RedmineMetadata.ENDPOINTS)
+
+
+def test_unloaded_list_warns_once_per_refresh(caplog):
+    target = FakeTarget(status_code=403)  # 非管理員讀不到 /custom_fields.json
+    for name in ("10", "備註", "網址"):
+        assert target.metadata.custom_field(name) is None
+    missing = [r for r in caplog.records if "custom_fields 清單未載入" in r.getMessage()]
+    assert len(missing) == 1 and missing[0].levelname == "WARNING"
+    assert not [r for r in caplog.records if r.levelname == "ERROR"]
+
+
+def test_first_load_wait_is_bounded_by_deadline():
+    target = FakeTarget()
+    target.metadata._refresh_lock.acquire()  # 另一個請求正在讀
+    token = app._deadline.set(app.Deadline(0.05))
+    try:
+        assert target.metadata.resolve_id("priorities", "high") is None
+    finally:
+        app._deadline.reset(token)
+        target.metadata._refresh_lock.release()
+    assert target.calls == []
+
+
+def test_field_tokens_anchor_on_whitespace():
+    assert app._FIELD_TOKEN_RE.findall("新商機 客戶A 優先:高 來源：展會") == [("優先", "高"), ("來源", "展會")]
+    assert app._FIELD_TOKEN_RE.findall("客戶A來源:展會") == [("客戶A來源", "展會")]  # 名稱是整個詞，不會對到「來源」
+    assert app._FIELD_TOKEN_RE.findall("會議 12:30 見 https://example.com/a:b") == [("12", "30")]  # 12 不是欄位名稱，之後會被略過
+    assert app._FIELD_TOKEN_RE.findall("第一行\n來源:展會") == [("來源", "展會")]
+
+
+def test_extract_issue_fields_only_keeps_known_custom_fields(monkeypatch):
+    target = FakeTarget()
+    monkeypatch.setattr(app, "current_redmine", lambda: app.RedmineRoute(target, None, None, None, None))
+    assert app.extract_issue_fields("新商機 優先:高 來源:展會 時間 12:30") == ("高", {"來源": "展會"})
+
+
+def test_full_width_colon_is_parsed_and_stripped():
+    assert app.parse_task_params("新任務 標題:abc 優先：高") == {"subject": "abc", "priority": "高"}
+    text = "新商機 客戶A 優先：高 來源：展會"
+    assert app.strip_issue_fields(text, "高", {"來源": "展會"}) == "新商機 客戶A"
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+import app
+from app import AdmissionRejected, PipelineGate, RateLimiter, TokenBucket
+
+
+def test_new_bucket_admits_first_request():
+    limiter = RateLimiter()
+    limiter.admit([("channel", "196", (1.0, 1 / 60))])
+    with pytest.raises(AdmissionRejected) as e:
+        limiter.admit([("channel", "196", (1.0, 1 / 60))])
+    assert e.value.scope == "channel:196"
+    assert e.value.retry_after > 0
+
+
+def test_bucket_refills_over_time():
+    bucket = TokenBucket(1.0, 10.0)
+    now = bucket.updated
+    assert bucket.wait_time(now) == 0
+    bucket.take()
+    assert bucket.wait_time(now) == pytest.approx(0.1)
+    assert bucket.wait_time(now + 0.11) == 0
+
+
+def test_bucket_ignores_clock_before_creation():
+    bucket = TokenBucket(1.0, 1 / 60)
+    assert bucket.wait_time(bucket.updated - 5) == 0
+
+
+def test_levels_are_keyed_separately_and_all_or_nothing():
+    limiter = RateLimiter()
+    route, channel, user = (100.0, 1.0), (2.0, 0.001), (1.0, 0.001)
+    limiter.admit([("route", "chat_webhook", route), ("channel", "196", channel), ("user", "196/5", user)])
+    # 同一使用者被擋時，頻道 bucket 不應被扣
+    with pytest.raises(AdmissionRejected) as e:
+        limiter.admit([("route", "chat_webhook", route), ("channel", "196", channel), ("user", "196/5", user)])
+    assert e.value.scope == "user:196/5"
+    # 其他使用者、其他頻道各自有 bucket
+    limiter.admit([("route", "chat_webhook", route), ("channel", "196", channel), ("user", "196/6", user)])
+    limiter.admit([("route", "chat_webhook", route), ("channel", "94", channel), ("user", "94/5", user)])
+    with pytest.raises(AdmissionRejected) as e:
+        limiter.admit([("channel", "196", channel)])
+    assert e.value.scope == "channel:196"
+
+
+def test_rate_change_rebuilds_only_that_bucket():
+    limiter = RateLimiter()
+    limiter.admit([("channel", "196", (1.0, 0.001))])
+    limiter.admit([("channel", "196", (5.0, 0.001))])  # 熱更新放寬限制：新 bucket 從滿的開始
+
+
+def test_none_rate_is_unlimited():
+    limiter = RateLimiter()
+    for _ in range(100):
+        limiter.admit([("user", "196/5", None)])
+
+
+def test_gate_rejects_when_queue_full():
+    async def main():
+        gate = PipelineGate(1, 0, 1.0)
+        async with gate.slot():
+            with pytest.raises(AdmissionRejected) as e:
+                async with gate.slot():
+                    pass
+            assert e.value.reason == "queue full"
+        async with gate.slot():
+            assert gate.inflight == 1
+    asyncio.run(main())
+
+
+def test_gate_rejects_after_queue_timeout():
+    async def main():
+        gate = PipelineGate(1, 1, 0.05)
+        async with gate.slot():
+            with pytest.raises(AdmissionRejected) as e:
+                async with gate.slot():
+                    pass
+            assert e.value.reason == "queue timeout"
+            assert gate.waiting == 0
+    asyncio.run(main())
+
+
+def test_gate_queued_request_runs_when_slot_frees():
+    async def main():
+        gate = PipelineGate(1, 1, 1.0)
+        order = []
+
+        async def hold():
+            async with gate.slot():
+                await asyncio.sleep(0.02)
+                order.append("first")
+
+        async def queued():
+            await asyncio.sleep(0)
+            async with gate.slot():
+                order.append("second")
+
+        await asyncio.gather(hold(), queued())
+        assert order == ["first", "second"]
+        assert gate.inflight == 0
+    asyncio.run(main())
+
+
+def test_parse_rate():
+    assert app.parse_rate("10/60") == (10.0, 10.0 / 60)
+    assert app.parse_rate("5") == (5.0, 5.0)
+    assert app.parse_rate("") is None
+    assert app.parse_rate("x/1") is None
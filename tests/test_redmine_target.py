@@ -0,0 +1,133 @@
+import asyncio
+import io
+import threading
+
+import pytest
+from starlette.concurrency import run_in_threadpool
+
+import app
+
+
+class FakeSession:
+    def __init__(self):
+        self.calls = 0
+
+    def request(self, *args, **kwargs):
+        self.calls += 1
+        resp = app.requests.Response()
+        resp.status_code = 200
+        resp.raw = io.BytesIO(b"{}")
+        return resp
+
+
+def make_target(name, max_concurrency=1):
+    target = app.RedmineTarget(name, "http://redmine.invalid", "key", max_concurrency)
+    target.session = FakeSession()
+    return target
+
+
+def test_gates_are_per_target():
+    slow, other = make_target("slow"), make_target("other")
+
+    async def main():
+        slow.gate = app.PipelineGate(1, 0, 1.0, scope="pipeline:slow")
+        other.gate = app.PipelineGate(1, 0, 1.0, scope="pipeline:other")
+        async with slow.gate.slot():
+            with pytest.raises(app.AdmissionRejected) as e:
+                async with slow.gate.slot():
+                    pass
+            assert e.value.scope == "pipeline:slow"
+            async with other.gate.slot():  # 另一台 Redmine 的頻道不受影響
+                pass
+
+    asyncio.run(main())
+
+
+def test_reserve_times_out_before_dispatch():
+    target = make_target("busy")
+    target._slots.acquire()  # 例如延後工作正佔著唯一的空位
+
+    async def main():
+        with pytest.raises(app.RedmineBusy) as e:
+            async with target.reserve(0.05):
+                pytest.fail("不應該進到這裡")
+        return e.value
+
+    err = asyncio.run(main())
+    assert isinstance(err, app.AdmissionRejected) and err.scope == "redmine:busy"
+    assert target.busy == 1
+
+
+def test_reserved_pipeline_reuses_its_slot():
+    target = make_target("one")
+
+    async def main():
+        async with target.reserve(1.0):
+            # 佔好的空位給流程內依序的請求共用，不會自己等自己
+            await run_in_threadpool(target.request, "GET", "/a.json", "lookup", 5)
+            await run_in_threadpool(target.request, "GET", "/b.json", "lookup", 5)
+        assert target._slots.acquire(blocking=False)
+
+    asyncio.run(main())
+    assert target.session.calls == 2
+
+
+def test_unreserved_request_waits_at_most_slot_wait(monkeypatch):
+    monkeypatch.setattr(app, "REDMINE_SLOT_WAIT", 0.05)
+    target = make_target("deferred")
+    target._slots.acquire()
+    with pytest.raises(app.RedmineBusy):
+        target.request("GET", "/a.json", "subtask", 30)
+
+
+def test_lookup_cache_is_thread_safe():
+    target = make_target("cache")
+
+    def work(n):
+        for i in range(2000):
+            target.remember("user", f"{n}-{i}", i)
+            target.cached("user", f"{n}-{i - 1}")
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(target._lookups) <= 1000
+
+
+def test_reserve_hands_slots_out_in_arrival_order():
+    target = make_target("fifo")
+    order = []
+
+    async def pipeline(name, hold):
+        async with target.reserve(1.0):
+            order.append(name)
+            await asyncio.sleep(hold)
+
+    async def main():
+        first = asyncio.create_task(pipeline("a", 0.05))
+        await asyncio.sleep(0)
+        waiters = []
+        for name in ("b", "c", "d"):
+            waiters.append(asyncio.create_task(pipeline(name, 0.01)))
+            await asyncio.sleep(0.005)  # 依序到達
+        await asyncio.gather(first, *waiters)
+
+    asyncio.run(main())
+    assert order == ["a", "b", "c", "d"]
+    assert not target._waiters and target._slots.acquire(blocking=False)
+
+
+def test_slot_released_by_thread_wakes_waiter():
+    target = make_target("thread")
+    target._slots.acquire()  # 延後工作（thread）佔著空位
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.05, lambda: threading.Thread(target=target._release).start())
+        async with target.reserve(1.0):
+            return True
+
+    assert asyncio.run(main())
+    assert target.busy == 0
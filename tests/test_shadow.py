@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+
+import app
+
+
+def make_request(headers):
+    return Request({"type": "http", "method": "POST", "path": "/chat_webhook", "query_string": b"",
+                    "headers": [(k.encode(), v.encode()) for k, v in headers.items()]})
+
+
+def test_shadow_response_keeps_deferred_work_in_shadow(monkeypatch):
+    monkeypatch.setattr(app, "SHADOW_RUNS", app.deque(maxlen=10))
+
+    def pipeline():
+        background = BackgroundTask(app.run_deferred, app.send_chat_message, "✅ 子議題已建立", "196")
+        return app.FastJSONResponse({"ok": True}, background=background)
+
+    resp, record = app.run_shadow("chat_webhook", "196", "shadow", pipeline)
+    assert resp.background is not None
+    assert not app.SHADOW_RUNS  # 延後工作做完才寫出紀錄
+    asyncio.run(resp.background())
+    assert record["would_send"] == [{"channel_id": "196", "text": "✅ 子議題已建立"}]
+    assert list(app.SHADOW_RUNS) == [record]
+
+
+def test_shadow_run_header_requires_debug_token(monkeypatch):
+    monkeypatch.setattr(app, "DEBUG_TOKEN", "")
+    with pytest.raises(HTTPException) as e:
+        app.mark_shadow_request(make_request({"x-shadow-run": "1"}))
+    assert e.value.status_code == 404
+
+    monkeypatch.setattr(app, "DEBUG_TOKEN", "s3cret")
+
+    async def forced():
+        app.mark_shadow_request(make_request({"x-shadow-run": "1", "x-debug-token": "s3cret"}))
+        return app.is_shadow("chat_webhook", "196")
+
+    assert asyncio.run(forced())
+    assert not app.is_shadow("chat_webhook", "196")
+
+
+def test_mirror_uses_own_buckets_and_never_queues(monkeypatch):
+    forwarded = []
+    monkeypatch.setattr(app, "forward_mirror", lambda *args: forwarded.append(args))
+    monkeypatch.setattr(app, "RATE_LIMITER", app.RateLimiter())
+    monkeypatch.setattr(app, "ROUTING", type("Routing", (), {"route_rate": lambda self, r: (10, 10), "channel_rate": lambda self, c: (10, 10)})())
+    source = ("/chat_webhook", b"text=x", "application/x-www-form-urlencoded")
+
+    async def main():
+        gate = app.PipelineGate(1, 10, 5)
+        monkeypatch.setattr(app.redmine_for("196").target, "gate", gate)
+        monkeypatch.setattr(app, "MIRROR_GATE", app.PipelineGate(1, 0, 0, scope="mirror"))
+        async with gate.slot():  # 正式流量佔滿建單閘門：鏡像不受影響，也不佔它的名額
+            await app.mirror_request("chat_webhook", "196", source, "req1", 200, b"{}")
+        async with app.MIRROR_GATE.slot():  # 鏡像自己的名額滿了：放棄，不排隊
+            await app.mirror_request("chat_webhook", "196", source, "req2", 200, b"{}")
+        assert gate.waiting == 0 and app.MIRROR_GATE.waiting == 0
+
+    asyncio.run(main())
+    assert [args[3] for args in forwarded] == ["req1"]
+    assert {kind for kind, _ in app.RATE_LIMITER._buckets} == {"mirror:route", "mirror:channel"}  # 不扣正式流量的 token
+
+
+def test_shadow_rejections_stay_out_of_stats(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(app, "PIPELINE_STATS", type("Stats", (), {"record": lambda self, e: recorded.append(e)})())
+    monkeypatch.setattr(app, "SHADOW_CHANNEL_IDS", {"77"})
+    err = app.AdmissionRejected("channel:77", "rate limited")
+    app.record_rejected("chat_webhook", "77", err)
+    assert recorded == []
+    app.record_rejected("chat_webhook", "196", err)
+    assert [e["channel"] for e in recorded] == ["196"]
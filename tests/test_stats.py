@@ -0,0 +1,91 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def stats(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "STATS_WINDOWS", [24, 168])
+    return app.PipelineStats(str(tmp_path / "events.ndjson"), str(tmp_path / "snap.json"), 2160)
+
+
+def event(hours_ago, channel="196", outcome="created", ttc=None):
+    return {"ts": time.time() - hours_ago * 3600, "channel": channel, "outcome": outcome, "ttc_ms": ttc}
+
+
+def test_p50_is_interpolated_within_bucket():
+    h = app.DurationHistogram()
+    for ms in (110, 160, 210, 250):
+        h.observe(ms)
+    assert h.percentile(0.5) == 175.0  # 100~250 這格的中間，不是上界 250
+    assert h.to_dict()["p50_ms"] == 175.0
+
+
+def test_windows_are_running_aggregates(stats):
+    stats.written([event(0, ttc=1500), event(2, "94", "failed"), event(30), event(200)], 0)
+    day, week = stats.summary(24)["window"], stats.summary(168)["window"]
+    assert day["outcomes"] == {"created": 1, "failed": 1}
+    assert day["channels"] == {"196": {"created": 1}, "94": {"failed": 1}}
+    assert week["outcomes"] == {"created": 2, "failed": 1}
+    assert stats.summary(24)["outcomes"] == {"created": 3, "failed": 1}  # 總計不受視窗影響
+    assert "hourly" not in day
+    assert sum(sum(h["outcomes"].values()) for h in stats.summary(24, hourly=True)["window"]["hourly"]) == 2
+
+
+def test_window_drops_hours_that_slide_out(stats):
+    stats.written([event(0, ttc=1500), event(2, "94", "failed", ttc=500)], 0)
+    window = stats.windows[24]
+    window.advance(stats.hours, datetime.now() + timedelta(hours=22))
+    assert window.outcomes == {"created": 1}
+    assert window.channels == {"196": {"created": 1}}
+    assert window.ttc.total == 1 and window.ttc.max_ms == 1500
+    window.advance(stats.hours, datetime.now() + timedelta(hours=100))  # 整個視窗都滑出：重建
+    assert not window.outcomes and not window.channels
+
+
+def test_unknown_window_is_rejected(stats):
+    assert stats.summary(100)["ok"] is False
+
+
+def test_poller_rejections_are_recorded(monkeypatch):
+    recorded = []
+
+    async def rejected(*args):
+        raise app.AdmissionRejected("channel:196", "rate limited", retry_after=1)
+
+    monkeypatch.setattr(app, "process_chat_message", rejected)
+    monkeypatch.setattr(app, "record_rejected", lambda route, channel_id, e: recorded.append((route, channel_id, e.scope)))
+    monkeypatch.setattr(app, "POST_LEDGER", app.PostLedger(10))
+    poller = app.ChatPoller(client=None, state_path="")
+    post = {"post_id": 5, "message": "新商機 客戶A", "creator_id": "7"}
+    assert asyncio.run(poller.ingest("196", post)) is False
+    assert recorded == [("chat_poll", "196", "channel:196")]
+
+
+def test_shadow_runs_do_not_touch_live_outcome():
+    live = app.PipelineOutcome("chat_webhook", "196", "7", "business")
+    seen = []
+
+    def pipeline():
+        seen.append(app._outcome.get())
+        return app.FastJSONResponse({"ok": True})
+
+    token = app._outcome.set(live)
+    try:
+        app.run_shadow("chat_webhook", "196", "shadow", pipeline)
+        assert app._outcome.get() is live
+    finally:
+        app._outcome.reset(token)
+    assert seen == [None]
+
+
+def test_default_window_is_largest_retained(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "STATS_WINDOWS", [24, 168, 720])
+    stats = app.PipelineStats(str(tmp_path / "events.ndjson"), str(tmp_path / "snap.json"), 72)  # 只保留 72 小時
+    assert sorted(stats.windows) == [24]
+    assert stats.summary()["ok"] is True
+    assert stats.summary()["window"] == stats.summary(24)["window"]
@@ -0,0 +1,113 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+import app
+
+
+def make_request(token=None):
+    headers = [(b"x-debug-token", token.encode())] if token is not None else []
+    return Request({"type": "http", "method": "GET", "path": "/debug/traces", "headers": headers, "query_string": b""})
+
+
+def test_debug_endpoints_disabled_without_token(monkeypatch):
+    monkeypatch.setattr(app, "DEBUG_TOKEN", "")
+    with pytest.raises(HTTPException) as e:
+        app.require_debug_token(make_request())
+    assert e.value.status_code == 404
+
+
+def test_debug_token_checked(monkeypatch):
+    monkeypatch.setattr(app, "DEBUG_TOKEN", "s3cret")
+    with pytest.raises(HTTPException) as e:
+        app.require_debug_token(make_request("wrong"))
+    assert e.value.status_code == 403
+    with pytest.raises(HTTPException):
+        app.require_debug_token(make_request())
+    app.require_debug_token(make_request("s3cret"))
+
+
+def test_concurrent_spans_keep_their_own_trace():
+    """同一個 event loop 上交錯執行的請求，span 各自記在自己的 Trace"""
+    async def request(name):
+        trace = app.Trace(name, name)
+        app._trace.set(trace)
+        with app.span("outer"):
+            await asyncio.sleep(0.01)
+            with app.span("inner"):
+                await asyncio.sleep(0.01)
+            assert threading.get_ident() not in app._thread_trace
+        return trace
+
+    async def main():
+        return await asyncio.gather(*(asyncio.create_task(request(f"r{i}")) for i in range(5)))
+
+    traces = asyncio.run(main())
+    for trace in traces:
+        names = [sp["name"] for sp in trace.spans]
+        assert names.count("outer") == 1 and names.count("inner") == 1
+
+
+def test_threadpool_span_registers_thread_for_sampler():
+    seen = {}
+
+    def work():
+        with app.span("work"):
+            seen["trace"] = app._thread_trace.get(threading.get_ident())
+
+    async def main():
+        trace = app.Trace("t", "t")
+        app._trace.set(trace)
+        await run_in_threadpool(work)
+        return trace
+
+    trace = asyncio.run(main())
+    assert seen["trace"] is trace
+
+
+def test_loop_stall_is_attributed_to_running_request(monkeypatch):
+    monitor = app.LoopMonitor(0.02, 50)
+    monkeypatch.setattr(app.logger, "warning", lambda *args, **kwargs: None)
+
+    async def blocking_request():
+        with app.loop_trace(app.Trace("req-1", "chat_webhook")):
+            await asyncio.sleep(0.05)
+            app.time.sleep(0.3)  # 同步呼叫卡住 event loop
+
+    async def idle_request():
+        with app.loop_trace(app.Trace("req-2", "chat_webhook")):
+            await asyncio.sleep(0.5)
+
+    async def main():
+        probe = asyncio.create_task(monitor.probe())
+        await asyncio.gather(blocking_request(), idle_request())
+        monitor.stop()
+        probe.cancel()
+
+    asyncio.run(main())
+    assert [s["request_id"] for s in monitor.stalls] == ["req-1"]
+    assert monitor.stalls[0]["route"] == "chat_webhook"
+    assert not app._task_trace
+
+
+def test_stop_ends_watchdog_thread(monkeypatch):
+    monitor = app.LoopMonitor(0.02, 50)
+    stalls = []
+    monkeypatch.setattr(app.logger, "warning", lambda *args, **kwargs: stalls.append(args))
+
+    async def main():
+        probe = asyncio.create_task(monitor.probe())
+        await asyncio.sleep(0.05)
+        thread = monitor._watchdog_thread
+        monitor.stop()
+        probe.cancel()
+        return thread
+
+    thread = asyncio.run(main())
+    app.time.sleep(0.2)  # probe 已停，心跳不再更新
+    assert not thread.is_alive()
+    assert not monitor.stalls and not stalls
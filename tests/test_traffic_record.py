@@ -0,0 +1,52 @@
+import json
+import os
+import subprocess
+import sys
+from urllib.parse import parse_qsl
+
+import app
+import replay_traffic
+
+TOKEN = "abcdefghijklmnop1234567890"
+
+
+def test_mask_secret_keeps_only_tail():
+    assert app.mask_secret(TOKEN) == "***34567890"
+    assert app.mask_secret("short-tok") == "***"  # 太短：末 8 碼幾乎就是全部
+    assert app.mask_secret("") == ""
+
+
+def test_sanitize_form_body_masks_token():
+    body = f"channel_id=196&token={TOKEN}&text=%E6%96%B0%E5%95%86%E6%A9%9F".encode()
+    sanitized = app.sanitize_body(body, "application/x-www-form-urlencoded; charset=utf-8")
+    assert TOKEN not in sanitized
+    assert dict(parse_qsl(sanitized)) == {"channel_id": "196", "token": "***34567890", "text": "新商機"}
+
+
+def test_sanitize_json_body_masks_token():
+    body = json.dumps({"command": "新任務", "token": TOKEN, "channel_id": "196"}).encode()
+    sanitized = app.sanitize_body(body, "application/json")
+    assert TOKEN not in sanitized
+    assert json.loads(sanitized) == {"command": "新任務", "token": "***34567890", "channel_id": "196"}
+
+
+def test_sanitize_skips_other_content():
+    assert app.sanitize_body(b"--boundary\r\n...", "multipart/form-data; boundary=boundary") is None
+    assert app.sanitize_body(b"{not json", "application/json") is None
+
+
+def test_restore_token_per_channel():
+    body = app.sanitize_body(f"channel_id=94&token={TOKEN}&text=x".encode(), "application/x-www-form-urlencoded")
+    entry = {"body": body, "content_type": "application/x-www-form-urlencoded"}
+    tokens = app.parse_map("196:tokA, 94:tokB")
+    assert dict(parse_qsl(replay_traffic.restore_token(entry, tokens, "fallback")))["token"] == "tokB"
+    assert dict(parse_qsl(replay_traffic.restore_token(entry, {}, "fallback")))["token"] == "fallback"
+    assert replay_traffic.restore_token(entry, {}, "") == body
+    json_entry = {"body": '{"token": "***"}', "content_type": "application/json"}
+    assert replay_traffic.restore_token(json_entry, tokens, "fallback") == json_entry["body"]
+
+
+def test_replay_tool_does_not_import_server():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys, replay_traffic; sys.exit('app' in sys.modules)"
+    assert subprocess.run([sys.executable, "-c", code], cwd=root).returncode == 0